@@ -0,0 +1,269 @@
+#! /usr/bin/env python3
+
+"""
+Time the main stages of gpas-uploader on synthetic batches of 10, 100 and 1,000 samples.
+
+Batches of random reads are generated for each size and run through validation,
+BAM conversion, decontamination, hashing, GPAS identifier assignment, upload
+and download. samtools and readItAndKeep are replaced by the stand-ins in
+fake_tools/ (see fake_tools/fake_cost.py for how to make them slower) and the
+GPAS API and upload bucket are replaced by local_server.LocalServer, so no
+network access, token or bioinformatics tools are needed. The timings are written as JSON so runs
+from two commits can be compared.
+
+    $ python benchmarks/bench_uploader.py --output before.json
+    $ git checkout my-branch
+    $ python benchmarks/bench_uploader.py --output after.json
+    $ python benchmarks/bench_uploader.py --compare before.json after.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCHMARKS = Path(__file__).resolve().parent
+
+# run against the checkout rather than any installed copy
+sys.path.insert(0, str(BENCHMARKS.parent))
+
+import gpas_uploader
+import synthetic
+from local_server import LocalServer
+
+SCHEDULE_KEYS = ['predicted_makespan', 'predicted_makespan_in_order', 'actual_makespan']
+
+
+class StageTimer:
+    """
+    Collect the duration of every stage span, summed by name, and the
+    predicted and actual makespan of the stages run with --parallel.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.schedules = {}
+
+    def start_span(self, span):
+        pass
+
+    def end_span(self, span):
+        if span.category == 'stage':
+            self.seconds[span.name] = self.seconds.get(span.name, 0) + span.duration
+            if 'actual_makespan' in span.args:
+                self.schedules[span.name] = {i: span.args[i] for i in SCHEDULE_KEYS}
+
+
+@contextlib.contextmanager
+def quiet():
+    """Discard STDOUT and STDERR at the file descriptor level.
+
+    The progress messages are printed to the sys.stdout bound when gpas_uploader
+    was imported, so contextlib.redirect_stdout does not catch them.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(devnull)
+        for i in saved:
+            os.close(i)
+
+
+def directory_size(filenames):
+    return sum(Path(i).stat().st_size for i in filenames)
+
+
+def run_batch(samples, args, workdir, token):
+    """Run every stage on a batch of the given size.
+
+    Returns
+    -------
+    dict
+        the number of seconds and, where relevant, bytes for each stage
+    """
+    timer = StageTimer()
+    gpas_uploader.add_span_listener(timer)
+
+    results = {}
+
+    try:
+        # some stages print JSON progress messages unconditionally
+        with quiet():
+
+            upload_csv = synthetic.make_batch(workdir / 'fastq', samples, reads=args.reads, read_length=args.read_length, platform=args.platform)
+
+            batch = gpas_uploader.UploadBatch(upload_csv, token_file=token, environment='local', run_parallel=args.parallel, output_json=True)
+            batch.validate()
+            assert batch.valid, batch.validation_json
+
+            outdir = workdir / 'decontaminated'
+            outdir.mkdir()
+            batch.decontaminate(run_parallel=args.parallel, outdir=outdir)
+            assert batch.decontamination_successful, batch.decontamination_json
+
+            columns = ['r1_uri', 'r2_uri'] if args.platform == 'Illumina' else ['r_uri']
+            fastq_bytes = directory_size(batch.df[columns].values.flatten())
+
+            results['validation'] = {'seconds': timer.seconds['validate']}
+            results['decontamination'] = {'seconds': timer.seconds['run_riak'], **timer.schedules.get('run_riak', {})}
+            results['hashing'] = {'seconds': timer.seconds['hash_fastqs'], 'bytes': fastq_bytes, **timer.schedules.get('hash_fastqs', {})}
+            results['guid_assignment'] = {'seconds': timer.seconds['assign_gpas_identifiers']}
+
+            batch.submit()
+            assert batch.df['uploaded'].all() and len(batch.submit_errors) == 0
+            results['upload'] = {'seconds': timer.seconds['upload'], 'bytes': fastq_bytes}
+
+            mapping_csv = workdir / 'sample_names.csv'
+            batch.sample_sheet.to_csv(mapping_csv, index=False)
+
+            download = gpas_uploader.DownloadBatch(mapping_csv, token_file=token, environment='local', output_json=True)
+            download.get_status()
+            downloads = workdir / 'downloads'
+            downloads.mkdir()
+            download.download(filetype='fasta', outdir=downloads)
+            assert download.df['fasta_downloaded'].all()
+            results['status'] = {'seconds': timer.seconds['get_status']}
+            results['download'] = {'seconds': timer.seconds['download'], 'bytes': directory_size(downloads.iterdir())}
+
+            bam_csv = synthetic.make_batch(workdir / 'bam', samples, reads=args.reads, read_length=args.read_length, platform=args.platform, bam=True)
+            bam_batch = gpas_uploader.UploadBatch(bam_csv, token_file=token, environment='local', run_parallel=args.parallel, output_json=True)
+            bam_batch.validate()
+            assert bam_batch.valid, bam_batch.validation_json
+            results['bam_conversion'] = {'seconds': timer.seconds['convert_bams'], 'bytes': directory_size((workdir / 'bam').glob('*.bam')), **timer.schedules.get('convert_bams', {})}
+
+    finally:
+        gpas_uploader.remove_span_listener(timer)
+
+    return results
+
+
+def benchmark(args):
+
+    # put the stand-in tools first on the $PATH
+    os.environ['PATH'] = str(BENCHMARKS / 'fake_tools') + os.pathsep + os.environ['PATH']
+    assert shutil.which('samtools') == str(BENCHMARKS / 'fake_tools' / 'samtools')
+
+    results = []
+
+    with LocalServer(latency=args.latency, bandwidth=args.bandwidth * 1e6 if args.bandwidth else None) as server, tempfile.TemporaryDirectory(dir=args.dir) as token_dir:
+
+        os.environ['GPAS_LOCAL_URL'] = server.url
+        token = server.write_token(Path(token_dir) / 'token.json')
+
+        for samples in args.samples:
+            for repeat in range(args.repeats):
+
+                with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+                    start = time.perf_counter()
+                    timings = run_batch(samples, args, Path(tmp), token)
+                    total = time.perf_counter() - start
+
+                for stage, timing in timings.items():
+                    result = {'samples': samples, 'repeat': repeat, 'stage': stage, 'seconds': round(timing['seconds'], 4),
+                              'samples_per_second': round(samples / timing['seconds'], 2) if timing['seconds'] > 0 else None}
+                    if 'bytes' in timing:
+                        result['bytes'] = timing['bytes']
+                        result['mb_per_second'] = round(timing['bytes'] / 1e6 / timing['seconds'], 2) if timing['seconds'] > 0 else None
+                    for i in SCHEDULE_KEYS:
+                        if i in timing:
+                            result[i] = timing[i]
+                    results.append(result)
+
+                print('%5i samples, repeat %i: %.1f s in total (including generating the data)' % (samples, repeat + 1, total), file=sys.stderr)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {'commit': commit,
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'gpas_uploader_version': gpas_uploader.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'parameters': {'reads': args.reads,
+                           'read_length': args.read_length,
+                           'platform': args.platform,
+                           'parallel': args.parallel,
+                           'latency': args.latency,
+                           'bandwidth': args.bandwidth,
+                           'fake_tool_cost': {i: os.environ[i] for i in sorted(os.environ) if i.startswith('FAKE_TOOL_')}},
+            'results': results}
+
+
+def best_times(report):
+    times = {}
+    for i in report['results']:
+        key = (i['stage'], i['samples'])
+        times[key] = min(times.get(key, i['seconds']), i['seconds'])
+    return times
+
+
+def compare(old_file, new_file, threshold):
+    """Print the ratio of new to old times, returning the number of regressions.
+    """
+    old = json.load(open(old_file))
+    new = json.load(open(new_file))
+    old_times, new_times = best_times(old), best_times(new)
+
+    print('old: %s  new: %s' % (old.get('commit'), new.get('commit')))
+    print('%-16s %8s %10s %10s %8s' % ('stage', 'samples', 'old (s)', 'new (s)', 'ratio'))
+
+    regressions = 0
+    for key in sorted(set(old_times) & set(new_times), key=lambda i: (i[1], i[0])):
+        ratio = new_times[key] / old_times[key] if old_times[key] > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            flag = '  <-- slower'
+            regressions += 1
+        print('%-16s %8i %10.3f %10.3f %8.2f%s' % (key[0], key[1], old_times[key], new_times[key], ratio, flag))
+
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", nargs='+', type=int, default=[10, 100, 1000], help='the batch sizes to run, default is 10 100 1000')
+    parser.add_argument("--reads", type=int, default=1000, help='reads (or pairs of reads) per sample, default is 1000')
+    parser.add_argument("--read_length", type=int, default=150, help='length of each read, default is 150')
+    parser.add_argument("--platform", default='Illumina', help='Illumina or Nanopore, default is Illumina')
+    parser.add_argument("--latency", type=float, default=0, help='seconds the stand-in GPAS server waits before answering each request, default is 0')
+    parser.add_argument("--bandwidth", type=float, default=None, help='cap on the MB per second to and from the stand-in GPAS server, default is no cap')
+    parser.add_argument("--parallel", action="store_true", help='convert, decontaminate and hash in parallel under a ResourceGovernor')
+    parser.add_argument("--repeats", type=int, default=1, help='run each batch size this many times, default is 1')
+    parser.add_argument("--dir", default=None, help='where to write the synthetic batches, default is the system temporary folder')
+    parser.add_argument("--output", default='benchmark.json', help='the JSON file to write the results to, default is benchmark.json')
+    parser.add_argument("--compare", nargs=2, metavar=('OLD', 'NEW'), help='compare two results files instead of running the benchmarks')
+    parser.add_argument("--threshold", type=float, default=1.2, help='when comparing, flag stages whose time has grown by more than this factor, default is 1.2')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) > 0 else 0)
+
+    report = benchmark(args)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for i in report['results']:
+        print('%-16s %8i %10.3f s' % (i['stage'], i['samples'], i['seconds']))
@@ -0,0 +1,45 @@
+#! /usr/bin/env python3
+
+"""
+Tunable cost for the fake samtools and readItAndKeep.
+
+Both tools do the real work of reading and writing their files; these
+environment variables then make them behave like slower tools.
+
+    FAKE_TOOL_CPU_SECONDS_PER_MB   busy the CPU for this many seconds per MB processed (default 0)
+    FAKE_TOOL_MB_PER_SECOND        cap the rate at which data is processed, by sleeping (default no cap)
+    FAKE_TOOL_STARTUP_SECONDS      sleep this long before starting, e.g. to mimic loading an index (default 0)
+"""
+
+import hashlib
+import os
+import time
+
+
+class Cost:
+
+    def __init__(self):
+
+        self.cpu_seconds_per_mb = float(os.environ.get('FAKE_TOOL_CPU_SECONDS_PER_MB', 0))
+        self.mb_per_second = float(os.environ.get('FAKE_TOOL_MB_PER_SECOND', 0))
+
+        time.sleep(float(os.environ.get('FAKE_TOOL_STARTUP_SECONDS', 0)))
+
+        self.start = time.monotonic()
+        self.processed = 0
+
+    def charge(self, nbytes):
+        """Account for nbytes of data having been processed.
+        """
+        self.processed += nbytes
+
+        if self.cpu_seconds_per_mb > 0:
+            end = time.process_time() + nbytes / 1e6 * self.cpu_seconds_per_mb
+            digest = hashlib.sha256()
+            while time.process_time() < end:
+                digest.update(b'x' * 4096)
+
+        if self.mb_per_second > 0:
+            ahead = self.processed / 1e6 / self.mb_per_second - (time.monotonic() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
@@ -0,0 +1,302 @@
+#! /usr/bin/env python3
+
+"""
+A TCP proxy that makes a fast local link look like a slow, lossy one.
+
+Sits between gpas-uploader and a server (normally local_server.LocalServer) and
+can impose a shared bandwidth cap, one-way latency, connections reset part way
+through a transfer, a stall shortly after each connection opens (as when a
+congestion window collapses) and storms during which every new request is
+answered with a 5xx. Counts the bytes passed in each direction so the amount
+re-sent after failures can be worked out.
+"""
+
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+
+
+class Link:
+    """
+    A bandwidth cap shared by every connection in one direction.
+
+    Parameters
+    ----------
+    bandwidth : float
+        bytes per second; if None, no cap
+    """
+
+    def __init__(self, bandwidth=None):
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.available_at = time.monotonic()
+
+    def consume(self, nbytes):
+        """Block until nbytes can be sent.
+        """
+        if not self.bandwidth:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.available_at)
+            self.available_at = start + nbytes / self.bandwidth
+            wait = self.available_at - now
+        time.sleep(wait)
+
+
+class FaultyProxy:
+    """
+    Forward connections to upstream, misbehaving as configured.
+
+    Parameters
+    ----------
+    upstream : str
+        host:port to forward to
+    bandwidth : float
+        cap on bytes per second in each direction, shared by all connections (default no cap)
+    latency : float
+        seconds added in each direction (default 0)
+    reset_rate : float
+        expected number of connection resets per MB forwarded (default 0)
+    stall_seconds : float
+        how long to pause each connection once stall_after bytes have passed (default 0)
+    stall_after : int
+        bytes after which each connection stalls (default 64 KB)
+    storm_period : float
+        seconds between the starts of 5xx storms (default None, no storms)
+    storm_duration : float
+        length of each storm in seconds; new requests are refused with storm_status (default 0)
+    storm_status : int
+        the HTTP status returned during a storm (default 503)
+    seed : int
+        seed for deciding when to reset connections
+    """
+
+    def __init__(self, upstream, bandwidth=None, latency=0, reset_rate=0, stall_seconds=0, stall_after=64 * 1024, storm_period=None, storm_duration=0, storm_status=503, seed=0):
+
+        host, port = upstream.split(':')
+        self.upstream = (host, int(port))
+        self.latency = latency
+        self.reset_rate = reset_rate
+        self.stall_seconds = stall_seconds
+        self.stall_after = stall_after
+        self.storm_period = storm_period
+        self.storm_duration = storm_duration
+        self.storm_status = storm_status
+
+        self.links = {'up': Link(bandwidth), 'down': Link(bandwidth)}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.counters = {'connections': 0, 'bytes_up': 0, 'bytes_down': 0, 'resets': 0, 'stalls': 0, 'storm_responses': 0}
+
+        self.listener = None
+        self.thread = None
+        self.running = False
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i' % self.listener.getsockname()[1]
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.running = True
+        self.start_time = time.monotonic()
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.listener is not None:
+            # closing alone does not wake a thread blocked in accept()
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.listener.close()
+            self.thread.join()
+            self.listener = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def reset_counters(self):
+        with self.lock:
+            for i in self.counters:
+                self.counters[i] = 0
+
+    def in_storm(self):
+        if not self.storm_period:
+            return False
+        return (time.monotonic() - self.start_time) % self.storm_period < self.storm_duration
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.counters[key] += value
+
+    def _accept(self):
+        while self.running:
+            try:
+                client, address = self.listener.accept()
+            except OSError:
+                return
+            self._count('connections')
+            threading.Thread(target=self._connection, args=(client,), daemon=True).start()
+
+    def _connection(self, client):
+
+        if self.in_storm():
+            self._refuse(client)
+            return
+
+        try:
+            server = socket.create_connection(self.upstream)
+        except OSError:
+            self._abort(client)
+            return
+
+        state = {'closed': False, 'bytes': 0, 'stalled': False, 'pumps': 2}
+        lock = threading.Lock()
+
+        for source, destination, direction in [(client, server, 'up'), (server, client, 'down')]:
+            threading.Thread(target=self._pump, args=(source, destination, direction, state, lock, client, server), daemon=True).start()
+
+    def _pump(self, source, destination, direction, state, lock, client, server):
+        """Copy one direction of a connection, closing both sockets once both directions are done.
+        """
+        try:
+            self._copy(source, destination, direction, state, lock, client, server)
+        finally:
+            with lock:
+                state['pumps'] -= 1
+                finished = state['pumps'] == 0
+            if finished:
+                client.close()
+                server.close()
+
+    def _copy(self, source, destination, direction, state, lock, client, server):
+        """Copy one direction of a connection, delaying each chunk by the latency.
+        """
+        chunks = queue.Queue()
+
+        def read():
+            while True:
+                try:
+                    data = source.recv(16 * 1024)
+                except OSError:
+                    data = b''
+                chunks.put((time.monotonic(), data))
+                if not data:
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+
+        while True:
+            arrived, data = chunks.get()
+
+            if not data:
+                # pass on a clean close in this direction
+                try:
+                    destination.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+                return
+
+            wait = arrived + self.latency - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            self.links[direction].consume(len(data))
+
+            with lock:
+                if state['closed']:
+                    return
+                state['bytes'] += len(data)
+                stall = self.stall_seconds > 0 and not state['stalled'] and state['bytes'] >= self.stall_after
+                if stall:
+                    state['stalled'] = True
+
+            if stall:
+                self._count('stalls')
+                time.sleep(self.stall_seconds)
+
+            if self.reset_rate > 0:
+                with self.lock:
+                    reset = self.random.random() < self.reset_rate * len(data) / 1e6
+                if reset:
+                    self._count('resets')
+                    with lock:
+                        state['closed'] = True
+                    self._abort(client)
+                    self._abort(server)
+                    return
+
+            try:
+                destination.sendall(data)
+            except OSError:
+                return
+
+            self._count('bytes_' + direction, len(data))
+
+    def _refuse(self, client):
+        """Answer a single request with an error, as a struggling load balancer would.
+        """
+        try:
+            client.settimeout(10)
+            data = b''
+            while b'\r\n\r\n' not in data:
+                chunk = client.recv(16 * 1024)
+                if not chunk:
+                    break
+                data += chunk
+            self._count('bytes_up', len(data))
+
+            headers, body = data.split(b'\r\n\r\n', 1) if b'\r\n\r\n' in data else (data, b'')
+            length = 0
+            for line in headers.split(b'\r\n')[1:]:
+                key, _, value = line.partition(b':')
+                if key.strip().lower() == b'content-length':
+                    length = int(value.strip())
+
+            # drain the body so the client sees the response rather than a broken pipe
+            remaining = length - len(body)
+            while remaining > 0:
+                chunk = client.recv(min(remaining, 64 * 1024))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self._count('bytes_up', len(chunk))
+
+            message = b'{"message": "Service unavailable."}'
+            client.sendall(b'HTTP/1.1 %i Storm\r\nContent-Type: application/json\r\nContent-Length: %i\r\nConnection: close\r\n\r\n' % (self.storm_status, len(message)) + message)
+            self._count('storm_responses')
+        except OSError:
+            pass
+        finally:
+            client.close()
+
+    @staticmethod
+    def _abort(sock):
+        """Close with a TCP reset rather than a clean shutdown.
+        """
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            # wakes the thread reading from the other end, which close() alone does not
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            sock.close()
+        except OSError:
+            pass
@@ -0,0 +1,423 @@
+#! /usr/bin/env python3
+
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+import sys
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse
+
+# run against the checkout rather than any installed copy
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import gpas_uploader
+
+# the part of the path that identifies each endpoint; any prefix (ORDS_PATH, API_PATH) is ignored
+LOCAL_SERVER_ENDPOINTS = ['userOrgDtls', 'pars', 'createSampleGuids', 'batches', 'get_sample_detail', 'get_output', 'bucket']
+
+
+class LocalServer:
+    """
+    A local, in-process stand-in for the GPAS ORDS API and the upload bucket.
+
+    Implements userOrgDtls, pars, createSampleGuids, batches, get_sample_detail and
+    get_output, plus a bucket that accepts PUTs (and HEADs) to the pre-authenticated
+    request URL returned by pars. Every request can be slowed down by a fixed
+    latency and a bandwidth cap, and a fraction can be failed, so that submit and
+    download can be load-tested without a network. Point the uploader at it with
+    the local environment (see parse_access_token).
+
+    Uploaded objects are not kept, only their size and MD5, unless store_dir is given.
+    It is only for testing and benchmarking, so is not part of the gpas_uploader package.
+
+    Parameters
+    ----------
+    port : int
+        the port to listen on; 0 picks a free port (default 0)
+    token : str
+        the access token to expect; if None, any token is accepted (default None)
+    latency : float
+        seconds to wait before answering each request (default 0)
+    bandwidth : float
+        cap on bytes per second when sending or receiving bodies; if None, no cap (default None)
+    error_rate : float
+        fraction of requests to fail with error_status (default 0)
+    error_status : int
+        HTTP status code of the injected failures (default 503)
+    error_endpoints : list
+        only inject failures into these endpoints, from LOCAL_SERVER_ENDPOINTS; if None, into all (default None)
+    default_status : str
+        the status of any sample GPAS does not otherwise know about; if None, such samples are not found (default Released)
+    tags : list
+        the tags the user is allowed to use
+    store_dir : str
+        if specified, keep the uploaded objects under this folder
+    seed : int
+        seed for choosing which requests fail
+
+    Example
+    -------
+    >>> with LocalServer() as server:
+    ...     token_file = server.write_token('token.json')
+    ...     a = gpas_uploader.DownloadBatch('sample_names.csv', token_file=token_file, environment='local')
+    """
+
+    def __init__(self, port=0, token=None, latency=0, bandwidth=None, error_rate=0, error_status=503, error_endpoints=None, default_status='Released', tags=['site0', 'site1'], store_dir=None, seed=0):
+
+        self.port = port
+        self.token = token
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.error_endpoints = error_endpoints
+        self.default_status = default_status
+        self.tags = tags
+        self.store_dir = Path(store_dir) if store_dir is not None else None
+
+        self.user_name = 'local.user@example.com'
+        self.organisation = 'Local Organisation'
+        self.bucket = hashlib.md5(b'gpas-local').hexdigest()
+
+        # what GPAS knows about: objects in the bucket, submitted batches and the status of each sample
+        self.objects = {}
+        self.batches = []
+        self.guids = {}
+        self.statuses = {}
+        self.requests = {i: 0 for i in LOCAL_SERVER_ENDPOINTS}
+        self.failures = {i: 0 for i in LOCAL_SERVER_ENDPOINTS}
+
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+        sequence = random.Random(seed).choices('ACGT', k=29903)
+        self.outputs = {'fasta': b'\n'.join(''.join(sequence[i:i+60]).encode() for i in range(0, len(sequence), 60)) + b'\n',
+                        'json': b'{"lineage": "B.1.1.7"}',
+                        'vcf': b'##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n',
+                        'bam': gpas_uploader.compress_bgzf_block(b'BAM\x01' + bytes(8)) + gpas_uploader.BGZF_EOF}
+
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        """The WORLD_URL of the running server.
+        """
+        return 'http://127.0.0.1:%i' % self.server.server_address[1]
+
+    @property
+    def par(self):
+        """The pre-authenticated request URL of the bucket, in the same form as OCI's.
+        """
+        return self.par_for(self.url)
+
+    def par_for(self, url):
+        """The pre-authenticated request URL of the bucket when the server is reached via url, e.g. through a proxy.
+        """
+        return url + '/p/local/n/gpas/b/' + self.bucket + '/o/'
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', self.port), LocalServerHandler)
+        self.server.daemon_threads = True
+        self.server.gpas = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def write_token(self, filename):
+        """Write a token file that the uploader will accept for this server.
+
+        Returns
+        -------
+        pathlib.Path
+        """
+        filename = Path(filename)
+        with open(filename, 'w') as f:
+            json.dump({'access_token': self.token if self.token is not None else 'local', 'expires_in': 3600}, f)
+        return filename
+
+    def get_status(self, sample):
+        with self.lock:
+            if sample in self.statuses:
+                return self.statuses[sample]
+        return self.default_status
+
+    def output(self, sample, filetype):
+        """The file GPAS would return for a sample; the FASTA header is the sample name.
+        """
+        if filetype == 'fasta':
+            return gzip.compress(b'>' + sample.encode() + b'\n' + self.outputs['fasta'], mtime=0)
+        return self.outputs[filetype]
+
+    def inject_failure(self, endpoint):
+        """Decide whether to fail this request.
+        """
+        if self.error_rate <= 0 or (self.error_endpoints is not None and endpoint not in self.error_endpoints):
+            return False
+        with self.lock:
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.failures[endpoint] += 1
+        return fail
+
+
+class LocalServerHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests made to a LocalServer.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        # clients dropping the connection part way through a request is expected, not an error
+        try:
+            super().handle()
+        except ConnectionError:
+            self.close_connection = True
+
+    def _handle(self, method):
+
+        gpas = self.server.gpas
+        path = urlparse(self.path).path
+        parts = path.strip('/').split('/')
+
+        if '/b/' + gpas.bucket + '/o/' in path:
+            endpoint = 'bucket'
+        else:
+            endpoint = next((i for i in LOCAL_SERVER_ENDPOINTS if i in parts), None)
+
+        if endpoint is None:
+            self._read_body()
+            return self._send(404, {'message': 'Not found.'})
+
+        with gpas.lock:
+            gpas.requests[endpoint] += 1
+
+        if gpas.latency > 0:
+            time.sleep(gpas.latency)
+
+        # the PAR is pre-authenticated so needs no token
+        if endpoint != 'bucket' and gpas.token is not None and self.headers.get('Authorization') != 'Bearer ' + gpas.token:
+            self._read_body()
+            return self._send(401, {'message': 'Unauthorized.'})
+
+        if gpas.inject_failure(endpoint):
+            self._read_body()
+            return self._send(gpas.error_status, {'message': 'Injected failure.'})
+
+        if endpoint == 'bucket':
+            return self._bucket(method, path.split('/o/', 1)[1])
+
+        body = self._read_body()
+
+        if endpoint == 'userOrgDtls':
+            self._send(200, {'userOrgDtl': [{'userName': gpas.user_name, 'organisation': gpas.organisation, 'tags': [{'tagName': i} for i in gpas.tags]}]})
+
+        elif endpoint == 'pars':
+            # hand out the address the client used, so uploads follow it through any proxy
+            self._send(200, {'par': gpas.par_for('http://' + self.headers.get('Host', gpas.url.split('//')[1]))})
+
+        elif endpoint == 'createSampleGuids':
+            request = json.loads(body)
+            samples = []
+            with gpas.lock:
+                for md5 in request['batch']['samples']:
+                    guid = gpas.guids.setdefault(md5, str(uuid.uuid4()))
+                    gpas.statuses.setdefault(guid, 'Uploaded')
+                    samples.append({'hash': md5, 'guid': guid})
+            self._send(200, {'batch': {'guid': 'B-' + uuid.uuid4().hex[:8].upper(), 'samples': samples}})
+
+        elif endpoint == 'batches':
+            request = json.loads(body)
+            with gpas.lock:
+                gpas.batches.append(request)
+                for sample in request['batch']['samples']:
+                    gpas.statuses[sample['name']] = 'Unreleased'
+            self._send(200, {'status': 'submitted'})
+
+        elif endpoint == 'get_sample_detail':
+            status = gpas.get_status(parts[-1])
+            if status is None:
+                self._send(404, {'message': 'Sample not found.'})
+            else:
+                self._send(200, [{'status': status}])
+
+        elif endpoint == 'get_output':
+            sample, filetype = parts[-2], parts[-1]
+            if gpas.get_status(sample) not in ['Unreleased', 'Released', 'Error'] or filetype not in gpas.outputs:
+                self._send(404, {'message': 'Sample not found.'})
+            else:
+                contents = gpas.output(sample, filetype)
+                self._send(200, contents, headers={'Content-MD5': base64.b64encode(hashlib.md5(contents).digest()).decode()})
+
+    def _bucket(self, method, name):
+
+        gpas = self.server.gpas
+
+        if method == 'HEAD':
+            with gpas.lock:
+                entry = gpas.objects.get(name)
+            if entry is None:
+                return self._send(404, b'')
+            return self._send(200, b'', headers={'Content-MD5': base64.b64encode(bytes.fromhex(entry['md5'])).decode(), 'ETag': entry['md5']}, length=entry['size'])
+
+        if method != 'PUT':
+            self._read_body()
+            return self._send(405, {'message': 'Method not allowed.'})
+
+        digest = hashlib.md5()
+        size = 0
+
+        output = None
+        if gpas.store_dir is not None:
+            # the object name comes from the URL so must not lead out of store_dir
+            filename = (gpas.store_dir / name).resolve()
+            if filename == gpas.store_dir.resolve() or gpas.store_dir.resolve() not in filename.parents:
+                self._read_body()
+                return self._send(400, {'message': 'Invalid object name.'})
+            filename.parent.mkdir(parents=True, exist_ok=True)
+            output = open(filename, 'wb')
+
+        try:
+            for chunk in self._body_chunks():
+                digest.update(chunk)
+                size += len(chunk)
+                if output is not None:
+                    output.write(chunk)
+        finally:
+            if output is not None:
+                output.close()
+
+        if 'Content-MD5' in self.headers and base64.b64decode(self.headers['Content-MD5']) != digest.digest():
+            return self._send(400, {'message': 'Content-MD5 does not match.'})
+
+        with gpas.lock:
+            gpas.objects[name] = {'size': size, 'md5': digest.hexdigest()}
+
+        self._send(200, b'', headers={'opc-content-md5': base64.b64encode(digest.digest()).decode(), 'ETag': digest.hexdigest()})
+
+    def _body_chunks(self):
+        """Yield the request body, whether sent with a Content-Length or chunked.
+        """
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    # skip any trailers
+                    while self.rfile.readline() not in [b'\r\n', b'\n', b'']:
+                        pass
+                    return
+                yield self._throttled_read(size)
+                self.rfile.readline()
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                chunk = self._throttled_read(min(remaining, 64 * 1024))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def _read_body(self):
+        return b''.join(self._body_chunks())
+
+    def _throttled_read(self, size):
+        start = time.monotonic()
+        data = self.rfile.read(size)
+        self._throttle(len(data), start)
+        return data
+
+    def _throttle(self, nbytes, start):
+        bandwidth = self.server.gpas.bandwidth
+        if bandwidth:
+            remaining = nbytes / bandwidth - (time.monotonic() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def _send(self, code, body, headers={}, length=None):
+
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        if body[:1] in [b'{', b'[']:
+            self.send_header('Content-Type', 'application/json')
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+        if self.command == 'HEAD':
+            return
+
+        for i in range(0, len(body), 64 * 1024):
+            start = time.monotonic()
+            self.wfile.write(body[i:i + 64 * 1024])
+            self._throttle(len(body[i:i + 64 * 1024]), start)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='run a local stand-in for GPAS; use with --environment local and GPAS_LOCAL_URL')
+    parser.add_argument("--port", type=int, default=8080, help='the port to listen on, default is 8080')
+    parser.add_argument("--token", default=None, help='only accept this access token, default is to accept any')
+    parser.add_argument("--latency", type=float, default=0, help='seconds to wait before answering each request, default is 0')
+    parser.add_argument("--bandwidth", type=float, default=None, help='cap on the MB per second sent or received, default is no cap')
+    parser.add_argument("--error_rate", type=float, default=0, help='fraction of requests to fail, default is 0')
+    parser.add_argument("--error_status", type=int, default=503, help='HTTP status code of the failed requests, default is 503')
+    parser.add_argument("--error_endpoints", nargs='+', default=None, help='only fail requests to these endpoints, from ' + ' '.join(LOCAL_SERVER_ENDPOINTS))
+    parser.add_argument("--store_dir", default=None, help='keep the uploaded files in this folder')
+    args = parser.parse_args()
+
+    server = LocalServer(port=args.port,
+                         token=args.token,
+                         latency=args.latency,
+                         bandwidth=args.bandwidth * 1e6 if args.bandwidth is not None else None,
+                         error_rate=args.error_rate,
+                         error_status=args.error_status,
+                         error_endpoints=args.error_endpoints,
+                         store_dir=args.store_dir)
+
+    server.start()
+    print('GPAS stand-in listening; export GPAS_LOCAL_URL=' + server.url)
+
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,194 @@
+#! /usr/bin/env python3
+
+"""
+Measure how submit and download cope with slow and unreliable networks.
+
+A synthetic batch is decontaminated once, then for each scenario it is submitted,
+and its outputs downloaded, through a FaultyProxy in front of local_server.LocalServer.
+For each scenario the completion time, whether it completed, and the bytes
+re-sent or re-fetched (the bytes that crossed the link beyond those finally
+stored, which includes HTTP overhead) are reported and saved as JSON.
+
+    $ python benchmarks/network_scenarios.py --samples 10 --reads 5000
+    $ python benchmarks/network_scenarios.py --scenarios lan lossy --output lossy.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+BENCHMARKS = Path(__file__).resolve().parent
+
+# run against the checkout rather than any installed copy
+sys.path.insert(0, str(BENCHMARKS.parent))
+
+import gpas_uploader
+import synthetic
+from bench_uploader import quiet
+from faulty_network import FaultyProxy
+from local_server import LocalServer
+
+# the arguments to FaultyProxy for each scenario; bandwidth is in bytes per second
+SCENARIOS = {
+    'lan': {},
+    'slow_link': {'bandwidth': 1e6, 'latency': 0.1},
+    'satellite': {'bandwidth': 0.5e6, 'latency': 0.3},
+    'lossy': {'bandwidth': 2e6, 'latency': 0.05, 'reset_rate': 0.5},
+    'stalls': {'latency': 0.05, 'stall_seconds': 2, 'stall_after': 32 * 1024},
+    'storm': {'storm_period': 10, 'storm_duration': 3},
+}
+
+
+def run_submit(batch, server, proxy):
+
+    server.objects.clear()
+    proxy.reset_counters()
+
+    batch.environment_urls['local']['WORLD_URL'] = proxy.url
+
+    error = None
+    start = time.perf_counter()
+    try:
+        with quiet():
+            batch.submit()
+    except Exception as e:
+        error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+    seconds = time.perf_counter() - start
+
+    columns = ['r1_uri', 'r2_uri'] if batch.sequencing_platform == 'Illumina' else ['r_uri']
+    payload = sum(Path(i).stat().st_size for i in batch.df[columns].values.flatten())
+    stored = sum(i['size'] for i in server.objects.values())
+
+    completed = error is None and bool(batch.df['uploaded'].all()) and len(batch.submit_errors) == 0
+
+    return {'operation': 'submit',
+            'completed': completed,
+            'seconds': round(seconds, 3),
+            'payload_bytes': payload,
+            'bytes_sent': proxy.counters['bytes_up'],
+            'bytes_resent': max(proxy.counters['bytes_up'] - stored, 0),
+            'connections': proxy.counters['connections'],
+            'resets': proxy.counters['resets'],
+            'stalls': proxy.counters['stalls'],
+            'storm_responses': proxy.counters['storm_responses'],
+            'error': error}
+
+
+def run_download(mapping_csv, token, proxy, outdir, filetypes):
+
+    proxy.reset_counters()
+
+    error = None
+    start = time.perf_counter()
+    try:
+        with quiet():
+            download = gpas_uploader.DownloadBatch(mapping_csv, token_file=token, environment='local', output_json=True)
+            download.environment_urls['local']['WORLD_URL'] = proxy.url
+            download.get_status()
+            for filetype in filetypes:
+                download.download(filetype=filetype, outdir=outdir)
+    except Exception as e:
+        error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        download = None
+    seconds = time.perf_counter() - start
+
+    stored = sum(i.stat().st_size for i in outdir.iterdir())
+    completed = error is None and all(download.df[i + '_downloaded'].all() for i in filetypes)
+
+    return {'operation': 'download',
+            'completed': completed,
+            'seconds': round(seconds, 3),
+            'payload_bytes': stored,
+            'bytes_received': proxy.counters['bytes_down'],
+            'bytes_refetched': max(proxy.counters['bytes_down'] - stored, 0),
+            'connections': proxy.counters['connections'],
+            'resets': proxy.counters['resets'],
+            'stalls': proxy.counters['stalls'],
+            'storm_responses': proxy.counters['storm_responses'],
+            'error': error}
+
+
+def run_scenarios(args):
+
+    os.environ['PATH'] = str(BENCHMARKS / 'fake_tools') + os.pathsep + os.environ['PATH']
+    assert shutil.which('readItAndKeep') == str(BENCHMARKS / 'fake_tools' / 'readItAndKeep')
+
+    results = []
+
+    with LocalServer() as server, tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+
+        tmp = Path(tmp)
+        os.environ['GPAS_LOCAL_URL'] = server.url
+        token = server.write_token(tmp / 'token.json')
+
+        # prepare the batch once, directly against the server
+        with quiet():
+            upload_csv = synthetic.make_batch(tmp / 'batch', args.samples, reads=args.reads, read_length=args.read_length, platform=args.platform)
+            batch = gpas_uploader.UploadBatch(upload_csv, token_file=token, environment='local', output_json=True)
+            batch.validate()
+            assert batch.valid, batch.validation_json
+            (tmp / 'decontaminated').mkdir()
+            batch.decontaminate(outdir=tmp / 'decontaminated')
+            assert batch.decontamination_successful, batch.decontamination_json
+
+        mapping_csv = tmp / 'sample_names.csv'
+        batch.sample_sheet.to_csv(mapping_csv, index=False)
+
+        upstream = server.url.split('//')[1]
+
+        for name in args.scenarios:
+
+            with FaultyProxy(upstream, seed=args.seed, **SCENARIOS[name]) as proxy:
+
+                for result in [run_submit(batch, server, proxy),
+                               run_download(mapping_csv, token, proxy, Path(tempfile.mkdtemp(dir=tmp)), args.file_types)]:
+                    result['scenario'] = name
+                    results.append(result)
+                    print('%-10s %-9s %-10s %8.1f s  %s' % (name, result['operation'], 'completed' if result['completed'] else 'FAILED', result['seconds'], result['error'] or ''), file=sys.stderr)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {'commit': commit,
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'gpas_uploader_version': gpas_uploader.__version__,
+            'python': platform.python_version(),
+            'parameters': {'samples': args.samples,
+                           'reads': args.reads,
+                           'read_length': args.read_length,
+                           'platform': args.platform,
+                           'file_types': args.file_types,
+                           'seed': args.seed,
+                           'scenarios': {i: SCENARIOS[i] for i in args.scenarios}},
+            'results': results}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS), help='which scenarios to run, default is all of them')
+    parser.add_argument("--samples", type=int, default=10, help='number of samples in the batch, default is 10')
+    parser.add_argument("--reads", type=int, default=5000, help='reads (or pairs of reads) per sample, default is 5000')
+    parser.add_argument("--read_length", type=int, default=150, help='length of each read, default is 150')
+    parser.add_argument("--platform", default='Illumina', help='Illumina or Nanopore, default is Illumina')
+    parser.add_argument("--file_types", nargs='+', default=['fasta', 'vcf'], help='which files to download, default is fasta vcf')
+    parser.add_argument("--seed", type=int, default=0, help='seed for the injected faults, default is 0')
+    parser.add_argument("--dir", default=None, help='where to write the synthetic batch, default is the system temporary folder')
+    parser.add_argument("--output", default='network_scenarios.json', help='the JSON file to write the results to, default is network_scenarios.json')
+    args = parser.parse_args()
+
+    report = run_scenarios(args)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
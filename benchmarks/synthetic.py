@@ -0,0 +1,206 @@
+#! /usr/bin/env python3
+
+"""
+Generate synthetic batches of FASTQ or BAM files, and their upload CSVs, for benchmarking.
+
+The reads are random so will not map to anything; the BAMs hold unmapped reads
+only, in the same order as the paired FASTQs would be, so the fake samtools in
+fake_tools/ can convert them back.
+"""
+
+import csv
+import gzip
+import random
+import struct
+from pathlib import Path
+
+import gpas_uploader
+
+BAM_BASES = '=ACMGRSVTWYHKDBN'
+
+# unmapped paired read 1, unmapped paired read 2 and unmapped unpaired read
+PAIRED_FLAGS = [77, 141]
+UNPAIRED_FLAG = 4
+
+UPLOAD_CSV_COLUMNS = ['batch', 'run_number', 'sample_name', 'control', 'collection_date', 'tags', 'country', 'region', 'district', 'specimen_organism', 'host', 'instrument_platform', 'primer_scheme']
+
+
+# lookup tables so that reads can be generated from random bytes without a Python loop per base
+_NIBBLES = [BAM_BASES.index(i) for i in 'ACGT']
+_PACKED = bytes((_NIBBLES[i >> 2 & 3] << 4) | _NIBBLES[i & 3] for i in range(256))
+_UNPACKED = {i: BAM_BASES[i >> 4] + BAM_BASES[i & 15] for i in set(_PACKED)}
+_QUALITIES = bytes(b'5?FI'[i & 3] for i in range(256))
+_PHRED = bytes(max(i - 33, 0) for i in range(256))
+
+
+def random_reads(reads, read_length, seed):
+    """Yield reproducible random reads.
+
+    Parameters
+    ----------
+    reads : int
+        the number of reads
+    read_length : int
+        the length of every read
+    seed : int
+        seed for the random number generator
+
+    Returns
+    -------
+    generator
+        of (sequence, quality, packed) tuples, where packed is the sequence in BAM 4-bit encoding
+    """
+    rng = random.Random(seed)
+    for i in range(reads):
+        packed = rng.randbytes((read_length + 1) // 2).translate(_PACKED)
+        sequence = ''.join(map(_UNPACKED.__getitem__, packed))[:read_length]
+        quality = rng.randbytes(read_length).translate(_QUALITIES).decode()
+        yield sequence, quality, packed
+
+
+def write_fastq(filename, reads, read_length, seed=0, mate=None):
+    """Write a gzipped FASTQ file of random reads.
+
+    Parameters
+    ----------
+    filename : pathlib.Path
+        the FASTQ to write, e.g. sample1_1.fastq.gz
+    reads : int
+        the number of reads
+    read_length : int
+        the length of every read
+    seed : int
+        seed for the random number generator; use the same seed for both files of a pair and
+        the same seed for write_bam to get the same reads
+    mate : int
+        1 or 2 to add /1 or /2 to the read names, or None for unpaired reads
+    """
+    suffix = '' if mate is None else '/' + str(mate)
+    with gzip.open(filename, 'wt', compresslevel=6) as f:
+        for i, (sequence, quality, packed) in enumerate(random_reads(reads, read_length, 4 * seed + (mate or 0))):
+            f.write('@read%i%s\n%s\n+\n%s\n' % (i, suffix, sequence, quality))
+
+
+def encode_bam_record(name, packed, read_length, quality, flag):
+    """Encode an unmapped read as a BAM alignment record.
+
+    Returns
+    -------
+    bytes
+    """
+    read_name = name.encode() + b'\x00'
+    qual = quality.encode().translate(_PHRED)
+    core = struct.pack('<iiBBHHHiiii', -1, -1, len(read_name), 255, 4680, 0, flag, read_length, -1, -1, 0)
+    record = core + read_name + packed + qual
+    return struct.pack('<i', len(record)) + record
+
+
+def write_bam(filename, reads, read_length, seed=0, paired=True):
+    """Write a BGZF-compressed BAM file of unmapped random reads.
+
+    Parameters
+    ----------
+    filename : pathlib.Path
+        the BAM to write
+    reads : int
+        the number of reads (or pairs of reads if paired)
+    read_length : int
+        the length of every read
+    seed : int
+        seed for the random number generator
+    paired : bool
+        if True, write both reads of each pair, sorted by name
+    """
+    text = b'@HD\tVN:1.6\tSO:queryname\n'
+    data = bytearray(b'BAM\x01' + struct.pack('<i', len(text)) + text + struct.pack('<i', 0))
+
+    if paired:
+        mates = [random_reads(reads, read_length, 4 * seed + 1), random_reads(reads, read_length, 4 * seed + 2)]
+        for i, pair in enumerate(zip(*mates)):
+            for (sequence, quality, packed), flag in zip(pair, PAIRED_FLAGS):
+                data += encode_bam_record('read%i' % i, packed, read_length, quality, flag)
+    else:
+        for i, (sequence, quality, packed) in enumerate(random_reads(reads, read_length, 4 * seed)):
+            data += encode_bam_record('read%i' % i, packed, read_length, quality, UNPAIRED_FLAG)
+
+    with open(filename, 'wb') as f:
+        for block, usize in gpas_uploader.compress_bgzf(bytes(data)):
+            f.write(block)
+        f.write(gpas_uploader.BGZF_EOF)
+
+
+def make_batch(directory, samples, reads=1000, read_length=150, platform='Illumina', bam=False):
+    """Write a complete synthetic batch and its upload CSV.
+
+    Parameters
+    ----------
+    directory : pathlib.Path
+        where to write the files; created if it does not exist
+    samples : int
+        the number of samples
+    reads : int
+        reads per sample (pairs for Illumina)
+    read_length : int
+        the length of every read
+    platform : str
+        Illumina or Nanopore
+    bam : bool
+        if True, write BAM files rather than FASTQs
+
+    Returns
+    -------
+    pathlib.Path
+        the upload CSV
+    """
+    assert platform in ['Illumina', 'Nanopore'], 'platform must be one of Illumina/Nanopore'
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    if bam:
+        file_columns = ['bam']
+    elif platform == 'Illumina':
+        file_columns = ['fastq1', 'fastq2']
+    else:
+        file_columns = ['fastq']
+
+    columns = UPLOAD_CSV_COLUMNS[:3] + file_columns + UPLOAD_CSV_COLUMNS[3:]
+
+    upload_csv = directory / ('%s-%s-%i.csv' % (platform.lower(), 'bam' if bam else 'fastq', samples))
+
+    with open(upload_csv, 'w', newline='') as f:
+
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+
+        for i in range(samples):
+
+            stem = 'sample%i' % (i + 1)
+
+            if bam:
+                files = {'bam': stem + '.bam'}
+                write_bam(directory / files['bam'], reads, read_length, seed=i, paired=(platform == 'Illumina'))
+            elif platform == 'Illumina':
+                files = {'fastq1': stem + '_1.fastq.gz', 'fastq2': stem + '_2.fastq.gz'}
+                write_fastq(directory / files['fastq1'], reads, read_length, seed=i, mate=1)
+                write_fastq(directory / files['fastq2'], reads, read_length, seed=i, mate=2)
+            else:
+                files = {'fastq': stem + '.fastq.gz'}
+                write_fastq(directory / files['fastq'], reads, read_length, seed=i)
+
+            writer.writerow({'batch': 'bench',
+                             'run_number': 'run%i' % (i % 4 + 1),
+                             'sample_name': stem,
+                             **files,
+                             'control': '',
+                             'collection_date': '2022-02-01',
+                             'tags': 'site0',
+                             'country': 'GBR',
+                             'region': '',
+                             'district': '',
+                             'specimen_organism': 'SARS-CoV-2',
+                             'host': 'human',
+                             'instrument_platform': platform,
+                             'primer_scheme': 'auto'})
+
+    return upload_csv
@@ -0,0 +1,213 @@
+#! /usr/bin/env python3
+
+import csv
+import hashlib
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+# how much of a zip member to hold in memory before spooling it to disk
+ZIP_SPOOL_BYTES = 64 * 1024 * 1024
+
+
+class ArchiveSink:
+    """
+    Write downloaded files into one or more size-capped tar or zip archives with a manifest.
+
+    Archives are named <prefix>.001.tar, <prefix>.002.tar and so on; a new one is
+    started once the current archive reaches max_size bytes. Every member is
+    recorded in <prefix>.manifest.csv, along with the sample, filetype, size and
+    SHA-256 digest, once it can be read back: for tar as soon as it has been
+    completely written, for zip only once the archive has been closed, as a zip
+    cannot be read without the directory written at its end. Members already in
+    the manifest are reported by __contains__ so an interrupted download can be
+    resumed; a resumed run always starts a new archive, numbered after any that
+    already exist.
+
+    Data is streamed into the archive as it arrives. For tar the member header is
+    written after the data, once the size is known, so no temporary copy is needed
+    even when the server does not send a Content-Length. A zip member cannot be
+    taken back once written, so it is first spooled, in memory or if large on disk
+    next to the archive, and only added once the whole file has arrived. Either way
+    a file whose chunks raise an exception part way leaves nothing in the archive.
+
+    Parameters
+    ----------
+    prefix : filename
+        path and stem of the archives, e.g. outputs/batch1
+    max_size : int
+        the number of bytes after which to start a new archive (default 10 GB)
+    archive_format : str
+        either tar or zip (default tar)
+    """
+
+    def __init__(self, prefix, max_size=10*1024**3, archive_format='tar'):
+
+        assert archive_format in ['tar', 'zip'], 'archive_format must be one of tar/zip'
+
+        self.prefix = Path(prefix)
+        self.max_size = max_size
+        self.archive_format = archive_format
+        self.manifest = Path(str(self.prefix) + '.manifest.csv')
+
+        # members from concurrent downloads are written one at a time
+        self.lock = threading.Lock()
+
+        self.members = set()
+        if self.manifest.is_file():
+            with open(self.manifest, newline='') as f:
+                for row in csv.DictReader(f):
+                    self.members.add((row['sample'], row['filetype']))
+        else:
+            with open(self.manifest, 'w', newline='') as f:
+                csv.writer(f).writerow(['archive', 'member', 'sample', 'filetype', 'size', 'sha256'])
+
+        # never overwrite an archive, even if there are gaps in the numbering
+        numbers = [i.name[len(self.prefix.name) + 1:-len(self.archive_format) - 1] for i in self.prefix.parent.glob(self.prefix.name + '.???.' + self.archive_format)]
+        self.archive_number = max([int(i) for i in numbers if i.isdigit()], default=0)
+
+        self.archive = None
+        self.archive_name = None
+
+        # manifest rows for the members of the current zip, written once it is closed
+        self.pending = []
+
+    def __contains__(self, key):
+        return key in self.members
+
+    def add(self, member, chunks, sample, filetype):
+        """Stream a single file into the current archive.
+
+        Parameters
+        ----------
+        member : str
+            the name of the file inside the archive
+        chunks : iterable
+            yielding the contents of the file as bytes
+        sample : str
+            the sample the file belongs to, recorded in the manifest
+        filetype : str
+            the filetype, recorded in the manifest
+
+        Returns
+        -------
+        int
+            the number of bytes written
+        """
+
+        with self.lock:
+
+            if self.archive is None or self._archive_size() >= self.max_size:
+                self._next_archive()
+
+            digest = hashlib.sha256()
+
+            if self.archive_format == 'tar':
+                size = self._add_tar(member, chunks, digest)
+            else:
+                size = self._add_zip(member, chunks, digest)
+
+            self.pending.append([self.archive_name.name, member, sample, filetype, size, digest.hexdigest()])
+            if self.archive_format == 'tar':
+                self._write_manifest()
+
+            self.members.add((sample, filetype))
+
+        return size
+
+    def close(self):
+        """Finish the current archive.
+        """
+        with self.lock:
+            self._close_archive()
+
+    def _archive_size(self):
+        return self.archive.fp.tell() if self.archive_format == 'zip' else self.archive.tell()
+
+    def _next_archive(self):
+        self._close_archive()
+        self.archive_number += 1
+        self.archive_name = Path(str(self.prefix) + '.%03i.' % self.archive_number + self.archive_format)
+        if self.archive_format == 'tar':
+            self.archive = open(self.archive_name, 'wb')
+        else:
+            self.archive = zipfile.ZipFile(self.archive_name, 'w', allowZip64=True)
+
+    def _close_archive(self):
+        if self.archive is not None:
+            if self.archive_format == 'tar':
+                # end of archive marker
+                self.archive.write(tarfile.NUL * 2 * tarfile.BLOCKSIZE)
+            self.archive.close()
+            self.archive = None
+            self._write_manifest()
+
+    def _write_manifest(self):
+        with open(self.manifest, 'a', newline='') as f:
+            csv.writer(f).writerows(self.pending)
+        self.pending = []
+
+    def _add_tar(self, member, chunks, digest):
+
+        info = tarfile.TarInfo(member)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+
+        # leave space for the header, which is written once the size is known
+        start = self.archive.tell()
+        header_size = len(info.tobuf(format=tarfile.GNU_FORMAT))
+        self.archive.write(tarfile.NUL * header_size)
+
+        size = 0
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.archive.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+        except Exception:
+            # remove the partial member, otherwise its empty header would end the archive
+            self.archive.seek(start)
+            self.archive.truncate()
+            raise
+
+        remainder = size % tarfile.BLOCKSIZE
+        if remainder:
+            self.archive.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        end = self.archive.tell()
+
+        info.size = size
+        self.archive.seek(start)
+        self.archive.write(info.tobuf(format=tarfile.GNU_FORMAT))
+        self.archive.seek(end)
+
+        return size
+
+    def _add_zip(self, member, chunks, digest):
+
+        # outputs that are already compressed are stored as is
+        if member.endswith('.gz') or member.endswith('.bam'):
+            compression = zipfile.ZIP_STORED
+        else:
+            compression = zipfile.ZIP_DEFLATED
+
+        info = zipfile.ZipInfo(member, date_time=time.localtime(time.time())[:6])
+        info.compress_type = compression
+
+        size = 0
+        with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_BYTES, dir=self.archive_name.parent) as spool:
+            for chunk in chunks:
+                if chunk:
+                    spool.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+
+            spool.seek(0)
+            with self.archive.open(info, 'w', force_zip64=True) as f:
+                shutil.copyfileobj(spool, f, 1024 * 1024)
+
+        return size
@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+
+from pathlib import Path
+
+import pandas
+
+import gpas_uploader
+
+# columns with few distinct values that are stored as categoricals in Parquet/Arrow files
+CATEGORICAL_COLUMNS = ['status', 'country', 'region', 'instrument_platform', 'batch', 'local_batch', 'gpas_batch', 'run_number', 'local_run_number', 'gpas_run_number']
+
+PARQUET_SUFFIXES = ['.parquet', '.pq']
+
+ARROW_SUFFIXES = ['.arrow', '.feather']
+
+
+def write_batch_state(df, filename):
+    """Save a mapping, status or download DataFrame, choosing the format from the file suffix.
+
+    Parquet (.parquet/.pq) and Arrow (.arrow/.feather) files store the repetitive
+    columns in CATEGORICAL_COLUMNS as categoricals; anything else is written as CSV.
+    Parquet and Arrow need pyarrow to be installed.
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        the batch state to save
+    filename: pathlib.Path
+        where to write it
+    """
+    suffix = Path(filename).suffix.lower()
+
+    if suffix not in PARQUET_SUFFIXES + ARROW_SUFFIXES:
+        df.to_csv(filename, index=False)
+        return
+
+    df = df.reset_index(drop=True)
+    for i in CATEGORICAL_COLUMNS:
+        if i in df.columns:
+            # Arrow cannot store a mix of e.g. integer and string run numbers
+            if df[i].dtype == object:
+                df[i] = df[i].where(df[i].isna(), df[i].astype(str))
+            df[i] = df[i].astype('category')
+
+    try:
+        if suffix in PARQUET_SUFFIXES:
+            df.to_parquet(filename, index=False)
+        else:
+            df.to_feather(filename)
+    except ImportError:
+        raise gpas_uploader.GpasError({"batch state": "pyarrow must be installed to write " + suffix + " files"})
+
+
+def read_batch_state(filename):
+    """Load a mapping, status or download DataFrame saved by write_batch_state.
+
+    Parameters
+    ----------
+    filename: pathlib.Path
+        the CSV, Parquet or Arrow file to read
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    suffix = Path(filename).suffix.lower()
+
+    if suffix not in PARQUET_SUFFIXES + ARROW_SUFFIXES:
+        return pandas.read_csv(filename)
+
+    try:
+        if suffix in PARQUET_SUFFIXES:
+            return pandas.read_parquet(filename)
+        else:
+            return pandas.read_feather(filename)
+    except ImportError:
+        raise gpas_uploader.GpasError({"batch state": "pyarrow must be installed to read " + suffix + " files"})
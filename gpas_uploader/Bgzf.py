@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+
+import struct
+import zlib
+
+# the empty block that terminates every BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# the maximum number of uncompressed bytes per block (as used by samtools)
+BGZF_BLOCK_SIZE = 0xff00
+
+BGZF_MAX_BLOCK = 0x10000
+
+
+def compress_bgzf_block(data, level=6):
+    """Compress up to BGZF_BLOCK_SIZE bytes into a single BGZF block.
+
+    Parameters
+    ----------
+    data: bytes
+        the uncompressed data
+    level: int
+        the zlib compression level (default 6)
+
+    Returns
+    -------
+    bytes
+        the complete BGZF block, including header and trailer
+    """
+    assert len(data) <= BGZF_BLOCK_SIZE, 'too much data for a single BGZF block'
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+
+    # incompressible data can grow so fall back to storing it
+    if len(cdata) + 26 > BGZF_MAX_BLOCK:
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+
+    header = struct.pack('<4BIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+
+    return header + cdata + struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def compress_bgzf(data, level=6):
+    """Split data into BGZF_BLOCK_SIZE pieces and compress each as a BGZF block.
+
+    Returns
+    -------
+    list
+        of (bytes, int) tuples of the compressed block and its uncompressed size
+    """
+    return [(compress_bgzf_block(data[i:i+BGZF_BLOCK_SIZE], level), len(data[i:i+BGZF_BLOCK_SIZE])) for i in range(0, len(data), BGZF_BLOCK_SIZE)]
+
+
+def read_bgzf_blocks(f):
+    """Walk the headers of the BGZF blocks in an open file without decompressing them.
+
+    Stops at the first block that is incomplete or not BGZF, so a file truncated
+    part way through a write yields only its intact blocks.
+
+    Parameters
+    ----------
+    f: file
+        opened in binary mode and positioned at the start of a block
+
+    Yields
+    ------
+    tuple
+        (compressed offset, compressed size, uncompressed size) of each block
+    """
+    offset = f.tell()
+    while True:
+        header = f.read(18)
+        if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:16] != b'BC\x02\x00':
+            return
+        block_size = struct.unpack('<H', header[16:18])[0] + 1
+        f.seek(offset + block_size - 4)
+        trailer = f.read(4)
+        if len(trailer) < 4:
+            return
+        yield (offset, block_size, struct.unpack('<I', trailer)[0])
+        offset += block_size
+
+
+def write_gzi(filename, blocks):
+    """Write a samtools/htslib .gzi index for a BGZF file.
+
+    Parameters
+    ----------
+    filename: pathlib.Path
+        the .gzi file to write
+    blocks: list
+        of (compressed offset, uncompressed offset) tuples, one per block
+    """
+    # the first block always starts at 0,0 and is left implicit
+    entries = [i for i in blocks if i != (0, 0)]
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<Q', len(entries)))
+        for compressed, uncompressed in entries:
+            f.write(struct.pack('<QQ', compressed, uncompressed))
+
+
+def append_gzi(filename, blocks):
+    """Add blocks to the end of a .gzi index written by write_gzi.
+
+    Only the new entries and the count at the start are written, so adding to a
+    large index takes no longer than adding to a small one.
+
+    Parameters
+    ----------
+    filename: pathlib.Path
+        the .gzi file
+    blocks: list
+        of (compressed offset, uncompressed offset) tuples, one per block added
+    """
+    entries = [i for i in blocks if i != (0, 0)]
+    with open(filename, 'r+b') as f:
+        count = struct.unpack('<Q', f.read(8))[0]
+        f.seek(8 + 16 * count)
+        for compressed, uncompressed in entries:
+            f.write(struct.pack('<QQ', compressed, uncompressed))
+        f.truncate()
+        f.seek(0)
+        f.write(struct.pack('<Q', count + len(entries)))
@@ -4,12 +4,17 @@ import pathlib
 import requests
 import json
 import gzip
+import time
+import zlib
 
 import pandas
 from tqdm.auto import tqdm
 
 import gpas_uploader
 
+# statuses after which a sample will not change again
+TERMINAL_STATUSES = ['Released', 'Error', 'Authorization required', 'Sample not found', 'You do not have access to this sample']
+
 
 class DownloadBatch:
     """
@@ -35,23 +40,39 @@ class DownloadBatch:
 
         assert self.mapping_csv.is_file, 'provided CSV does not exist!'
 
-        INPUT = open(self.mapping_csv, 'rb')
-        data = INPUT.read()
-        assert gpas_uploader.check_utf8(data), 'mapping CSV must be UTF-8, please check your CSV'
+        # the mapping can also be a Parquet/Arrow file previously saved by write_batch_state
+        if self.mapping_csv.suffix.lower() not in gpas_uploader.PARQUET_SUFFIXES + gpas_uploader.ARROW_SUFFIXES:
+            INPUT = open(self.mapping_csv, 'rb')
+            data = INPUT.read()
+            assert gpas_uploader.check_utf8(data), 'mapping CSV must be UTF-8, please check your CSV'
+
+        self.df = gpas_uploader.read_batch_state(self.mapping_csv)
+
+        # earlier versions also saved the index in the output CSV
+        self.df = self.df.drop(columns=['Unnamed: 0'], errors='ignore')
+
+        # the status is updated as samples progress so cannot stay categorical
+        if 'status' in self.df.columns:
+            self.df['status'] = self.df['status'].astype(object)
 
-        self.df = pandas.read_csv(self.mapping_csv)
+        # ignore any status and download columns saved from a previous run
+        mapping_columns = [i for i in self.df.columns if i != 'status' and not i.endswith('_downloaded') and not i.endswith('_verified')]
 
-        if len(self.df.columns) == 6:
+        if len(mapping_columns) == 6:
             self.mapping_csv_type = 'wide'
-            assert all(self.df.columns.isin(['local_batch', 'local_run_number', 'local_sample_name', 'gpas_batch', 'gpas_run_number', 'gpas_sample_name'])), 'mapping CSV does not have a header of local_batch,local_run_number,local_sample_name,gpas_batch,gpas_run_number,gpas_sample_name'
-        elif len(self.df.columns) == 1:
+            assert all(pandas.Index(mapping_columns).isin(['local_batch', 'local_run_number', 'local_sample_name', 'gpas_batch', 'gpas_run_number', 'gpas_sample_name'])), 'mapping CSV does not have a header of local_batch,local_run_number,local_sample_name,gpas_batch,gpas_run_number,gpas_sample_name'
+        elif len(mapping_columns) == 1:
             self.mapping_csv_type = 'narrow'
-            assert self.df.columns == ['gpas_sample_name'], 'single column mapping CSV should have a header of gpas_sample_name'
+            assert mapping_columns == ['gpas_sample_name'], 'single column mapping CSV should have a header of gpas_sample_name'
         else:
            raise Error('specified mapping CSV should only have 1 or 6 columns')
 
         self.access_token, self.headers, self.environment_urls = gpas_uploader.parse_access_token(token_file)
 
+        # outcome of verifying each downloaded file, keyed on (gpas_sample_name, filetype)
+        self.verification = {}
+        self.download_failures = []
+
 
     def get_status(self):
         """Retrieve the status of the samples in the mapping CSV.
@@ -66,23 +87,34 @@ class DownloadBatch:
         """
         url = self.environment_urls[self.enviroment]['WORLD_URL'] + self.environment_urls[self.enviroment]['API_PATH']
         url += '/get_sample_detail/'
-        self.df['status'] = self.df.apply(self._get_sample_status, args=(url,), axis=1)
+        with gpas_uploader.span('get_status', samples=len(self.df)):
+            status = self.df.apply(self._get_sample_status, args=(url,), axis=1)
+
+        # a sample that could not be polled keeps any status it already had
+        if 'status' in self.df.columns:
+            status = status.fillna(self.df['status'])
+        self.df['status'] = status.fillna('Unknown')
         return self.df.rename(columns={'gpas_sample_name': 'sample'})[['sample', 'status']].to_dict('records')
 
 
     def _get_sample_status(self, row, url):
         url += row.gpas_sample_name
-        response = requests.get(url=url, headers=self.headers)
-        if response.ok:
-            result = json.loads(response.content)
-            status = result[0]['status']
-        elif response.status_code == 401:
-            status = "Authorization required"
-        elif 'message' in json.loads(response.text).keys():
-            status = json.loads(response.text)['message']
-            status = status.replace('.','')
-        else:
-            status = 'Unknown'
+        try:
+            response = requests.get(url=url, headers=self.headers)
+            if response.ok:
+                result = json.loads(response.content)
+                status = result[0]['status']
+            elif response.status_code == 401:
+                status = "Authorization required"
+            elif 'message' in json.loads(response.text).keys():
+                status = json.loads(response.text)['message']
+                status = status.replace('.','')
+            else:
+                status = 'Unknown'
+
+        # e.g. the connection failed or a proxy returned an HTML error page
+        except (requests.exceptions.RequestException, ValueError):
+            return None
 
         if self.output_json:
             gpas_uploader.dsmsg(row.gpas_sample_name, status, json=True)
@@ -90,7 +122,7 @@ class DownloadBatch:
         return status
 
 
-    def download(self, filetype=None, outdir=None, rename=False):
+    def download(self, filetype=None, outdir=None, rename=False, multi_fasta=None, archive=None):
         """Download the specified files (FASTA etc) using the mapping CSV
 
         Parameters
@@ -101,6 +133,10 @@ class DownloadBatch:
             the path to write the downloaded files
         rename : bool
             if True, rename the downloaded files to the local_sample_name. For FASTA files this includes modifying the header to include both the local_sample_name and the gpas_sample_name
+        multi_fasta : str
+            if specified, append the FASTA files to this single indexed BGZF multi-FASTA instead of writing one file per sample
+        archive : gpas_uploader.ArchiveSink
+            if specified, stream the files into these archives instead of writing one file per sample
         """
 
         assert filetype in ['fasta', 'json', 'bam', 'vcf'], 'must specify one of fasta/json/bam/vcf'
@@ -115,15 +151,29 @@ class DownloadBatch:
 
         output_dir = pathlib.Path(outdir)
 
-        if not self.output_json:
-            tqdm.pandas(desc='Downloading '+filetype)
-
-            self.df[filetype+'_downloaded'] = self.df.progress_apply(self._download_file, args=(url, filetype, output_dir, rename), axis=1)
+        if filetype == 'fasta' and multi_fasta is not None:
+            writer = gpas_uploader.MultiFastaWriter(multi_fasta)
         else:
-            self.df[filetype+'_downloaded'] = self.df.apply(self._download_file, args=(url, filetype, output_dir, rename), axis=1)
+            writer = None
 
+        try:
+            with gpas_uploader.span('download', samples=len(self.df), filetype=filetype):
+
+                if not self.output_json:
+                    tqdm.pandas(desc='Downloading '+filetype)
+
+                    self.df[filetype+'_downloaded'] = self.df.progress_apply(self._download_file, args=(url, filetype, output_dir, rename, writer, archive), axis=1)
+                else:
+                    self.df[filetype+'_downloaded'] = self.df.apply(self._download_file, args=(url, filetype, output_dir, rename, writer, archive), axis=1)
 
-    def _download_file(self, row, url, filetype, outdir, rename):
+        finally:
+            if writer is not None:
+                writer.close()
+
+        self._record_verification(filetype)
+
+
+    def _download_file(self, row, url, filetype, outdir, rename, multi_fasta=None, archive=None):
         """Private method to download a file from GPAS.
 
         Designed to be used with pandas.DataFrame.apply
@@ -140,6 +190,10 @@ class DownloadBatch:
             where to write the downloaded file
         rename: bool
             if True, rename the downloaded file to the local_sample_name
+        multi_fasta: gpas_uploader.MultiFastaWriter
+            if not None, append the FASTA to this instead of writing its own file
+        archive: gpas_uploader.ArchiveSink
+            if not None, stream the file into this archive instead of writing its own file
 
         Returns
         -------
@@ -149,53 +203,276 @@ class DownloadBatch:
 
         url = url + row.gpas_sample_name + '/' + filetype
 
+        if rename:
+            header = row.local_sample_name + '|' + row.gpas_sample_name
+        else:
+            header = row.gpas_sample_name
+
         if filetype + '_downloaded' in row.keys() and row[filetype + '_downloaded']:
             return True
-        elif row.status in ['Unreleased', 'Released', 'Error']:
+        elif multi_fasta is not None and header in multi_fasta:
+            return True
+        elif multi_fasta is None and archive is not None and (row.gpas_sample_name, filetype) in archive:
+            return True
+        elif row.status not in ['Unreleased', 'Released', 'Error']:
+            return False
 
-            response = requests.get(url=url, headers=self.headers)
+        with gpas_uploader.span('download', category='sample', sample=row.gpas_sample_name, filetype=filetype) as s:
+
+            # stream the body rather than holding it all in memory
+            try:
+                response = requests.get(url=url, headers=self.headers, stream=True)
+            except requests.exceptions.RequestException as err:
+                self.verification[(row.gpas_sample_name, filetype)] = 'failed'
+                if self.output_json:
+                    gpas_uploader.ddmsg(row.gpas_sample_name, filetype, json=True, msg={'status':'failure'})
+                s.set(error=repr(err))
+                return False
 
             if not response.ok:
                 if self.output_json:
                     gpas_uploader.ddmsg(row.gpas_sample_name, filetype, json=True, msg={'status':'failure'})
+                s.set(status_code=response.status_code)
                 return False
-            else:
-                if outdir is not None:
-                    filename = outdir
-                else:
-                    filename = pathlib.Path('.')
 
-                if filetype == 'fasta':
-                    if rename:
-                        filename = str(filename / row.local_sample_name) + '.fasta.gz'
-                    else:
-                        filename = str(filename / row.gpas_sample_name) + '.fasta.gz'
+            # check the size, digest and structure of the file as it arrives
+            verifier = gpas_uploader.DownloadVerifier(filetype, response.headers)
+            chunks = verifier.wrap(response.iter_content(chunk_size=1024*1024))
+
+            filename = None
+
+            try:
+
+                if multi_fasta is not None:
+
+                    # keep only the sequence, and the original header unless renaming
+                    contents = gzip.decompress(b''.join(chunks))
+                    if not rename and contents.startswith(b'>'):
+                        header = contents.split(b'\n', 1)[0][1:].rstrip(b'\r').decode('utf8')
+                    sequence = b''.join(line for line in contents.splitlines() if not line.startswith(b'>'))
+                    multi_fasta.append(header, sequence)
+
+                    written = str(multi_fasta.filename)
+
+                elif archive is not None:
+
+                    stem = row.local_sample_name if rename else row.gpas_sample_name
+                    member = stem + '.fasta.gz' if filetype == 'fasta' else stem + '.' + filetype
+
+                    if filetype == 'fasta' and rename:
+                        contents = gzip.decompress(b''.join(chunks)).split(b'\n', 1)[1]
+                        chunks = [gzip.compress(b'>' + bytes(header, encoding='utf8') + b'\n' + contents)]
+
+                    archive.add(member, chunks, row.gpas_sample_name, filetype)
+
+                    written = str(archive.archive_name)
+
                 else:
-                    if rename:
-                        filename = str(filename / row.local_sample_name) + '.' + filetype
+                    if outdir is not None:
+                        filename = outdir
                     else:
-                        filename = str(filename / row.gpas_sample_name) + '.' + filetype
+                        filename = pathlib.Path('.')
 
-                with open(filename, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=1024):
-                        if chunk:
+                    if filetype == 'fasta':
+                        if rename:
+                            filename = str(filename / row.local_sample_name) + '.fasta.gz'
+                        else:
+                            filename = str(filename / row.gpas_sample_name) + '.fasta.gz'
+                    else:
+                        if rename:
+                            filename = str(filename / row.local_sample_name) + '.' + filetype
+                        else:
+                            filename = str(filename / row.gpas_sample_name) + '.' + filetype
+
+                    with open(filename, 'wb') as f:
+                        for chunk in chunks:
                             f.write(chunk)
 
-                if filetype == 'fasta' and rename:
-                    with gzip.open(filename, 'rb') as f:
-                        stem = filename.split('/')[-1].split('.fasta.gz')[0]
-                        file_contents = f.readline()
-                        file_contents = b'>' + bytes(stem, encoding='utf8') + b'|' + bytes(row.gpas_sample_name, encoding='utf8') + b'\n'
-                        for line in f:
-                            file_contents += line
+                    if filetype == 'fasta' and rename:
+                        with gzip.open(filename, 'rb') as f:
+                            stem = filename.split('/')[-1].split('.fasta.gz')[0]
+                            file_contents = f.readline()
+                            file_contents = b'>' + bytes(stem, encoding='utf8') + b'|' + bytes(row.gpas_sample_name, encoding='utf8') + b'\n'
+                            for line in f:
+                                file_contents += line
+
+                        with gzip.open(filename, 'wb') as f:
+                            f.write(file_contents)
+                            f.close()
+
+                    written = filename
+
+            except (gpas_uploader.GpasError, requests.exceptions.RequestException, gzip.BadGzipFile, EOFError, zlib.error) as err:
+
+                # e.g. the connection dropped part way through the body
+                if isinstance(err, requests.exceptions.RequestException):
+                    verifier.errors.append('download failed: ' + str(err))
+
+                # or the FASTA could not be decompressed to rename it or add it to the multi-FASTA
+                elif not isinstance(err, gpas_uploader.GpasError):
+                    verifier.errors.append('gzip stream is corrupt: ' + str(err))
 
-                    with gzip.open(filename, 'wb') as f:
-                        f.write(file_contents)
-                        f.close()
+                # do not leave a truncated or corrupt file behind
+                if filename is not None and pathlib.Path(filename).is_file():
+                    pathlib.Path(filename).unlink()
+
+                self.verification[(row.gpas_sample_name, filetype)] = verifier.result()['status']
 
                 if self.output_json:
-                    gpas_uploader.ddmsg(row.gpas_sample_name, filetype, json=True, msg={'status':'success'})
+                    gpas_uploader.ddmsg(row.gpas_sample_name, filetype, json=True, msg={'status':'failure', 'verification': verifier.result()})
 
-                return True
-        else:
+                s.set(bytes=verifier.size, verification=verifier.result()['status'])
+                return False
+
+            self.verification[(row.gpas_sample_name, filetype)] = verifier.result()['status']
+
+            if self.output_json:
+                gpas_uploader.ddmsg(row.gpas_sample_name, filetype, json=True, msg={'status':'success', 'file': written, 'verification': verifier.result()})
+
+            s.set(bytes=verifier.size, verification=verifier.result()['status'])
+            return True
+
+
+    def watch(self, filetypes=['fasta'], outdir=None, rename=False, interval=30, max_interval=600, timeout=None, multi_fasta=None, archive=None, max_failures=5):
+        """Poll the pending samples and download their files as soon as they are available.
+
+        Only samples that have not yet reached a terminal status (or whose files have
+        not all been downloaded) are polled. The wait between polls doubles each time
+        nothing changes, up to max_interval, and falls back to interval whenever a
+        status changes or a file is downloaded. If a sample cannot be polled, e.g. the
+        connection fails, it keeps its previous status and the wait doubles. A Released
+        sample whose files fail to download max_failures times in a row is given up on
+        and listed in the instance variable download_failures.
+
+        Parameters
+        ----------
+        filetypes : list
+            the filetypes to download, from ['fasta', 'json', 'bam', 'vcf']
+        outdir : str
+            the path to write the downloaded files
+        rename : bool
+            if True, rename the downloaded files to the local_sample_name
+        interval : float
+            the initial (and minimum) number of seconds between polls (default 30)
+        max_interval : float
+            the maximum number of seconds between polls (default 600)
+        timeout : float
+            give up after this many seconds; if None, wait until every sample is finished
+        multi_fasta : str
+            if specified, append the FASTA files to this single indexed BGZF multi-FASTA instead of writing one file per sample
+        archive : gpas_uploader.ArchiveSink
+            if specified, stream the files into these archives instead of writing one file per sample
+        max_failures : int
+            the number of polls in a row a Released sample's files can fail to download before it is given up on (default 5)
+
+        Returns
+        -------
+        bool
+            True if every sample reached a terminal status and its files were downloaded, False if the timeout
+            passed first or any sample was given up on
+        """
+
+        for filetype in filetypes:
+            assert filetype in ['fasta', 'json', 'bam', 'vcf'], 'must specify one of fasta/json/bam/vcf'
+
+        if self.mapping_csv_type == 'narrow':
+            assert not rename, "cannot rename the files to the local_sample_name if you don't provide the full mapping CSV with six fields that is output by the GPAS upload app or command line tool"
+
+        url = self.environment_urls[self.enviroment]['WORLD_URL'] + self.environment_urls[self.enviroment]['API_PATH']
+        status_url = url + '/get_sample_detail/'
+        download_url = url + '/get_output/'
+
+        output_dir = pathlib.Path(outdir) if outdir is not None else None
+
+        if 'status' not in self.df.columns:
+            self.df['status'] = None
+        for filetype in filetypes:
+            if filetype + '_downloaded' not in self.df.columns:
+                self.df[filetype + '_downloaded'] = False
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        wait = interval
+
+        # only samples polled in this session count as finished
+        polled = pandas.Series(False, index=self.df.index)
+
+        # the polls in a row that each Released sample's files failed to download
+        failures = pandas.Series(0, index=self.df.index)
+
+        def unfinished():
+            return ~(polled & self.df.apply(self._watch_finished, args=(filetypes,), axis=1)) & (failures < max_failures)
+
+        writer = gpas_uploader.MultiFastaWriter(multi_fasta) if multi_fasta is not None else None
+
+        try:
+            pending = unfinished()
+
+            while pending.any():
+
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+
+                before = self.df.loc[pending].copy()
+
+                # a sample that could not be polled keeps its previous status and is polled again
+                status = self.df.loc[pending].apply(self._get_sample_status, args=(status_url,), axis=1)
+                failed = status.isna()
+                self.df.loc[status.index[~failed], 'status'] = status[~failed]
+                polled[status.index[~failed]] = True
+
+                for filetype in filetypes:
+                    self.df.loc[pending, filetype + '_downloaded'] = self.df.loc[pending].apply(self._download_file, args=(download_url, filetype, output_dir, rename, writer if filetype == 'fasta' else None, archive), axis=1)
+                    self._record_verification(filetype)
+
+                downloaded = self.df[[filetype + '_downloaded' for filetype in filetypes]].all(axis=1)
+                failures[pending & (self.df.status == 'Released') & ~downloaded] += 1
+                failures[downloaded] = 0
+
+                columns = ['status'] + [filetype + '_downloaded' for filetype in filetypes]
+                changed = (self.df.loc[pending, columns] != before[columns]).any(axis=None) and not failed.any()
+
+                # do not wait again once the last sample has finished
+                pending = unfinished()
+                if not pending.any():
+                    break
+
+                wait = interval if changed else min(wait * 2, max_interval)
+
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        continue
+                    time.sleep(min(wait, remaining))
+                else:
+                    time.sleep(wait)
+
+            self.download_failures = list(self.df.gpas_sample_name[failures >= max_failures])
+
+            return len(self.download_failures) == 0
+
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _record_verification(self, filetype):
+        """Private method that adds the outcome of verifying each download to a <filetype>_verified column.
+        """
+        column = filetype + '_verified'
+        previous = self.df[column] if column in self.df.columns else pandas.Series(None, index=self.df.index, dtype=object)
+        self.df[column] = [self.verification.get((i, filetype), j) for i, j in zip(self.df.gpas_sample_name, previous)]
+
+    def _watch_finished(self, row, filetypes):
+        """Private method that decides if a sample no longer needs polling.
+
+        Designed to be used with pandas.DataFrame.apply
+
+        Returns
+        -------
+        bool
+            True if the sample has a terminal status and, if Released, all its files have been downloaded
+        """
+        if row.status not in TERMINAL_STATUSES:
             return False
+        if row.status == 'Released':
+            return all(row[filetype + '_downloaded'] for filetype in filetypes)
+        return True
@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+
+import base64
+import binascii
+import hashlib
+import zlib
+
+import gpas_uploader
+
+
+class DownloadVerifier:
+    """
+    Check a downloaded file as it is streamed, without a second pass over it.
+
+    Counts the bytes and computes their MD5, which are compared against the
+    Content-Length and any MD5 sent by the server (Content-MD5 or OCI's
+    opc-content-md5). BAM files must end with the BGZF EOF block; other gzip
+    files are decompressed as they arrive so a truncated member, or a trailer
+    whose CRC or uncompressed size (ISIZE) does not match, is caught. FASTA
+    files are always gzip-compressed, so one that is not fails.
+
+    Parameters
+    ----------
+    filetype : str
+        one of fasta, bam, vcf, json
+    headers : dict
+        the headers of the HTTP response
+
+    Example
+    -------
+    >>> a = DownloadVerifier('json', {'Content-Length': '2'})
+    >>> b''.join(a.wrap([b'{}']))
+    b'{}'
+    >>> a.result()['status']
+    'verified'
+    """
+
+    def __init__(self, filetype, headers):
+
+        self.filetype = filetype
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.head = b''
+        self.tail = b''
+        self.decompressor = None
+        self.errors = []
+
+        # requests transparently decodes any Content-Encoding so the length no longer applies
+        if 'Content-Length' in headers and 'Content-Encoding' not in headers:
+            self.expected_size = int(headers['Content-Length'])
+        else:
+            self.expected_size = None
+
+        self.expected_md5 = None
+        for i in ['Content-MD5', 'opc-content-md5']:
+            if i in headers:
+                try:
+                    self.expected_md5 = base64.b64decode(headers[i]).hex()
+                except binascii.Error:
+                    pass
+
+    def update(self, chunk):
+        """Add the next chunk of the download.
+        """
+        self.md5.update(chunk)
+        self.size += len(chunk)
+
+        if len(self.head) < 2:
+            self.head += chunk[:2 - len(self.head)]
+            if self.head == b'\x1f\x8b' and self.filetype != 'bam':
+                self.decompressor = zlib.decompressobj(31)
+
+        self.tail = (self.tail + chunk[-len(gpas_uploader.BGZF_EOF):])[-len(gpas_uploader.BGZF_EOF):]
+
+        if self.decompressor is not None and not self.errors:
+            self._decompress(chunk)
+
+    def wrap(self, chunks):
+        """Pass the chunks through, checking them on the way.
+
+        Raises
+        ------
+        gpas_uploader.GpasError
+            once all the chunks have been seen, if the download failed verification
+        """
+        for chunk in chunks:
+            if chunk:
+                self.update(chunk)
+                yield chunk
+        if self.result()['status'] != 'verified':
+            raise gpas_uploader.GpasError({'verification': self.result()})
+
+    def result(self):
+        """Finish the checks.
+
+        Returns
+        -------
+        dict
+            with the status (verified or failed), size, md5 and any errors
+        """
+        errors = list(self.errors)
+
+        if self.expected_size is not None and self.size != self.expected_size:
+            errors.append('expected %i bytes but received %i' % (self.expected_size, self.size))
+
+        if self.expected_md5 is not None and self.md5.hexdigest() != self.expected_md5:
+            errors.append('MD5 does not match the server')
+
+        if self.filetype == 'bam':
+            if self.head != b'\x1f\x8b' or self.tail != gpas_uploader.BGZF_EOF:
+                errors.append('BAM is missing its BGZF EOF block')
+
+        elif self.filetype == 'fasta' and self.head != b'\x1f\x8b':
+            errors.append('FASTA is not gzip-compressed')
+
+        elif self.decompressor is not None and not self.errors and not self.decompressor.eof:
+            errors.append('gzip stream is truncated')
+
+        return {'status': 'failed' if errors else 'verified',
+                'size': self.size,
+                'md5': self.md5.hexdigest(),
+                'errors': errors}
+
+    def _decompress(self, data):
+
+        try:
+            # a gzip file can be several members concatenated together
+            while data:
+                self.decompressor.decompress(data)
+                if self.decompressor.eof:
+                    data = self.decompressor.unused_data
+                    if data:
+                        self.decompressor = zlib.decompressobj(31)
+                else:
+                    data = b''
+        except zlib.error as e:
+            self.errors.append('gzip stream is corrupt: ' + str(e))
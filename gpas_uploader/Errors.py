@@ -6,6 +6,22 @@ class GpasError(Exception):
     pass
 
 
+# a tool such as samtools cannot be run at all, so none of the samples can be processed
+class MissingToolError(GpasError):
+    pass
+
+
+def describe_error(err):
+    """Return a one line description of an exception, for an errors DataFrame.
+
+    A GpasError carries a dict of messages, e.g. {"decontamination": "..."}, whose
+    messages are joined; any other exception is described by its message.
+    """
+    if isinstance(err, GpasError) and len(err.args) == 1 and isinstance(err.args[0], dict):
+        return '; '.join(str(i) for i in err.args[0].values())
+    return str(err) if str(err) else type(err).__name__
+
+
 def dmsg(sample_name, error, msg=None, json=False, file=sys.stdout):
     if not msg:
         msg = {}
@@ -0,0 +1,251 @@
+#! /usr/bin/env python3
+
+import os
+import glob
+import gzip
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import gpas_uploader
+
+
+# a FASTQ in the upload CSV containing any of these is a pattern matching several files
+GLOB_CHARACTERS = '*?['
+
+# the first bytes of gzip and zstd files
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def fastq_compression(filename):
+    """Return how a FASTQ file is compressed, judged by its first bytes.
+
+    Returns
+    -------
+    str
+        gzip, zstd or None if it is not compressed
+    """
+    with open(filename, 'rb') as INPUT:
+        magic = INPUT.read(4)
+    if magic[:2] == GZIP_MAGIC:
+        return 'gzip'
+    if magic == ZSTD_MAGIC:
+        return 'zstd'
+    return None
+
+
+def open_fastq(raw):
+    """Return a file object that reads the FASTQ in an open file, decompressing it as need be.
+
+    zstd needs the zstandard package to be installed.
+
+    Parameters
+    ----------
+    raw : file
+        opened in binary mode, at the start of the file
+
+    Returns
+    -------
+    file
+        the FASTQ, read in binary mode; raw.tell() is still how far through the file it is
+    """
+    magic = raw.read(4)
+    raw.seek(0)
+
+    if magic[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=raw)
+
+    if magic == ZSTD_MAGIC:
+        return ZstdReader(raw)
+
+    return raw
+
+
+class ZstdReader:
+    """
+    Read a zstd-compressed file, frame after frame, as gzip.GzipFile reads gzip members.
+
+    Unlike zstandard's own stream_reader, a file that ends part way through a frame
+    raises an EOFError rather than just ending early.
+
+    Parameters
+    ----------
+    raw : file
+        opened in binary mode, at the start of the file
+    """
+
+    def __init__(self, raw):
+        try:
+            import zstandard
+        except ImportError:
+            raise gpas_uploader.GpasError({"validation": "zstandard must be installed to read zstd-compressed FASTQ files"})
+
+        self.raw = raw
+        self.context = zstandard.ZstdDecompressor()
+        self.frame = None
+        self.buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            data = self.raw.read(1024 * 1024)
+            if not data:
+                if self.frame is not None:
+                    raise EOFError('compressed file ended before the end of the last frame')
+                break
+            # files written by e.g. pzstd hold several frames
+            while data:
+                if self.frame is None:
+                    self.frame = self.context.decompressobj()
+                self.buffer += self.frame.decompress(data)
+                data = b''
+                if self.frame.eof:
+                    data = self.frame.unused_data
+                    self.frame = None
+        if size < 0:
+            size = len(self.buffer)
+        block, self.buffer = self.buffer[:size], self.buffer[size:]
+        return block
+
+
+def expand_fastq(filename, wd):
+    """Return the files that a FASTQ in the upload CSV refers to.
+
+    A FASTQ containing *, ? or [ is a pattern, e.g. fastq_pass/barcode01/*.fastq.gz,
+    matching the files that hold the sample's reads between them. These are returned
+    sorted, so they are always read in the same order.
+
+    Parameters
+    ----------
+    filename : str
+        the FASTQ, relative to the working directory
+    wd : pathlib.Path
+        the working directory
+
+    Returns
+    -------
+    list of pathlib.Path
+        the one file, or the files matching the pattern, which may be none
+    """
+    filename = str(filename)
+    if not any(i in filename for i in GLOB_CHARACTERS):
+        return [Path(wd) / filename]
+    return sorted(Path(i) for i in glob.glob(os.path.join(glob.escape(str(wd)), filename)) if os.path.isfile(i))
+
+
+class FastqStream:
+    """
+    Present several FASTQ files to a tool as if they were one, without writing them out.
+
+    Gzipped files can simply be joined end to end, each becoming a member of the
+    whole, as can uncompressed ones. A thread therefore copies the files in turn into
+    a named pipe, which the tool is given as its input, so nothing is decompressed
+    or recompressed and the joined file never exists on disk. A single gzipped or
+    uncompressed file is given to the tool as it is. Files the tool cannot read,
+    i.e. zstd, or a mix of formats, are instead decompressed into the pipe as they
+    are read.
+
+    start() must be called each time the tool is started, as a pipe can only be read once.
+
+    Parameters
+    ----------
+    files : list of pathlib.Path
+        the FASTQ files, gzipped, zstd-compressed or not
+    directory : pathlib.Path
+        where to make the named pipe (default None, the system's temporary folder)
+
+    Example
+    -------
+    >>> with FastqStream(expand_fastq(row.fastq, wd)) as reads:
+    ...     reads.start()
+    ...     subprocess.run([riak, '--reads1', reads.path, ...])
+    """
+
+    def __init__(self, files, directory=None):
+
+        self.files = [Path(i) for i in files]
+        self.thread = None
+        self.tempdir = None
+        self.error = None
+
+        if len(self.files) == 0:
+            raise gpas_uploader.GpasError({"decontamination": "no FASTQ files to read"})
+
+        compression = set(fastq_compression(i) for i in self.files)
+
+        # gzipped or uncompressed files can be joined as they are, anything else is decompressed
+        self.decompress = len(compression) > 1 or 'zstd' in compression
+
+        if len(self.files) == 1 and not self.decompress:
+            self.path = self.files[0]
+            return
+
+        if not hasattr(os, 'mkfifo'):
+            raise gpas_uploader.GpasError({"decontamination": "reading several FASTQ files as one needs named pipes, which this platform does not have"})
+
+        self.tempdir = tempfile.mkdtemp(prefix='gpas-reads.', dir=directory)
+        self.path = Path(self.tempdir) / ('reads.fastq.gz' if compression == {'gzip'} else 'reads.fastq')
+        os.mkfifo(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def bytes(self):
+        """Return the total size of the files.
+        """
+        return sum(i.stat().st_size for i in self.files)
+
+    def start(self):
+        """Start feeding the files into the pipe, ready for the tool to read.
+        """
+        if self.tempdir is None:
+            return
+        self._stop()
+        self.error = None
+        self.thread = threading.Thread(target=self._feed, daemon=True)
+        self.thread.start()
+
+    def check(self):
+        """Once the tool has finished, raise a GpasError if the files could not all be
+        read into the pipe, as the tool will only have seen some of the reads.
+        """
+        self._stop()
+        if self.error is not None:
+            raise gpas_uploader.GpasError({"decontamination": "could not read %s (%s)" % (', '.join(str(i) for i in self.files), self.error)})
+
+    def close(self):
+        """Stop feeding the pipe and remove it.
+        """
+        if self.tempdir is None:
+            return
+        self._stop()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+        self.tempdir = None
+
+    def _feed(self):
+        try:
+            with open(self.path, 'wb') as OUTPUT:
+                for i in self.files:
+                    with open(i, 'rb') as INPUT:
+                        shutil.copyfileobj(open_fastq(INPUT) if self.decompress else INPUT, OUTPUT, 1024 * 1024)
+        except BrokenPipeError:
+            # the tool stopped reading, e.g. it failed or was killed
+            pass
+        except Exception as err:
+            # e.g. a corrupt file; closing the pipe lets the tool finish
+            self.error = err
+
+    def _stop(self):
+        # a tool that never opened the pipe leaves the thread waiting to open it, so
+        # open and close the other end until it gives up
+        while self.thread is not None and self.thread.is_alive():
+            try:
+                os.close(os.open(self.path, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            self.thread.join(0.1)
+        self.thread = None
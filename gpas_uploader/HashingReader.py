@@ -0,0 +1,48 @@
+#! /usr/bin/env python3
+
+import os
+import hashlib
+
+
+class HashingReader:
+    """
+    Compute the MD5 of a file as it is read for upload, without a second pass over it.
+
+    requests sends a body with a read method in blocks, so wrapping the open file
+    means every byte that goes over the wire is also hashed. The length is given
+    so that requests still sends a Content-Length rather than chunking the upload.
+
+    Parameters
+    ----------
+    f : file
+        opened in binary mode
+
+    Example
+    -------
+    >>> with open('sample1.reads.fastq.gz', 'rb') as f:
+    ...     body = HashingReader(f)
+    ...     r = requests.put(url, body)
+    >>> body.hexdigest() == row.r_md5
+    True
+    """
+
+    def __init__(self, f):
+
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.length = os.fstat(f.fileno()).st_size - f.tell()
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        """Return the MD5 of the bytes read so far.
+        """
+        return self.md5.hexdigest()
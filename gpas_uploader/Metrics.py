@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import gpas_uploader
+
+
+class MetricsWriter:
+    """
+    Export the throughput of a run as a Prometheus textfile.
+
+    Listens to the spans (see gpas_uploader.span) and keeps running totals of the
+    samples processed, bytes, durations, retries and failures for each stage.
+    The textfile is rewritten atomically every interval seconds and when the
+    writer is stopped, so it can be scraped at any time by e.g. the textfile
+    collector of the Prometheus node exporter. That reads the Prometheus text
+    format, in which the TYPE and HELP of a counter name its samples, which end
+    _total.
+
+    Parameters
+    ----------
+    filename : filename
+        the textfile to write; for the node exporter this must end .prom
+    command : str
+        the subcommand being run, added as a label to every metric
+    interval : float
+        the number of seconds between writes while running; if None, only write when stopped (default 60)
+    """
+
+    def __init__(self, filename, command=None, interval=60):
+
+        self.filename = Path(filename)
+        self.labels = {'command': command} if command is not None else {}
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.start_time = time.time()
+        self.finished = 0
+
+        self.stage_runs = {}
+        self.stage_seconds = {}
+        self.stage_samples = {}
+        self.samples = {}
+        self.failures = {}
+        self.sample_bytes = {}
+        self.retries = {}
+        self.stage_failures = {}
+
+    def start(self):
+        gpas_uploader.add_span_listener(self)
+        if self.interval is not None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stop listening and write the final textfile.
+        """
+        gpas_uploader.remove_span_listener(self)
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.finished = 1
+        self.write()
+
+    def start_span(self, span):
+        pass
+
+    def end_span(self, span):
+
+        with self.lock:
+
+            if span.category == 'stage':
+                self._increment(self.stage_runs, span.name)
+                self._increment(self.stage_seconds, span.name, span.duration)
+                if 'samples' in span.args:
+                    self._increment(self.stage_samples, span.name, span.args['samples'])
+                if 'attempts' in span.args and span.args['attempts'] > 1:
+                    self._increment(self.retries, span.name, span.args['attempts'] - 1)
+                if self._failed(span.args):
+                    self._increment(self.stage_failures, span.name)
+            else:
+                self._increment(self.samples, span.name)
+                if 'bytes' in span.args:
+                    self._increment(self.sample_bytes, span.name, span.args['bytes'])
+                if self._failed(span.args):
+                    self._increment(self.failures, span.name)
+
+    def write(self):
+        """Atomically replace the textfile with the current totals.
+        """
+        with self.lock:
+            contents = self.render()
+
+        # write alongside and rename so a scrape never sees a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.filename.parent, prefix='.' + self.filename.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(contents)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.filename)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def render(self):
+        """Format the current totals in the Prometheus text format.
+
+        Returns
+        -------
+        str
+        """
+        lines = []
+
+        def family(name, metric_type, help, values, label=None):
+            if metric_type == 'counter':
+                name += '_total'
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' ' + metric_type)
+            if label is None:
+                lines.append(name + self._format_labels({}) + ' ' + self._format_value(values))
+            else:
+                for key in sorted(values):
+                    lines.append(name + self._format_labels({label: key}) + ' ' + self._format_value(values[key]))
+
+        family('gpas_uploader_run_start_timestamp_seconds', 'gauge', 'When the run started.', self.start_time)
+        family('gpas_uploader_last_update_timestamp_seconds', 'gauge', 'When this file was written.', time.time())
+        family('gpas_uploader_run_finished', 'gauge', '1 if the run has finished, otherwise 0.', self.finished)
+        family('gpas_uploader_stage_runs', 'counter', 'Number of times each stage has run.', self.stage_runs, 'stage')
+        family('gpas_uploader_stage_duration_seconds', 'counter', 'Time spent in each stage.', self.stage_seconds, 'stage')
+        family('gpas_uploader_stage_samples', 'counter', 'Samples passed to each stage.', self.stage_samples, 'stage')
+        family('gpas_uploader_samples_processed', 'counter', 'Samples processed by each per-sample step.', self.samples, 'step')
+        family('gpas_uploader_bytes', 'counter', 'Bytes hashed, uploaded, downloaded or passed to samtools/readItAndKeep by each step.', self.sample_bytes, 'step')
+        family('gpas_uploader_retries', 'counter', 'Retries made by each stage.', self.retries, 'stage')
+        family('gpas_uploader_stage_failures', 'counter', 'Failures of each stage.', self.stage_failures, 'stage')
+        family('gpas_uploader_failures', 'counter', 'Failures of each per-sample step.', self.failures, 'step')
+
+        lines.append('# EOF')
+
+        return '\n'.join(lines) + '\n'
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    def _format_labels(self, labels):
+        labels = {**self.labels, **labels}
+        if not labels:
+            return ''
+        escaped = [k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in labels.items()]
+        return '{' + ','.join(escaped) + '}'
+
+    @staticmethod
+    def _format_value(value):
+        return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+    @staticmethod
+    def _increment(totals, key, value=1):
+        totals[key] = totals.get(key, 0) + value
+
+    @staticmethod
+    def _failed(args):
+        """Decide from the information recorded on a span whether it failed.
+        """
+        if 'error' in args:
+            return True
+        for i in ['returncode', 'sort_returncode']:
+            if args.get(i) not in [None, 0]:
+                return True
+        status_codes = args.get('status_code')
+        if status_codes is not None:
+            if not isinstance(status_codes, list):
+                status_codes = [status_codes]
+            if any(i >= 400 for i in status_codes):
+                return True
+        if args.get('verification') == 'failed':
+            return True
+        return False
@@ -1,4 +1,5 @@
 import json
+import os
 
 
 def check_utf8(data):
@@ -11,6 +12,10 @@ def check_utf8(data):
 def parse_access_token(token_file):
     """Parse the provided access token and store its contents
 
+    As well as dev, staging and prod, there is a local environment which uses the
+    WORLD_URL in the GPAS_LOCAL_URL environment variable (default http://127.0.0.1:8080),
+    such as the stand-in in benchmarks/local_server.py.
+
     Returns
     -------
     access_token: str
@@ -43,6 +48,13 @@ def parse_access_token(token_file):
             "ORDS_PATH": "/ords/gpasuat/grep/electron",
             "DASHBOARD_PATH": "/ords/gpas/r/gpas-portal/lineages-voc",
             "ENV_NAME": "STAGE"
+        },
+        "local": {
+            "WORLD_URL": os.environ.get('GPAS_LOCAL_URL', 'http://127.0.0.1:8080'),
+            "API_PATH": "/ords/gpas_pub/gpasapi",
+            "ORDS_PATH": "/ords/grep/electron",
+            "DASHBOARD_PATH": "/ords/r/gpas/gpas-portal/lineages-voc",
+            "ENV_NAME": "LOCAL"
         }
     }
     return(access_token, headers, environment_urls)
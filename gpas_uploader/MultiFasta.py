@@ -0,0 +1,185 @@
+#! /usr/bin/env python3
+
+import os
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+import gpas_uploader
+
+
+class MultiFastaWriter:
+    """
+    Append consensus genomes to a single BGZF-compressed multi-FASTA file with .fai and .gzi indexes.
+
+    Every record starts on a fresh BGZF block and the file always ends with the
+    BGZF EOF block, so after each append the file and its indexes can be read by
+    samtools faidx. The .fai is the record of which samples have been written;
+    reopening an existing file resumes after the last record in the .fai and
+    discards anything written after it by an interrupted run.
+
+    Each writer keeps the offsets of the end of the file in memory, so there can
+    only be one writer per file. An exclusive lock is held on the file from when
+    the writer is created until close() is called, and a second writer, in this or
+    any other process, raises a GpasError. The lock needs fcntl, so is not taken on
+    Windows.
+
+    Parameters
+    ----------
+    filename : filename
+        path to the multi-FASTA, conventionally ending .fasta.gz
+    line_length : int
+        number of bases per line in the written records (default 60)
+    level : int
+        the zlib compression level (default 6)
+
+    Example
+    -------
+    >>> a = MultiFastaWriter('consensus.fasta.gz')
+    >>> a.append('sample1', b'ACGT')
+    >>> 'sample1' in a
+    True
+    """
+
+    def __init__(self, filename, line_length=60, level=6):
+
+        self.filename = Path(filename)
+        self.fai = Path(str(self.filename) + '.fai')
+        self.gzi = Path(str(self.filename) + '.gzi')
+        self.line_length = line_length
+        self.level = level
+
+        # appends from concurrent downloads are serialised
+        self.lock = threading.Lock()
+
+        # and there is only one writer
+        self.handle = open(self.filename, 'ab')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.handle.close()
+                raise gpas_uploader.GpasError({'multi_fasta': str(self.filename) + ' is already being written to'})
+
+        self.names = set()
+        self.blocks = []
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+
+        if self.filename.stat().st_size > 0 and self.fai.is_file():
+            self._resume()
+        else:
+            with open(self.filename, 'wb') as f:
+                f.write(gpas_uploader.BGZF_EOF)
+            self.fai.write_text('')
+            gpas_uploader.write_gzi(self.gzi, self.blocks)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def close(self):
+        """Release the lock on the file so that another writer can append to it.
+        """
+        self.handle.close()
+
+    def append(self, name, sequence):
+        """Append a single record, unless a record with this name has already been written.
+
+        Parameters
+        ----------
+        name : str
+            the FASTA header, without the leading >
+        sequence : bytes
+            the sequence, which may contain newlines
+
+        Returns
+        -------
+        bool
+            True if the record was written, False if it was already present
+        """
+        sequence = b''.join(sequence.split())
+
+        lines = [sequence[i:i+self.line_length] for i in range(0, len(sequence), self.line_length)]
+        header = b'>' + bytes(name, encoding='utf8') + b'\n'
+        record = header + b''.join(i + b'\n' for i in lines)
+
+        with self.lock:
+
+            if name in self.names:
+                return False
+
+            blocks = gpas_uploader.compress_bgzf(record, self.level)
+
+            # overwrite the EOF block, which is written again at the end
+            with open(self.filename, 'r+b') as f:
+                f.seek(self.compressed_offset)
+                compressed_offset, uncompressed_offset = self.compressed_offset, self.uncompressed_offset
+                new_blocks = []
+                for block, size in blocks:
+                    f.write(block)
+                    new_blocks.append((compressed_offset, uncompressed_offset))
+                    compressed_offset += len(block)
+                    uncompressed_offset += size
+                f.write(gpas_uploader.BGZF_EOF)
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.blocks += new_blocks
+            gpas_uploader.append_gzi(self.gzi, new_blocks)
+
+            # the .fai is written last as it records which samples are complete
+            with open(self.fai, 'a') as f:
+                f.write('%s\t%i\t%i\t%i\t%i\n' % (name, len(sequence), self.uncompressed_offset + len(header), self.line_length, self.line_length + 1))
+
+            self.names.add(name)
+            self.compressed_offset = compressed_offset
+            self.uncompressed_offset = uncompressed_offset
+
+        return True
+
+    def _resume(self):
+        """Private method that picks up where a previous writer left off.
+        """
+
+        # find the uncompressed offset where the last complete record ends
+        end = 0
+        records = []
+        with open(self.fai) as f:
+            for line in f:
+                cols = line.rstrip('\n').split('\t')
+                if not line.endswith('\n') or len(cols) != 5:
+                    break
+                records.append(line)
+                name, length, offset, line_bases, line_width = cols[0], int(cols[1]), int(cols[2]), int(cols[3]), int(cols[4])
+                self.names.add(name)
+                n_lines = -(-length // line_bases)
+                end = offset + length + n_lines * (line_width - line_bases)
+
+        # walk the blocks up to that point and drop any written afterwards
+        uncompressed_offset = 0
+        with open(self.filename, 'r+b') as f:
+            for compressed_offset, compressed_size, uncompressed_size in gpas_uploader.read_bgzf_blocks(f):
+                if uncompressed_offset >= end or uncompressed_size == 0:
+                    break
+                self.blocks.append((compressed_offset, uncompressed_offset))
+                uncompressed_offset += uncompressed_size
+                self.compressed_offset = compressed_offset + compressed_size
+
+            assert uncompressed_offset == end, str(self.filename) + ' does not match its .fai index'
+
+            f.seek(self.compressed_offset)
+            f.write(gpas_uploader.BGZF_EOF)
+            f.truncate()
+
+        self.uncompressed_offset = uncompressed_offset
+
+        # drop any partially written line
+        self.fai.write_text(''.join(records))
+
+        gpas_uploader.write_gzi(self.gzi, self.blocks)
@@ -1,6 +1,10 @@
 #! /usr/bin/env python3
 
+import re
+import base64
+import binascii
 import hashlib
+import importlib.util
 from pathlib import Path
 import requests
 
@@ -9,6 +13,13 @@ import numpy
 
 import gpas_uploader
 
+# the names of the decontaminated FASTQs in the bucket, after the sample's GPAS identifier
+UPLOAD_SUFFIXES = {'r_uri': '.reads.fastq.gz', 'r1_uri': '.reads_1.fastq.gz', 'r2_uri': '.reads_2.fastq.gz'}
+
+# the most HEAD requests to have in flight at once when looking for files already in the bucket
+PROBE_THREADS = 16
+
+
 def hash_paired_reads(row, wd):
     """Calculate the MD5 and SHA hashes for two FASTQ files containing paired reads.
 
@@ -65,10 +76,14 @@ def hash_fastq(filename):
     """
     md5 = hashlib.md5()
     sha = hashlib.sha256()
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5.update(chunk)
-            sha.update(chunk)
+    with gpas_uploader.span('hash', category='sample', file=str(filename)) as s:
+        size = 0
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(4096), b""):
+                md5.update(chunk)
+                sha.update(chunk)
+                size += len(chunk)
+        s.set(bytes=size)
     return md5.hexdigest(), sha.hexdigest()
 
 
@@ -110,8 +125,12 @@ def format_error(row):
         return row.column + ' cannot be empty'
     elif row.check == 'field_uniqueness':
         return row.column + ' must be unique in the upload CSV'
+    elif row.check == 'file_suffix':
+        suffixes = gpas_uploader.FILE_SUFFIXES[row.column]
+        return(row.column + ' must end in ' + ', '.join(suffixes[:-1]) + ' or ' + suffixes[-1])
     elif 'str_matches' in row.check:
-        allowed_chars = row.check.split('[')[1].split(']')[0]
+        # the characters between the first [ and the ]+ that closes it, which may itself contain [ and ]
+        allowed_chars = row.check.split('[', 1)[1].split(']+')[0].replace('\\', '')
         if row.schema_context == 'Column':
             return(row.column + ' can only contain characters (' + allowed_chars + ')')
         elif row.schema_context == 'Index':
@@ -196,6 +215,84 @@ def rename_paired_fastq(row):
 
     return pandas.Series([str(p1.parent / dest_file1), str(p2.parent / dest_file2),])
 
+def uploaded_object_matches(url, filename, md5):
+    """Check whether a file is already in the bucket, with a HEAD request for the object.
+
+    The object must be the same size as the file and, if the bucket gives its MD5
+    (as Content-MD5, opc-content-md5 or an ETag that is an MD5), have the same MD5.
+
+    Parameters
+    ----------
+    url : str
+        the object
+    filename : str
+        the local file
+    md5 : str
+        the MD5 of the local file
+
+    Returns
+    -------
+    bool
+        False if the object is not there, differs or could not be checked
+    """
+    try:
+        size = Path(filename).stat().st_size
+        r = requests.head(url, timeout=60)
+    except (OSError, requests.exceptions.RequestException):
+        return False
+
+    if not r.ok or r.headers.get('Content-Length') != str(size):
+        return False
+
+    remote = None
+    for i in ['Content-MD5', 'opc-content-md5']:
+        if i in r.headers:
+            try:
+                remote = base64.b64decode(r.headers[i]).hex()
+            except binascii.Error:
+                pass
+    etag = r.headers.get('ETag', '').strip('"')
+    if remote is None and re.fullmatch('[0-9a-f]{32}', etag):
+        remote = etag
+
+    return remote is None or remote == md5
+
+def upload_file(url, filename, md5, headers):
+    """Upload a file, checking that the bytes sent are those that were hashed.
+
+    The MD5 recorded when the file was hashed is sent as the Content-MD5, so the
+    bucket refuses the upload if the bytes it receives differ, and the bytes are
+    hashed as they are read, so a file that has changed on disk since is caught
+    without reading it again.
+
+    Parameters
+    ----------
+    url : str
+        where to PUT the file
+    filename : str
+    md5 : str
+        the MD5 of the file, as sent to GPAS when the sample was created
+    headers : dict
+
+    Returns
+    -------
+    requests.Response
+    bool
+        True if the bytes sent, and any MD5 the bucket returned, match md5
+    """
+    headers = dict(headers)
+    headers['Content-MD5'] = base64.b64encode(bytes.fromhex(md5)).decode()
+
+    with open(filename, 'rb') as INPUT:
+        body = gpas_uploader.HashingReader(INPUT)
+        r = requests.put(url, body, headers=headers)
+
+    matches = body.size == len(body) and body.hexdigest() == md5
+    if 'opc-content-md5' in r.headers:
+        matches = matches and r.headers['opc-content-md5'] == headers['Content-MD5']
+
+    return r, matches
+
 def upload_fastq_paired(row, url, headers):
     """Upload a pair of FASTQ files to the Organisation's input bucket in OCI.
 
@@ -203,13 +300,16 @@ def upload_fastq_paired(row, url, headers):
 
     Returns
     -------
-    True if upload successful (or previously done), False otherwise
+    True if upload successful (or previously done), False otherwise, including if
+    either file no longer matches its MD5
     """
 
     if not row.uploaded:
-        r1 = requests.put(url + row.name + '.reads_1.fastq.gz', open(row['r1_uri'], 'rb'), headers=headers)
-        r2 = requests.put(url+ row.name + '.reads_2.fastq.gz', open(row['r2_uri'], 'rb'), headers=headers)
-        return (r1.ok and r2.ok)
+        with gpas_uploader.span('upload', category='sample', sample=row.name, bytes=lambda: Path(row['r1_uri']).stat().st_size + Path(row['r2_uri']).stat().st_size) as s:
+            r1, md5_ok1 = upload_file(url + row.name + UPLOAD_SUFFIXES['r1_uri'], row['r1_uri'], row['r1_md5'], headers)
+            r2, md5_ok2 = upload_file(url + row.name + UPLOAD_SUFFIXES['r2_uri'], row['r2_uri'], row['r2_md5'], headers)
+            s.set(status_code=[r1.status_code, r2.status_code], md5_ok=[md5_ok1, md5_ok2])
+        return (r1.ok and r2.ok and md5_ok1 and md5_ok2)
     else:
         return True
 
@@ -220,12 +320,15 @@ def upload_fastq_unpaired(row, url, headers):
 
     Returns
     -------
-    True if upload successful (or previously done), False otherwise
+    True if upload successful (or previously done), False otherwise, including if
+    the file no longer matches its MD5
     """
 
     if not row.uploaded:
-        r = requests.put(url + row.name + '.reads.fastq.gz', open(row['r_uri'], 'rb'), headers=headers)
-        return r.ok
+        with gpas_uploader.span('upload', category='sample', sample=row.name, bytes=lambda: Path(row['r_uri']).stat().st_size) as s:
+            r, md5_ok = upload_file(url + row.name + UPLOAD_SUFFIXES['r_uri'], row['r_uri'], row['r_md5'], headers)
+            s.set(status_code=r.status_code, md5_ok=md5_ok)
+        return r.ok and md5_ok
     else:
         return True
 
@@ -243,15 +346,23 @@ def check_files_exist(row, file_extension, wd):
     wd: pathlib.Path
         the working directory
 
+    A FASTQ that is a pattern must match at least one file, and the files it matches
+    are checked together.
+
     Returns
     -------
     None or error message if file does not exist
     """
     if isinstance(row[file_extension], str):
-        if not (wd / row[file_extension]).is_file():
+        files = gpas_uploader.expand_fastq(row[file_extension], wd)
+        if len(files) == 0:
+            return(row[file_extension] + ' matches no files')
+        elif not all(i.is_file() for i in files):
             return(row[file_extension] + ' does not exist')
+        elif row[file_extension].endswith('.zst') and importlib.util.find_spec('zstandard') is None:
+            return(row[file_extension] + ' is zstd-compressed but zstandard is not installed')
         else:
-            if (wd / row[file_extension]).stat().st_size < 100:
+            if sum(i.stat().st_size for i in files) < 100:
                 return(row[file_extension] + ' is too small (< 100 bytes)')
             else:
                 return(None)
@@ -283,6 +394,115 @@ def check_files_exist_in_df(df, file_extension, wd):
         err.rename(columns={'name': 'sample_name'}, inplace=True)
         return(False, err)
 
+def digest_file(filename, limit=None):
+    """Return the MD5 of a file, or of just its first limit bytes.
+
+    Parameters
+    ----------
+    filename: pathlib.Path
+    limit: int
+        if given, only read this many bytes from the start of the file (default None)
+
+    Returns
+    -------
+    str
+    """
+    md5 = hashlib.md5()
+    remaining = limit
+    with open(filename, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(1024 * 1024 if remaining is None else min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            md5.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return md5.hexdigest()
+
+def check_files_not_duplicated_in_df(df, columns, wd, head=64 * 1024):
+    """Check that no two samples specify files with the same contents.
+
+    Copied or linked files would otherwise be decontaminated and uploaded twice
+    and would then be given the same GPAS identifier. So that this is cheap, the
+    samples are first grouped by the sizes of their files and only samples whose
+    sizes match another's are read. Files that are the same file (the same inode,
+    e.g. hard links or symlinks to it) need not be read at all; the others are
+    compared by the MD5 of their first head bytes and then of the whole file.
+    Samples whose files do not exist are ignored, as check_files_exist_in_df
+    reports them.
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        indexed by sample name
+    columns: list
+        the columns holding each sample's files, e.g. ['fastq1', 'fastq2']
+    wd: pathlib.Path
+        the working directory
+    head: int
+        the bytes at the start of each file to compare before reading the whole file (default 64 KB)
+
+    Returns
+    -------
+    bool
+        True if there are no duplicates
+    pandas.DataFrame
+        with sample_name and error_message for each sample that repeats an earlier one, or None
+    """
+    # group the samples by the sizes of their files
+    groups = {}
+    for idx, row in df.iterrows():
+        try:
+            stats = [j.stat() for i in columns for j in gpas_uploader.expand_fastq(row[i], wd)]
+        except (OSError, TypeError):
+            continue
+        if len(stats) == 0:
+            continue
+        groups.setdefault(tuple(i.st_size for i in stats), []).append((idx, row, tuple((i.st_dev, i.st_ino) for i in stats)))
+
+    def key(row, limit):
+        return tuple(digest_file(j, limit) for i in columns for j in gpas_uploader.expand_fastq(row[i], wd))
+
+    errors = []
+
+    for candidates in groups.values():
+
+        if len(candidates) < 2:
+            continue
+
+        # samples naming the very same files are duplicates without reading them
+        distinct = {}
+        for idx, row, inodes in candidates:
+            if inodes in distinct:
+                errors.append([idx, 'same files as sample ' + str(distinct[inodes][0])])
+            else:
+                distinct[inodes] = (idx, row)
+
+        if len(distinct) < 2:
+            continue
+
+        # only read the whole of the files whose first head bytes also match another's
+        heads = {}
+        for idx, row in distinct.values():
+            heads.setdefault(key(row, head), []).append((idx, row))
+
+        for matches in heads.values():
+
+            if len(matches) < 2:
+                continue
+
+            first = {}
+            for idx, row in matches:
+                contents = key(row, None)
+                if contents in first:
+                    errors.append([idx, 'same file contents as sample ' + str(first[contents])])
+                else:
+                    first[contents] = idx
+
+    if len(errors) == 0:
+        return(True, None)
+    return(False, pandas.DataFrame(errors, columns=['sample_name', 'error_message']))
+
 def check_tags_not_duplicated(row):
 
     tags_not_duplicated = True
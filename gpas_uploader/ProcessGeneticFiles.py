@@ -2,9 +2,15 @@
 
 import shutil
 import os
+import re
 import sys
+import gzip
+import math
+import tempfile
+import threading
 import subprocess
 import importlib.resources
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pandas
@@ -29,7 +35,7 @@ def locate_bam_binary():
         return str(Path(shutil.which('samtools')))
 
     else:
-        raise gpas_uploader.GpasError({"BAM conversion": "samtools not found"})
+        raise gpas_uploader.MissingToolError({"BAM conversion": "samtools not found"})
 
 def locate_riak_binary():
     """Locate ReadItAndKeep by searching the $PATH and in the current folder.
@@ -49,11 +55,44 @@ def locate_riak_binary():
         return str(Path(shutil.which('readItAndKeep')))
 
     else:
-        raise gpas_uploader.GpasError({"decontamination": "read removal tool not found"})
+        raise gpas_uploader.MissingToolError({"decontamination": "read removal tool not found"})
 
+def locate_reference_genome(reference_genome=None):
+    """Return the reference genome to pass to ReadItAndKeep.
 
-def convert_bam_paired_reads(row, wd):
-    """Convert a BAM file into a pair of FASTQ files.
+    Parameters
+    ----------
+    reference_genome : str
+        if given, use this FASTA file rather than the bundled SARS-CoV-2 reference
+
+    Returns
+    -------
+    str
+        path to the reference FASTA file
+    """
+    if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
+        return 'MN908947_no_polyA.fasta'
+    elif reference_genome is None:
+        with importlib.resources.path("gpas_uploader", 'MN908947_no_polyA.fasta') as path:
+            return str(path)
+    else:
+        return reference_genome
+
+
+def cram_reference_args(filename, cram_reference=None):
+    """Return the arguments telling samtools the reference a CRAM was compressed against.
+
+    Returns
+    -------
+    list
+        empty for a BAM, or if no reference is given
+    """
+    if cram_reference is None or not str(filename).endswith('.cram'):
+        return []
+    return ['--reference', str(cram_reference)]
+
+def convert_bam_paired_reads(row, wd, outdir=None, watchdog=None, cram_reference=None):
+    """Convert a BAM (or CRAM) file into a pair of FASTQ files.
 
     Designed to be used with pandas.DataFrame.apply
 
@@ -63,6 +102,12 @@ def convert_bam_paired_reads(row, wd):
         row from pandas.DataFrame
     wd : pathlib.Path
         working directory
+    outdir : pathlib.Path
+        where to write the FASTQ files, named after the sample (default None, next to the BAM)
+    watchdog : gpas_uploader.Watchdog
+        runs samtools, killing it if it hangs (default None, wait for as long as it takes)
+    cram_reference : str
+        the FASTA file a CRAM was compressed against (default None, samtools finds it from the CRAM's header)
 
     Returns
     -------
@@ -73,43 +118,60 @@ def convert_bam_paired_reads(row, wd):
     # locate the samtools binary
     samtools = locate_bam_binary()
 
-    stem = row['bam'].split('.bam')[0]
-
-    process1 = subprocess.Popen(
-        [
-            samtools,
-            'sort',
-            '-n',
-            wd / Path(row['bam'])
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    process2 = subprocess.run(
-        [
-            samtools,
-            'fastq',
-            '-N',
-            '-1',
-            wd / Path(stem + "_1.fastq.gz"),
-            '-2',
-            wd / Path(stem+"_2.fastq.gz"),
-        ],
-        stdin = process1.stdout,
-        stdout = subprocess.DEVNULL,
-        stderr = subprocess.DEVNULL
-    )
-
-    # to stop a race condition
-    process1.wait()
+    if outdir is None:
+        stem = re.sub(r'\.(bam|cram)$', '', row['bam'])
+    else:
+        stem = str(Path(outdir) / row.name)
+
+    reference = cram_reference_args(row['bam'], cram_reference)
+
+    if watchdog is None:
+        watchdog = gpas_uploader.Watchdog()
+
+    def start():
+        process1 = subprocess.Popen(
+            [
+                samtools,
+                'sort',
+                '-n',
+                *reference,
+                wd / Path(row['bam'])
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        process2 = subprocess.Popen(
+            [
+                samtools,
+                'fastq',
+                '-N',
+                '-1',
+                wd / Path(stem + "_1.fastq.gz"),
+                '-2',
+                wd / Path(stem+"_2.fastq.gz"),
+            ],
+            stdin = process1.stdout,
+            stdout = subprocess.DEVNULL,
+            stderr = subprocess.DEVNULL
+        )
+        # so that samtools sort is not left writing to a pipe no one is reading
+        process1.stdout.close()
+        return [process1, process2]
+
+    with gpas_uploader.span('samtools', category='sample', sample=row.name, bytes=lambda: (wd / Path(row['bam'])).stat().st_size) as s:
+
+        (sort_returncode, returncode), stdout, attempts = watchdog.run(start, [wd / Path(stem + "_1.fastq.gz"), wd / Path(stem + "_2.fastq.gz")], 'samtools', row.name)
+
+        s.set(returncode=returncode, sort_returncode=sort_returncode, attempts=attempts)
 
     # insist that the above command did not fail
-    assert process2.returncode == 0, 'samtools command failed'
+    if returncode != 0:
+        raise gpas_uploader.GpasError({"BAM conversion": "samtools failed to convert %s" % row['bam']})
 
     return(pandas.Series([stem + "_1.fastq.gz", stem + "_2.fastq.gz"]))
 
-def convert_bam_unpaired_reads(row, wd):
-    """Convert a BAM file into a single unpaired FASTQ file.
+def convert_bam_unpaired_reads(row, wd, outdir=None, watchdog=None, cram_reference=None):
+    """Convert a BAM (or CRAM) file into a single unpaired FASTQ file.
 
     Designed to be used with pandas.DataFrame.apply
 
@@ -119,6 +181,12 @@ def convert_bam_unpaired_reads(row, wd):
         row from pandas.DataFrame
     wd : pathlib.Path
         working directory
+    outdir : pathlib.Path
+        where to write the FASTQ file, named after the sample (default None, next to the BAM)
+    watchdog : gpas_uploader.Watchdog
+        runs samtools, killing it if it hangs (default None, wait for as long as it takes)
+    cram_reference : str
+        the FASTA file a CRAM was compressed against (default None, samtools finds it from the CRAM's header)
 
     Returns
     -------
@@ -127,30 +195,45 @@ def convert_bam_unpaired_reads(row, wd):
     """
     samtools = locate_bam_binary()
 
-    stem = row['bam'].split('.bam')[0]
+    if outdir is None:
+        stem = re.sub(r'\.(bam|cram)$', '', row['bam'])
+    else:
+        stem = str(Path(outdir) / row.name)
+
+    reference = cram_reference_args(row['bam'], cram_reference)
+
+    if watchdog is None:
+        watchdog = gpas_uploader.Watchdog()
+
+    def start():
+        return [subprocess.Popen(
+            [
+                samtools,
+                'fastq',
+                *reference,
+                '-0',
+                wd / Path(stem + '.fastq.gz'),
+                wd / Path(row['bam'])
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )]
+
+    with gpas_uploader.span('samtools', category='sample', sample=row.name, bytes=lambda: (wd / Path(row['bam'])).stat().st_size) as s:
 
-    process = subprocess.Popen(
-        [
-            samtools,
-            'fastq',
-            '-0',
-            wd / Path(stem + '.fastq.gz'),
-            wd / Path(row['bam'])
-        ],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
+        # wait for it to finish otherwise the file will not be present
+        (returncode,), stdout, attempts = watchdog.run(start, [wd / Path(stem + '.fastq.gz')], 'samtools', row.name)
 
-    # wait for it to finish otherwise the file will not be present
-    process.wait()
+        s.set(returncode=returncode, attempts=attempts)
 
     # successful completion
-    assert process.returncode == 0, 'samtools command failed'
+    if returncode != 0:
+        raise gpas_uploader.GpasError({"BAM conversion": "samtools failed to convert %s" % row['bam']})
 
     # now that we have a FASTQ, add it to the dict
     return(stem + '.fastq.gz')
 
-def remove_pii_unpaired_reads(row, reference_genome, wd, outdir, output_json):
+def remove_pii_unpaired_reads(row, reference_genome, wd, outdir, output_json, watchdog=None):
     """Remove personally identifiable reads from an unpaired FASTQ file using ReadItAndKeep.
 
     Designed to be used with pandas.DataFrame.apply
@@ -163,6 +246,8 @@ def remove_pii_unpaired_reads(row, reference_genome, wd, outdir, output_json):
         working directory
     outdir : pathlib.Path
         output directory
+    watchdog : gpas_uploader.Watchdog
+        runs ReadItAndKeep, killing it if it hangs (default None, wait for as long as it takes)
 
     Returns
     -------
@@ -175,14 +260,10 @@ def remove_pii_unpaired_reads(row, reference_genome, wd, outdir, output_json):
 
     riak = locate_riak_binary()
 
-    if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
-        ref_genome = 'MN908947_no_polyA.fasta'
-    else:
-        if reference_genome is None:
-            with importlib.resources.path("gpas_uploader", 'MN908947_no_polyA.fasta') as path:
-                ref_genome = str(path)
-        else:
-            ref_genome = reference_genome
+    ref_genome = locate_reference_genome(reference_genome)
+
+    # the FASTQ may be a pattern matching several files, which are read as one
+    reads = gpas_uploader.FastqStream(gpas_uploader.expand_fastq(row.fastq, wd))
 
     riak_command = [
         riak,
@@ -192,24 +273,36 @@ def remove_pii_unpaired_reads(row, reference_genome, wd, outdir, output_json):
         "--ref_fasta",
         ref_genome,
         "--reads1",
-        wd / Path(row.fastq),
+        reads.path,
         "--outprefix",
         str(outdir / row.name),
     ]
 
-    process = subprocess.Popen(
-                riak_command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
+    fq = outdir / f"{row.name}.reads.fastq.gz"
 
-    # wait for it to finish otherwise the file will not be present
-    process.wait()
+    if watchdog is None:
+        watchdog = gpas_uploader.Watchdog()
 
-    # successful completion
-    assert process.returncode == 0, 'riak command failed'
+    def start():
+        reads.start()
+        return [subprocess.Popen(
+                    riak_command,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )]
 
-    fq = outdir / f"{row.name}.reads.fastq.gz"
+    with reads, gpas_uploader.span('readItAndKeep', category='sample', sample=row.name, bytes=reads.bytes) as s:
+
+        # wait for it to finish otherwise the file will not be present
+        (returncode,), stdout, attempts = watchdog.run(start, [fq], 'readItAndKeep', row.name)
+
+        s.set(returncode=returncode, attempts=attempts)
+
+        reads.check()
+
+    # successful completion
+    if returncode != 0:
+        raise gpas_uploader.GpasError({"decontamination": "read removal tool failed on %s" % row.fastq})
 
     # PWF Sprint 11 hack to push JSON decontamination block later to help EC
     # if output_json:
@@ -217,7 +310,7 @@ def remove_pii_unpaired_reads(row, reference_genome, wd, outdir, output_json):
 
     return(str(fq))
 
-def remove_pii_paired_reads(row, reference_genome, wd, outdir, output_json):
+def remove_pii_paired_reads(row, reference_genome, wd, outdir, output_json, watchdog=None):
     """Remove personally identifiable reads from a pair of FASTQ files using ReadItAndKeep.
 
     Designed to be used with pandas.DataFrame.apply
@@ -230,6 +323,8 @@ def remove_pii_paired_reads(row, reference_genome, wd, outdir, output_json):
         working directory
     outdir : pathlib.Path
         output directory
+    watchdog : gpas_uploader.Watchdog
+        runs ReadItAndKeep, killing it if it hangs (default None, wait for as long as it takes)
 
     Returns
     -------
@@ -243,14 +338,11 @@ def remove_pii_paired_reads(row, reference_genome, wd, outdir, output_json):
 
     riak = locate_riak_binary()
 
-    if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
-        ref_genome = 'MN908947_no_polyA.fasta'
-    else:
-        if reference_genome is None:
-            with importlib.resources.path("gpas_uploader", 'MN908947_no_polyA.fasta') as path:
-                ref_genome = str(path)
-        else:
-            ref_genome = reference_genome
+    ref_genome = locate_reference_genome(reference_genome)
+
+    # either FASTQ may be a pattern matching several files, e.g. one per lane, which are read as one
+    reads1 = gpas_uploader.FastqStream(gpas_uploader.expand_fastq(row.fastq1, wd))
+    reads2 = gpas_uploader.FastqStream(gpas_uploader.expand_fastq(row.fastq2, wd))
 
     riak_command = [
         riak,
@@ -260,27 +352,41 @@ def remove_pii_paired_reads(row, reference_genome, wd, outdir, output_json):
         "--ref_fasta",
         ref_genome,
         "--reads1",
-        wd / Path(row.fastq1),
+        reads1.path,
         "--reads2",
-        wd / Path(row.fastq2),
+        reads2.path,
         "--outprefix",
         outdir / Path(row.name),
     ]
 
-    process = subprocess.Popen(
-                riak_command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
+    fq1 = outdir / f"{row.name}.reads_1.fastq.gz"
+    fq2 = outdir / f"{row.name}.reads_2.fastq.gz"
+
+    if watchdog is None:
+        watchdog = gpas_uploader.Watchdog()
 
-    # wait for it to finish otherwise the file will not be present
-    process.wait()
+    def start():
+        reads1.start()
+        reads2.start()
+        return [subprocess.Popen(
+                    riak_command,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )]
 
-    # successful completion
-    assert process.returncode == 0, 'riak command failed'
+    with reads1, reads2, gpas_uploader.span('readItAndKeep', category='sample', sample=row.name, bytes=lambda: reads1.bytes() + reads2.bytes()) as s:
 
-    fq1 = outdir / f"{row.name}.reads_1.fastq.gz"
-    fq2 = outdir / f"{row.name}.reads_2.fastq.gz"
+        # wait for it to finish otherwise the files will not be present
+        (returncode,), stdout, attempts = watchdog.run(start, [fq1, fq2], 'readItAndKeep', row.name)
+
+        s.set(returncode=returncode, attempts=attempts)
+
+        reads1.check()
+        reads2.check()
+
+    # successful completion
+    if returncode != 0:
+        raise gpas_uploader.GpasError({"decontamination": "read removal tool failed on %s and %s" % (row.fastq1, row.fastq2)})
 
     # PWF Sprint 11 hack to push JSON decontamination block later to help EC
     # if output_json:
@@ -288,3 +394,366 @@ def remove_pii_paired_reads(row, reference_genome, wd, outdir, output_json):
     #     gpas_uploader.dmsg(row.name, "completed", msg={"file": str(row.fastq2), 'cleaned': str(fq2)}, json=True)
 
     return(pandas.Series([str(fq1), str(fq2)]))
+
+def chunk_workers(size, chunk_size, max_workers):
+    """Return how many chunks of a FASTQ to decontaminate at once.
+
+    Parameters
+    ----------
+    size : int
+        the size of the FASTQ file in bytes
+    chunk_size : int
+        the size of each chunk in bytes of the (compressed) FASTQ file
+    max_workers : int
+        the most chunks to run at once, e.g. the number of CPUs
+
+    Returns
+    -------
+    int
+    """
+    return max(1, min(math.ceil(size / chunk_size), int(max_workers)))
+
+def _read_blocks(files, block_size):
+    """Yield the contents of one or more FASTQ files, compressed or not, a block at a time.
+
+    Each block comes with how many bytes of the files have been read so far, and
+    the last block is empty.
+    """
+    done = 0
+    for filename in files:
+        with open(filename, 'rb') as raw:
+
+            reader = gpas_uploader.open_fastq(raw)
+
+            while True:
+                block = reader.read(block_size)
+                if not block:
+                    break
+                yield block, done + raw.tell()
+
+            done += raw.tell()
+
+    yield b'', done
+
+def split_fastq(filename, chunk_size, outdir, stem, block_size=4 * 1024 * 1024):
+    """Split a FASTQ file into gzipped chunks of whole reads.
+
+    The reads are renamed 1,2,3.. across all the chunks, so that the chunks can be
+    decontaminated separately without the read names clashing once they are joined
+    back together. The chunks are compressed at level 1 as they only live until
+    they have been decontaminated.
+
+    Parameters
+    ----------
+    filename : pathlib.Path or list
+        the FASTQ file, gzipped, zstd-compressed or not, or several to be split as if they were one
+    chunk_size : int
+        start a new chunk each time this many bytes of the file have been read
+    outdir : pathlib.Path
+        where to write the chunks
+    stem : str
+        the chunks are named <stem>.<n>.fastq.gz
+    block_size : int
+        bytes of FASTQ to process at a time; chunks can be no smaller than this (default 4 MB)
+
+    Returns
+    -------
+    generator
+        of (pathlib.Path, int) tuples, the chunk and the number of reads it holds,
+        each yielded as soon as the chunk is complete
+    """
+    files = [filename] if isinstance(filename, (str, Path)) else list(filename)
+
+    boundary = chunk_size
+    total_reads = 0
+    chunk = None
+    pending = b''
+
+    for block, position in _read_blocks(files, block_size):
+
+        lines = (pending + block).split(b'\n')
+
+        if block:
+            # the last few lines may belong to a read that is not yet complete
+            complete = (len(lines) - 1) // 4 * 4
+        else:
+            if lines[-1] == b'':
+                lines.pop()
+            if len(lines) % 4 != 0:
+                raise gpas_uploader.GpasError({"decontamination": "%s is truncated or not a FASTQ file" % filename})
+            complete = len(lines)
+
+        pending = b'\n'.join(lines[complete:])
+
+        if complete > 0:
+
+            if not all(i.startswith(b'@') for i in lines[0:complete:4]):
+                raise gpas_uploader.GpasError({"decontamination": "%s is not a FASTQ file" % filename})
+
+            reads = complete // 4
+            lines[0:complete:4] = [b'@%i' % i for i in range(total_reads + 1, total_reads + reads + 1)]
+            lines[2:complete:4] = [b'+'] * reads
+            total_reads += reads
+
+            if chunk is None:
+                chunk = {'path': Path(outdir) / ('%s.%i.fastq.gz' % (stem, boundary // chunk_size)), 'reads': 0}
+                chunk['file'] = gzip.open(chunk['path'], 'wb', compresslevel=1)
+
+            chunk['file'].write(b'\n'.join(lines[:complete]) + b'\n')
+            chunk['reads'] += reads
+
+        if chunk is not None and (not block or position >= boundary):
+            chunk['file'].close()
+            yield chunk['path'], chunk['reads']
+            chunk = None
+            while position >= boundary:
+                boundary += chunk_size
+
+def count_fastq(filename, block_size=4 * 1024 * 1024):
+    """Read a FASTQ file once, checking it is intact and counting its reads and bases.
+
+    A gzipped file is decompressed as it is read, so the CRC and length in the trailer
+    of each gzip member are checked, and a file that stops part way through a member
+    (or zstd frame) or a read is refused. Every read must have a name starting with @, a + line and
+    as many quality scores as bases. Reading stops at the first problem found.
+
+    Parameters
+    ----------
+    filename : pathlib.Path
+        the FASTQ file, gzipped, zstd-compressed or not
+    block_size : int
+        bytes of FASTQ to process at a time (default 4 MB)
+
+    Returns
+    -------
+    int
+        the number of reads
+    int
+        the number of bases
+    """
+    total_reads, total_bases = 0, 0
+
+    with open(filename, 'rb') as raw:
+
+        reader = gpas_uploader.open_fastq(raw)
+
+        pending = b''
+
+        while True:
+
+            try:
+                block = reader.read(block_size)
+            except Exception as err:
+                # gzip, zlib and zstd each raise their own errors on a corrupt file
+                raise gpas_uploader.GpasError({"validation": "%s is corrupt (%s)" % (filename, err)})
+
+            lines = (pending + block).split(b'\n')
+
+            if block:
+                # the last few lines may belong to a read that is not yet complete
+                complete = (len(lines) - 1) // 4 * 4
+            else:
+                if lines[-1] == b'':
+                    lines.pop()
+                if len(lines) % 4 != 0:
+                    raise gpas_uploader.GpasError({"validation": "%s is truncated or not a FASTQ file" % filename})
+                complete = len(lines)
+
+            pending = b'\n'.join(lines[complete:])
+
+            if complete > 0:
+
+                if not all(i.startswith(b'@') for i in lines[0:complete:4]) or not all(i.startswith(b'+') for i in lines[2:complete:4]):
+                    raise gpas_uploader.GpasError({"validation": "%s is not a FASTQ file" % filename})
+
+                bases = list(map(len, lines[1:complete:4]))
+                if bases != list(map(len, lines[3:complete:4])):
+                    raise gpas_uploader.GpasError({"validation": "%s has reads whose sequence and quality scores differ in length" % filename})
+
+                total_reads += complete // 4
+                total_bases += sum(bases)
+
+            if not block:
+                return total_reads, total_bases
+
+def count_fastq_files(files):
+    """Return the reads and bases in all of the FASTQ files of a sample, see count_fastq.
+    """
+    counts = [count_fastq(i) for i in files]
+    return sum(i[0] for i in counts), sum(i[1] for i in counts)
+
+def check_unpaired_fastq(row, wd):
+    """Check the FASTQ file of a sample is intact, counting its reads and bases.
+
+    Designed to be used with pandas.DataFrame.apply
+
+    Parameters
+    ----------
+    row : pandas.Series
+    wd : pathlib.Path
+        the working directory
+
+    Returns
+    -------
+    pandas.Series
+        the number of reads and bases
+    """
+    return pandas.Series(count_fastq_files(gpas_uploader.expand_fastq(row.fastq, wd)))
+
+def check_paired_fastq(row, wd):
+    """Check the pair of FASTQ files of a sample are intact and hold the same number of reads.
+
+    Designed to be used with pandas.DataFrame.apply
+
+    Parameters
+    ----------
+    row : pandas.Series
+    wd : pathlib.Path
+        the working directory
+
+    Returns
+    -------
+    pandas.Series
+        the number of pairs of reads and the bases in both files
+    """
+    reads1, bases1 = count_fastq_files(gpas_uploader.expand_fastq(row.fastq1, wd))
+    reads2, bases2 = count_fastq_files(gpas_uploader.expand_fastq(row.fastq2, wd))
+
+    if reads1 != reads2:
+        raise gpas_uploader.GpasError({"validation": "%s has %i reads but %s has %i" % (row.fastq1, reads1, row.fastq2, reads2)})
+
+    return pandas.Series([reads1, bases1 + bases2])
+
+def _decontaminate_chunk(riak, ref_genome, chunk, reads, sample, index, watchdog):
+    """Run ReadItAndKeep on one chunk of a FASTQ file, deleting the chunk afterwards.
+
+    Returns
+    -------
+    pathlib.Path
+        the decontaminated chunk
+    int
+        the number of reads kept
+    """
+    prefix = str(chunk).split('.fastq.gz')[0] + '.riak'
+
+    def start():
+        return [subprocess.Popen(
+                    [riak, "--tech", "ont", "--ref_fasta", ref_genome, "--reads1", chunk, "--outprefix", prefix],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )]
+
+    with gpas_uploader.span('readItAndKeep_chunk', category='sample', sample=sample, chunk=index, reads=reads, bytes=lambda: chunk.stat().st_size) as s:
+
+        (returncode,), stdout, attempts = watchdog.run(start, [prefix + '.reads.fastq.gz'], 'readItAndKeep', sample)
+
+        s.set(returncode=returncode, attempts=attempts)
+
+    chunk.unlink()
+
+    if returncode != 0:
+        raise gpas_uploader.GpasError({"decontamination": "read removal tool failed on chunk %i of %s" % (index, sample)})
+
+    # every read in the chunk must have been seen, as ReadItAndKeep reports
+    seen = re.search(rb'Input reads file 1\s+(\d+)', stdout)
+    if seen is None:
+        raise gpas_uploader.GpasError({"decontamination": "could not find how many reads ReadItAndKeep read from chunk %i of %s" % (index, sample)})
+    if int(seen.group(1)) != reads:
+        raise gpas_uploader.GpasError({"decontamination": "ReadItAndKeep read %s reads from chunk %i of %s, not %i" % (seen.group(1).decode(), index, sample, reads)})
+
+    kept = re.search(rb'Kept reads 1\s+(\d+)', stdout)
+
+    return Path(prefix + '.reads.fastq.gz'), int(kept.group(1)) if kept is not None else None
+
+def remove_pii_unpaired_reads_chunked(row, reference_genome, wd, outdir, output_json, chunk_size, max_workers, watchdog=None):
+    """Remove personally identifiable reads from a large unpaired FASTQ file, a chunk at a time.
+
+    The FASTQ is split into chunks of whole reads which are decontaminated by
+    ReadItAndKeep in parallel as they are written, and the outputs are then
+    concatenated (gzip members can simply be joined) into the single FASTQ that
+    remove_pii_unpaired_reads would have produced. The reads are numbered across the
+    whole file rather than by --enumerate_names, so the names are unique as before,
+    and the reads each chunk holds are checked against those ReadItAndKeep reports
+    reading. Files no larger than chunk_size are passed to remove_pii_unpaired_reads.
+
+    Designed to be used with pandas.DataFrame.apply
+
+    Parameters
+    ----------
+    row : pandas.Series
+        row from pandas.DataFrame
+    wd : pathlib.Path
+        working directory
+    outdir : pathlib.Path
+        output directory
+    chunk_size : int
+        the size of each chunk in bytes of the FASTQ file
+    max_workers : int
+        the most chunks to decontaminate at once, see chunk_workers
+    watchdog : gpas_uploader.Watchdog
+        runs each copy of ReadItAndKeep, killing it if it hangs (default None, wait for as long as it takes)
+
+    Returns
+    -------
+    str
+        path to the decontaminated FASTQ file
+    """
+    fastq = gpas_uploader.expand_fastq(row.fastq, wd)
+    size = sum(i.stat().st_size for i in fastq)
+
+    if size <= chunk_size:
+        return remove_pii_unpaired_reads(row, reference_genome, wd, outdir, output_json, watchdog)
+
+    riak = locate_riak_binary()
+    ref_genome = locate_reference_genome(reference_genome)
+
+    if watchdog is None:
+        watchdog = gpas_uploader.Watchdog()
+
+    workers = chunk_workers(size, chunk_size, max_workers)
+
+    # do not let the splitting get more than a couple of chunks per worker ahead
+    slots = threading.Semaphore(2 * workers)
+
+    def decontaminate(chunk, reads, index):
+        try:
+            return _decontaminate_chunk(riak, ref_genome, chunk, reads, row.name, index, watchdog)
+        finally:
+            slots.release()
+
+    chunkdir = Path(tempfile.mkdtemp(prefix=str(row.name) + '.chunks.', dir=outdir))
+
+    try:
+        with gpas_uploader.span('readItAndKeep', category='sample', sample=row.name, bytes=size, workers=workers) as s:
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+
+                futures = []
+                reads = 0
+                chunks = split_fastq(fastq, chunk_size, chunkdir, row.name)
+
+                while True:
+                    slots.acquire()
+                    try:
+                        chunk, chunk_reads = next(chunks)
+                    except StopIteration:
+                        break
+                    futures.append(pool.submit(decontaminate, chunk, chunk_reads, len(futures)))
+                    reads += chunk_reads
+
+                outputs = [i.result() for i in futures]
+
+            fq = outdir / f"{row.name}.reads.fastq.gz"
+
+            with open(fq, 'wb') as OUTPUT:
+                for output, kept in outputs:
+                    with open(output, 'rb') as INPUT:
+                        shutil.copyfileobj(INPUT, OUTPUT, 1024 * 1024)
+
+            kept = [i[1] for i in outputs]
+            s.set(chunks=len(outputs), reads=reads, kept=sum(kept) if None not in kept else None)
+
+    finally:
+        shutil.rmtree(chunkdir, ignore_errors=True)
+
+    return(str(fq))
@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import tracemalloc
+
+import gpas_uploader
+
+
+class CpuProfiler:
+    """
+    Profile a run with cProfile, saving the statistics and summarising the most expensive functions.
+
+    A cProfile.Profile only sees the thread that enabled it, so every thread
+    started while profiling, e.g. the workers of a parallel run, is given a profile of its
+    own, and these are merged with that of the main thread when profiling stops.
+    Threads that were already running when profiling started are not profiled.
+    The saved file can be loaded with pstats or a viewer such as snakeviz.
+
+    Parameters
+    ----------
+    filename : filename
+        where to dump the pstats statistics
+    top : int
+        the number of functions to include in the summary (default 25)
+    sort : str
+        the pstats key to sort the summary by (default cumulative)
+    """
+
+    def __init__(self, filename, top=25, sort='cumulative'):
+
+        self.filename = str(filename)
+        self.top = top
+        self.sort = sort
+        self.profile = cProfile.Profile()
+        self.thread_profiles = []
+        self.running = False
+
+    def start(self):
+        threading.setprofile(self._profile_thread)
+        self.profile.enable()
+        self.running = True
+
+    def _profile_thread(self, frame, event, arg):
+        """Private method, called in each new thread, that replaces itself with a profile for that thread.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # from Python 3.12 a single profile already sees every thread
+            sys.setprofile(None)
+            return
+        self.thread_profiles.append(profile)
+
+    def stop(self, stream=sys.stderr):
+        """Stop profiling, save the statistics and write the summary to stream.
+
+        Returns
+        -------
+        str
+            the summary
+        """
+        if not self.running:
+            return ''
+        self.profile.disable()
+        threading.setprofile(None)
+        self.running = False
+
+        summary = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=summary)
+        for i in self.thread_profiles:
+            stats.add(i)
+
+        stats.dump_stats(self.filename)
+        stats.sort_stats(self.sort).print_stats(self.top)
+
+        if stream is not None:
+            stream.write(summary.getvalue())
+
+        return summary.getvalue()
+
+
+def _reset_peak():
+    """Reset the peak memory traced by tracemalloc, where this Python (3.9 or later) can.
+    """
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+class MemoryProfiler:
+    """
+    Record the peak memory allocated by Python during each UploadBatch and DownloadBatch stage.
+
+    Uses tracemalloc and is called at the start and end of every stage span
+    (see gpas_uploader.span). Nested stages are allowed: the peak of an inner
+    stage also counts towards the stage that encloses it. At the end of each
+    stage a snapshot is compared with the one taken at its start so the lines
+    responsible for the largest increases can be reported. The peak is also
+    added to the span, so appears in any --trace file. Python 3.7 and 3.8 cannot
+    reset the peak, so there a stage's peak is the highest since profiling started.
+
+    Parameters
+    ----------
+    top : int
+        the number of lines with the largest growth to keep for each stage (default 5)
+
+    Example
+    -------
+    >>> a = MemoryProfiler()
+    >>> a.start()
+    >>> with gpas_uploader.span('validate'):
+    ...     pass
+    >>> a.stop()
+    >>> a.stages[0]['stage']
+    'validate'
+    """
+
+    def __init__(self, top=5):
+
+        self.top = top
+        self.stages = []
+        self.stack = []
+        self.started_tracemalloc = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        gpas_uploader.add_span_listener(self)
+
+    def stop(self):
+        gpas_uploader.remove_span_listener(self)
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def start_span(self, span):
+
+        if span.category != 'stage':
+            return
+
+        current, peak = tracemalloc.get_traced_memory()
+
+        # fold the peak so far into the enclosing stage before it is reset
+        if self.stack:
+            self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+
+        _reset_peak()
+        self.stack.append({'start': current, 'peak': current, 'snapshot': tracemalloc.take_snapshot()})
+
+    def end_span(self, span):
+
+        if span.category != 'stage' or not self.stack:
+            return
+
+        current, peak = tracemalloc.get_traced_memory()
+        stage = self.stack.pop()
+        peak = max(stage['peak'], peak)
+
+        if self.stack:
+            self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+        _reset_peak()
+
+        growth = tracemalloc.take_snapshot().compare_to(stage['snapshot'], 'lineno')[:self.top]
+
+        self.stages.append({'stage': span.name,
+                            'seconds': round(span.duration, 3),
+                            'start_bytes': stage['start'],
+                            'end_bytes': current,
+                            'peak_bytes': peak,
+                            'top_growth': [str(i) for i in growth]})
+
+        span.set(peak_memory=peak)
+
+    def report(self, stream=sys.stderr):
+        """Write a summary of the peak memory of each stage to stream.
+
+        Returns
+        -------
+        str
+            the summary
+        """
+        summary = io.StringIO()
+        summary.write('%-25s %10s %12s %12s\n' % ('stage', 'seconds', 'peak (MB)', 'end (MB)'))
+        for i in self.stages:
+            summary.write('%-25s %10.3f %12.1f %12.1f\n' % (i['stage'], i['seconds'], i['peak_bytes'] / 1e6, i['end_bytes'] / 1e6))
+            for j in i['top_growth']:
+                summary.write('    ' + j + '\n')
+
+        if stream is not None:
+            stream.write(summary.getvalue())
+
+        return summary.getvalue()
+
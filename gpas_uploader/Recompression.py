@@ -0,0 +1,270 @@
+#! /usr/bin/env python3
+
+import hashlib
+import os
+import time
+import zlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas
+
+import gpas_uploader
+
+
+# what to do with the decontaminated FASTQs before they are uploaded
+COMPRESSION_POLICIES = ['keep', 'bgzf', 'auto']
+
+# how much of a FASTQ to read when deciding whether recompressing it will pay off
+COMPRESSION_SAMPLE_BYTES = 4 * 1024 * 1024
+
+
+class _DigestReader:
+    """Private file object that passes on the reads of another, adding every byte read to a digest.
+
+    A byte is only added the first time it is read, so open_fastq can seek back
+    after peeking at the start of the file.
+    """
+
+    def __init__(self, raw, digest):
+        self.raw = raw
+        self.digest = digest
+        self.digested = 0
+
+    def read(self, size=-1):
+        start = self.raw.tell()
+        data = self.raw.read(size)
+        if start + len(data) > self.digested:
+            self.digest.update(data[self.digested - start:])
+            self.digested = start + len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.raw.seek(offset, whence)
+
+    def tell(self):
+        return self.raw.tell()
+
+
+def recompress_bgzf(filename, level=9, threads=1, digest=None):
+    """Recompress a FASTQ in place as BGZF, i.e. as independent gzip blocks that are
+    compressed on several threads at once.
+
+    The new file is written alongside and only replaces the original, keeping its
+    name, if it is smaller, so the FASTQ is never left half written. BGZF is gzip
+    so it can be read by anything that reads gzipped FASTQs.
+
+    Parameters
+    ----------
+    filename : pathlib.Path
+        the FASTQ, gzipped, zstd-compressed or not
+    level : int
+        the zlib compression level (default 9)
+    threads : int
+        the number of blocks to compress at once (default 1)
+    digest : hashlib hash
+        if given, updated with the bytes of the original file as it is read (default None)
+
+    Returns
+    -------
+    tuple
+        (bytes before, bytes after), which are the same if the original was kept
+    """
+    filename = Path(filename)
+    temp = filename.with_name(filename.name + '.bgzf')
+
+    bytes_before = filename.stat().st_size
+
+    # enough blocks to keep every thread busy while the next batch is decompressed
+    batch = gpas_uploader.BGZF_BLOCK_SIZE * 4 * threads
+
+    try:
+        with open(filename, 'rb') as raw, open(temp, 'wb') as OUTPUT, ThreadPoolExecutor(max_workers=threads) as pool:
+            if digest is not None:
+                raw = _DigestReader(raw, digest)
+            reads = gpas_uploader.open_fastq(raw)
+            previous = []
+            while True:
+                data = reads.read(batch)
+                current = [pool.submit(gpas_uploader.compress_bgzf_block, data[i:i + gpas_uploader.BGZF_BLOCK_SIZE], level) for i in range(0, len(data), gpas_uploader.BGZF_BLOCK_SIZE)]
+                for i in previous:
+                    OUTPUT.write(i.result())
+                previous = current
+                if not data:
+                    break
+            OUTPUT.write(gpas_uploader.BGZF_EOF)
+
+            # include anything after the last gzip member in the digest
+            if digest is not None:
+                while raw.read(1024 * 1024):
+                    pass
+
+        bytes_after = temp.stat().st_size
+        if bytes_after < bytes_before:
+            os.replace(temp, filename)
+            return bytes_before, bytes_after
+        return bytes_before, bytes_before
+
+    finally:
+        if temp.exists():
+            temp.unlink()
+
+
+def measure_compression(filename, level=9, sample_bytes=COMPRESSION_SAMPLE_BYTES):
+    """Measure how well, and how fast, the start of a FASTQ is compressed now and would be as BGZF.
+
+    Parameters
+    ----------
+    filename : pathlib.Path
+        the FASTQ, gzipped or not
+    level : int
+        the zlib compression level it would be recompressed at (default 9)
+    sample_bytes : int
+        how many bytes of reads to measure (default COMPRESSION_SAMPLE_BYTES)
+
+    Returns
+    -------
+    dict
+        with bytes (of reads measured), ratio (compressed bytes per byte of reads now),
+        bgzf_ratio (and as BGZF), decompress_rate and compress_rate (bytes of reads per second),
+        or None if the FASTQ is empty
+    """
+    start = time.perf_counter()
+
+    with open(filename, 'rb') as raw:
+        if gpas_uploader.fastq_compression(filename) != 'gzip':
+            data = raw.read(sample_bytes)
+            consumed = len(data)
+        else:
+            # decompress by hand so as to know exactly how many compressed bytes were read
+            data = b''
+            consumed = 0
+            pending = b''
+            member = zlib.decompressobj(31)
+            while len(data) < sample_bytes:
+                if not pending:
+                    pending = raw.read(64 * 1024)
+                    if not pending:
+                        break
+                    consumed += len(pending)
+                # files written in parallel hold several gzip members
+                if member.eof:
+                    member = zlib.decompressobj(31)
+                data += member.decompress(pending, sample_bytes - len(data))
+                pending = member.unconsumed_tail or member.unused_data
+            consumed -= len(pending)
+
+    decompress_seconds = time.perf_counter() - start
+
+    if len(data) == 0:
+        return None
+
+    start = time.perf_counter()
+    blocks = gpas_uploader.compress_bgzf(data, level)
+    compress_seconds = time.perf_counter() - start
+
+    return {'bytes': len(data),
+            'ratio': consumed / len(data),
+            'bgzf_ratio': sum(len(i[0]) for i in blocks) / len(data),
+            'decompress_rate': len(data) / max(decompress_seconds, 1e-6),
+            'compress_rate': len(data) / max(compress_seconds, 1e-6)}
+
+
+def choose_compression(filename, bandwidth, level=9, threads=1):
+    """Decide whether recompressing a FASTQ as BGZF will get it uploaded sooner.
+
+    The time to upload it as it is, is compared with the time to decompress and
+    recompress it on the given threads plus the time to upload the smaller file,
+    both estimated by measuring the start of the FASTQ.
+
+    Parameters
+    ----------
+    filename : pathlib.Path
+        the FASTQ
+    bandwidth : float
+        the upload speed in bytes per second, or None if it is not known
+    level : int
+        the zlib compression level (default 9)
+    threads : int
+        the number of threads to compress on (default 1)
+
+    Returns
+    -------
+    str
+        bgzf or keep
+    """
+    if bandwidth is None or bandwidth <= 0:
+        return 'keep'
+
+    measured = measure_compression(filename, level)
+    if measured is None:
+        return 'keep'
+
+    size = Path(filename).stat().st_size
+    reads = size / measured['ratio']
+
+    keep = size / bandwidth
+    bgzf = reads / measured['decompress_rate'] + reads / (measured['compress_rate'] * threads) + reads * measured['bgzf_ratio'] / bandwidth
+
+    return 'bgzf' if bgzf < keep else 'keep'
+
+
+def compress_reads(row, columns, wd, policy, level=9, threads=1, bandwidth=None):
+    """Apply the compression policy to the decontaminated FASTQs of a sample.
+
+    With auto the policy is chosen from the first FASTQ, so both FASTQs of a
+    paired sample are treated alike. As that choice depends on the upload speed,
+    the same reads can be uploaded with different MD5s by different runs, so the
+    MD5 of the first FASTQ as readItAndKeep wrote it is kept too, for looking the
+    reads up in the history. Designed to be used with pandas.DataFrame.apply.
+
+    Parameters
+    ----------
+    row : pandas.Series
+    columns : list
+        the columns holding the FASTQs, e.g. ['r1_uri', 'r2_uri']
+    wd : pathlib.Path
+        the working directory
+    policy : str
+        one of COMPRESSION_POLICIES
+    level : int
+        the zlib compression level (default 9)
+    threads : int
+        the number of threads to compress each FASTQ on (default 1)
+    bandwidth : float
+        the upload speed in bytes per second, for auto (default None, unknown)
+
+    Returns
+    -------
+    pandas.Series
+        the compression applied (bgzf or keep, if recompressing saved nothing), bytes before
+        and after, seconds taken and the MD5 of the first FASTQ before it was recompressed
+        (None if it was kept)
+    """
+    files = [wd / Path(row[i]) for i in columns]
+
+    if policy == 'auto':
+        policy = choose_compression(files[0], bandwidth, level, threads)
+
+    bytes_before = sum(i.stat().st_size for i in files)
+
+    if policy == 'keep':
+        return pandas.Series(['keep', bytes_before, bytes_before, 0.0, None])
+
+    # the MD5 is worked out as the first FASTQ is read to recompress it, saving a second read
+    md5 = hashlib.md5()
+
+    with gpas_uploader.span('recompress', category='sample', sample=row.name, bytes=bytes_before) as s:
+        start = time.perf_counter()
+        sizes = [recompress_bgzf(i, level, threads, md5 if n == 0 else None) for n, i in enumerate(files)]
+        bytes_after = sum(i[1] for i in sizes)
+        seconds = time.perf_counter() - start
+        s.set(bytes_after=bytes_after)
+
+    # each FASTQ is only replaced if it got smaller
+    if bytes_after == bytes_before:
+        return pandas.Series(['keep', bytes_before, bytes_before, round(seconds, 3), None])
+
+    md5_before = md5.hexdigest() if sizes[0][1] < sizes[0][0] else None
+
+    return pandas.Series(['bgzf', bytes_before, bytes_after, round(seconds, 3), md5_before])
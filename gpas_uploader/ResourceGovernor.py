@@ -0,0 +1,360 @@
+#! /usr/bin/env python3
+
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas
+
+import gpas_uploader
+
+# estimated cost of one job of each kind: CPUs, bytes of memory and bytes of scratch disk
+# written per byte of input. samtools sort holds up to 768 MB per thread before spilling
+# to temporary files and writes those, then the FASTQs, next to the BAM.
+JOB_COSTS = {
+    'samtools_sort': {'cpus': 1, 'memory': 800e6, 'disk': 3.0},
+    'samtools_fastq': {'cpus': 1, 'memory': 100e6, 'disk': 1.5},
+    'readItAndKeep': {'cpus': 1, 'memory': 300e6, 'disk': 1.0},
+    'hash': {'cpus': 1, 'memory': 10e6, 'disk': 0},
+    'check_fastq': {'cpus': 1, 'memory': 50e6, 'disk': 0},
+    'compress': {'cpus': 1, 'memory': 20e6, 'disk': 1.0},
+}
+
+# the most threads that will wait on the governor at once
+MAX_THREADS = 256
+
+
+def _read_cgroup_file(filename):
+    try:
+        with open(filename, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def machine_cpus():
+    """Return the number of CPUs this process may use.
+
+    Takes into account the CPU affinity mask and any CPU quota of the cgroup (v1 or v2)
+    the process is running in, e.g. under Docker, Kubernetes or SLURM.
+
+    Returns
+    -------
+    float
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = float(len(os.sched_getaffinity(0)))
+    else:
+        cpus = float(os.cpu_count() or 1)
+
+    # cgroup v2: "max 100000" or "<quota> <period>"
+    cpu_max = _read_cgroup_file('/sys/fs/cgroup/cpu.max')
+    if cpu_max is not None and not cpu_max.startswith('max'):
+        quota, period = cpu_max.split()
+        cpus = min(cpus, int(quota) / int(period))
+
+    # cgroup v1: a quota of -1 means no limit
+    quota = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota is not None and period is not None and int(quota) > 0:
+        cpus = min(cpus, int(quota) / int(period))
+
+    return max(cpus, 1.0)
+
+
+def machine_memory():
+    """Return the number of bytes of memory available to this process.
+
+    The smaller of the memory the kernel reports as available and the headroom left
+    under the memory limit of the cgroup (v1 or v2), if any.
+
+    Returns
+    -------
+    float
+        or None if it cannot be determined, e.g. on Windows
+    """
+    memory = None
+
+    meminfo = _read_cgroup_file('/proc/meminfo')
+    if meminfo is not None:
+        for line in meminfo.splitlines():
+            if line.startswith('MemAvailable:'):
+                memory = float(line.split()[1]) * 1024
+    elif hasattr(os, 'sysconf') and 'SC_PHYS_PAGES' in os.sysconf_names:
+        memory = float(os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE'))
+
+    for limit_file, usage_file in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        limit = _read_cgroup_file(limit_file)
+        if limit is None or limit == 'max':
+            continue
+        usage = _read_cgroup_file(usage_file)
+        headroom = float(limit) - (float(usage) if usage is not None else 0)
+        # cgroup v1 reports an enormous limit rather than max when there is none
+        if memory is None or headroom < memory:
+            memory = headroom
+
+    return memory
+
+
+class ResourceGovernor:
+    """
+    Share out CPUs, memory and scratch disk between the jobs of a batch.
+
+    Each job (converting a BAM, running readItAndKeep, hashing a sample) declares
+    or is given an estimated cost, see job_cost(), and waits until that much of every
+    resource is free before starting, so as many jobs run at once as fit on the
+    machine rather than a fixed number. Disk is checked against the space actually free
+    in the job's output folder, less that promised to the jobs already running. A job
+    needing more CPUs or memory than the governor has in total is allowed to run
+    on its own; one that cannot fit on the disk raises a GpasError.
+
+    Parameters
+    ----------
+    cpus : float
+        the number of CPUs to share out (default is what the machine and its cgroup allow)
+    memory : float
+        the number of bytes of memory to share out (default is what is available when created)
+    disk_reserve : float
+        bytes of disk to always leave free (default 1 GB)
+    costs : dict
+        overrides for JOB_COSTS, e.g. {'samtools_sort': {'memory': 2e9}}
+
+    Example
+    -------
+    >>> governor = ResourceGovernor(cpus=4, memory=8e9)
+    >>> hashes = governor.apply(df, hash_unpaired_reads, args=(wd,), cost=lambda row: governor.job_cost('hash', [row.r_uri]))
+    """
+
+    def __init__(self, cpus=None, memory=None, disk_reserve=1e9, costs=None):
+
+        self.cpus = float(cpus) if cpus is not None else machine_cpus()
+        self.memory = float(memory) if memory is not None else machine_memory()
+        self.disk_reserve = disk_reserve
+
+        self.costs = {i: dict(JOB_COSTS[i]) for i in JOB_COSTS}
+        if costs is not None:
+            for kind in costs:
+                self.costs.setdefault(kind, {'cpus': 1, 'memory': 0, 'disk': 0}).update(costs[kind])
+
+        self.condition = threading.Condition()
+        self.in_use = {'cpus': 0.0, 'memory': 0.0, 'disk': 0.0}
+        self.running = 0
+        self.peak_running = 0
+        self.last_schedule = None
+
+    def job_cost(self, kind, files=(), directory=None, width=1):
+        """Estimate the cost of a job from the sizes of its input files.
+
+        Parameters
+        ----------
+        kind : str
+            a key of JOB_COSTS, e.g. readItAndKeep
+        files : list
+            the input files; any that do not exist count as empty
+        directory : pathlib.Path
+            where the job writes its output (default None, the job writes nothing)
+        width : int
+            the number of copies of the tool the job runs at once, e.g. on chunks of one file (default 1)
+
+        Returns
+        -------
+        dict
+            with bytes (of input), width, cpus, memory, disk and directory
+        """
+        input_bytes = 0
+        for i in files:
+            try:
+                input_bytes += Path(i).stat().st_size
+            except (OSError, TypeError):
+                pass
+
+        cost = self.costs[kind]
+        return {'bytes': input_bytes,
+                'width': width,
+                'cpus': min(cost['cpus'] * width, self.cpus),
+                'memory': cost['memory'] * width if self.memory is None else min(cost['memory'] * width, self.memory),
+                'disk': cost['disk'] * input_bytes if directory is not None else 0,
+                'directory': directory}
+
+    def _free_disk(self, directory):
+        return shutil.disk_usage(directory).free - self.disk_reserve - self.in_use['disk']
+
+    def _fits(self, cost):
+        if self.in_use['cpus'] + cost['cpus'] > self.cpus + 1e-9:
+            return False
+        if self.memory is not None and self.in_use['memory'] + cost['memory'] > self.memory:
+            return False
+        if cost['disk'] > 0 and cost['disk'] > self._free_disk(cost['directory']):
+            return False
+        return True
+
+    def _take(self, cost):
+        for i in self.in_use:
+            self.in_use[i] += cost[i]
+        self.running += 1
+        self.peak_running = max(self.peak_running, self.running)
+
+    def _no_room(self, cost):
+        return gpas_uploader.GpasError({"resources": "not enough free space in %s: about %.1f GB is needed" % (cost['directory'], cost['disk'] / 1e9)})
+
+    def acquire(self, cost):
+        """Block until the job fits, then take its resources.
+        """
+        with self.condition:
+            while not self._fits(cost):
+                if self.running == 0:
+                    raise self._no_room(cost)
+                # wake periodically as the disk can also be freed by other processes
+                self.condition.wait(timeout=1)
+            self._take(cost)
+
+    def release(self, cost):
+        """Return the job's resources and wake any waiting jobs.
+        """
+        with self.condition:
+            for i in self.in_use:
+                self.in_use[i] -= cost[i]
+            self.running -= 1
+            self.condition.notify_all()
+
+    def apply(self, df, func, cost, args=(), largest_first=True):
+        """Apply func to each row of a DataFrame, running as many rows at once as fit.
+
+        A drop-in replacement for df.apply(func, args=args, axis=1) for functions that
+        spend their time in subprocesses or in C (hashing) and so can run in threads.
+        The jobs are started biggest first, by bytes of input per copy of the tool,
+        so that a large sample listed last does not leave the batch waiting on it
+        alone; whenever the next job does not fit, a smaller one that does is started.
+        The schedule, including the predicted and actual makespan, is left in
+        last_schedule, see schedule_report().
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+        func : function
+            called as func(row, *args), designed for pandas.DataFrame.apply
+        cost : function
+            called as cost(row), returning the cost of the job, see job_cost()
+        args : tuple
+            passed on to func
+        largest_first : bool
+            if False, start the jobs in the order of the rows (default True)
+
+        Returns
+        -------
+        pandas.Series or pandas.DataFrame
+            as pandas.DataFrame.apply would
+        """
+        rows = [row for idx, row in df.iterrows()]
+
+        if len(rows) == 0:
+            return df.apply(func, args=args, axis=1)
+
+        jobs = [{'position': i, 'row': row, 'cost': cost(row)} for i, row in enumerate(rows)]
+        if largest_first:
+            jobs.sort(key=lambda i: i['cost']['bytes'] / i['cost']['width'], reverse=True)
+
+        def run(job):
+            start = time.perf_counter()
+            try:
+                return func(job['row'], *args)
+            finally:
+                job['seconds'] = time.perf_counter() - start
+                self.release(job['cost'])
+
+        start = time.perf_counter()
+        futures = [None] * len(jobs)
+        pending = list(jobs)
+
+        with ThreadPoolExecutor(max_workers=min(len(jobs), MAX_THREADS)) as pool:
+
+            while pending:
+                with self.condition:
+                    while True:
+                        job = next((i for i in pending if self._fits(i['cost'])), None)
+                        if job is not None:
+                            break
+                        if self.running == 0:
+                            raise self._no_room(pending[0]['cost'])
+                        # wake periodically as the disk can also be freed by other processes
+                        self.condition.wait(timeout=1)
+                    self._take(job['cost'])
+                pending.remove(job)
+                futures[job['position']] = pool.submit(run, job)
+
+            results = [i.result() for i in futures]
+
+        self.last_schedule = self.schedule_report(jobs, time.perf_counter() - start)
+
+        if isinstance(results[0], pandas.Series):
+            return pandas.DataFrame([list(i) for i in results], index=df.index, columns=results[0].index)
+        return pandas.Series(results, index=df.index)
+
+    def simulate(self, costs, seconds):
+        """Return how long the jobs would take if started in the given order.
+
+        Each job is started as soon as it, or failing that a later job, fits in the
+        CPUs and memory, as apply() does.
+
+        Parameters
+        ----------
+        costs : list
+            the cost of each job, see job_cost()
+        seconds : list
+            how long each job takes
+
+        Returns
+        -------
+        float
+            the makespan in seconds
+        """
+        now, cpus, memory = 0.0, 0.0, 0.0
+        pending = list(zip(costs, seconds))
+        running = []
+
+        while pending or running:
+            for job in list(pending):
+                cost, duration = job
+                if (cpus + cost['cpus'] <= self.cpus + 1e-9 and (self.memory is None or memory + cost['memory'] <= self.memory)) or not running:
+                    running.append((now + duration, cost))
+                    cpus += cost['cpus']
+                    memory += cost['memory']
+                    pending.remove(job)
+            running.sort(key=lambda i: i[0])
+            end, cost = running.pop(0)
+            now = end
+            cpus -= cost['cpus']
+            memory -= cost['memory']
+
+        return now
+
+    def schedule_report(self, jobs, actual):
+        """Compare the makespan of a set of jobs with that predicted from their sizes.
+
+        The time each job would take is predicted from its bytes of input per copy
+        of the tool, at the rate achieved across all the jobs. The schedule is then
+        replayed in the order the jobs were started and in the order of the rows.
+
+        Returns
+        -------
+        dict
+            with the number of jobs and the predicted_makespan, predicted_makespan_in_order
+            and actual_makespan in seconds
+        """
+        work = [i['cost']['bytes'] / i['cost']['width'] for i in jobs]
+        if sum(work) > 0:
+            rate = sum(i['seconds'] for i in jobs) / sum(work)
+            predicted = [i * rate for i in work]
+        else:
+            predicted = [sum(i['seconds'] for i in jobs) / len(jobs)] * len(jobs)
+
+        in_order = sorted(range(len(jobs)), key=lambda i: jobs[i]['position'])
+
+        return {'jobs': len(jobs),
+                'predicted_makespan': round(self.simulate([i['cost'] for i in jobs], predicted), 3),
+                'predicted_makespan_in_order': round(self.simulate([jobs[i]['cost'] for i in in_order], [predicted[i] for i in in_order]), 3),
+                'actual_makespan': round(actual, 3)}
@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import gpas_uploader
+
+# rough ratios of the size of the files written to the size of the files read
+FASTQ_PER_BAM_BYTE = 1.5
+DECONTAMINATED_PER_FASTQ_BYTE = 1.0
+
+
+class ScratchSpace:
+    """
+    A folder for the intermediate files of a run, emptied as the run progresses.
+
+    The FASTQs converted from BAMs (and, when submitting, the decontaminated
+    FASTQs) are written to a folder of their own under directory. Each is deleted
+    as soon as the stage that reads it has finished with that sample, so a batch
+    needs roughly one copy of its reads free at any time rather than one per stage.
+    Before each stage the space it will need is estimated from the sizes of its
+    input files and a GpasError is raised if there is not enough.
+
+    Parameters
+    ----------
+    directory : str
+        where to create the scratch folder, ideally on fast local disk (default
+        $GPAS_SCRATCH_DIR, otherwise the system temporary folder)
+    reserve : float
+        bytes to always leave free (default 1 GB)
+    keep : bool
+        if True, never delete any files, e.g. for debugging (default False)
+    name : str
+        if given, use the folder of this name under directory, so that a run resumed from
+        the journal finds the files an earlier run left there (default None, a new folder)
+    resume : bool
+        if False, empty the named folder first (default False)
+    """
+
+    def __init__(self, directory=None, reserve=1e9, keep=False, name=None, resume=False):
+
+        if directory is None:
+            directory = os.environ.get('GPAS_SCRATCH_DIR', tempfile.gettempdir())
+
+        parent = Path(directory)
+        parent.mkdir(parents=True, exist_ok=True)
+
+        if name is None:
+            self.directory = Path(tempfile.mkdtemp(prefix='gpas-uploader-', dir=parent)).resolve()
+        else:
+            self.directory = (parent / name).resolve()
+            if not resume:
+                shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory.mkdir(exist_ok=True)
+        self.reserve = reserve
+        self.keep = keep
+
+        self.lock = threading.Lock()
+        self.files_deleted = 0
+        self.bytes_freed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+        return False
+
+    def path(self, name):
+        """Return a subfolder of the scratch folder, creating it if need be.
+        """
+        folder = self.directory / name
+        folder.mkdir(exist_ok=True)
+        return folder
+
+    def manages(self, filename):
+        """Return True if the file is inside the scratch folder, and so can be deleted.
+        """
+        try:
+            Path(filename).resolve().relative_to(self.directory)
+        except (ValueError, TypeError):
+            return False
+        return True
+
+    def estimate(self, files, ratio, directory):
+        """Estimate how many bytes a stage will write to directory.
+
+        If the inputs are themselves scratch files on the same filesystem they are
+        deleted as the stage goes, so only the largest single input is counted.
+
+        Parameters
+        ----------
+        files : list of lists
+            the input files of each sample
+        ratio : float
+            bytes written per byte read, e.g. FASTQ_PER_BAM_BYTE
+        directory : pathlib.Path
+            where the outputs will be written
+
+        Returns
+        -------
+        float
+        """
+        sizes = []
+        rolling = True
+        device = os.stat(directory).st_dev
+
+        for sample in files:
+            size = 0
+            for i in sample:
+                stat = os.stat(i)
+                size += stat.st_size
+                if not self.manages(i) or stat.st_dev != device:
+                    rolling = False
+            sizes.append(size * ratio)
+
+        if len(sizes) == 0:
+            return 0
+        return max(sizes) if rolling else sum(sizes)
+
+    def check(self, needed, directory):
+        """Raise a GpasError if there are not needed bytes free in directory.
+        """
+        free = shutil.disk_usage(directory).free - self.reserve
+        if needed > free:
+            raise gpas_uploader.GpasError({"scratch": "not enough free space in %s: about %.1f GB is needed but only %.1f GB is free" % (directory, needed / 1e9, max(free, 0) / 1e9)})
+
+    def release(self, files):
+        """Delete any of the files that are in the scratch folder.
+        """
+        if self.keep:
+            return
+        for i in files:
+            if not self.manages(i):
+                continue
+            try:
+                size = os.stat(i).st_size
+                os.remove(i)
+            except OSError:
+                continue
+            with self.lock:
+                self.files_deleted += 1
+                self.bytes_freed += size
+
+    def cleanup(self):
+        """Delete the scratch folder and everything left in it.
+        """
+        if not self.keep:
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,200 @@
+#! /usr/bin/env python3
+
+import functools
+import json
+import os
+import threading
+import time
+
+# the active Tracer, if any; when None and there are no listeners span() does nothing
+_tracer = None
+
+# objects with start_span(span) and end_span(span) methods, called at every span boundary
+_listeners = []
+
+
+class Tracer:
+    """
+    Write timing spans to a trace file.
+
+    If the filename ends .jsonl each span is written as a line of JSON, otherwise
+    the file is in the Chrome trace event format and can be opened directly in
+    chrome://tracing or https://ui.perfetto.dev. Each event is appended with a
+    single write, so spans from worker threads, or forked worker processes, end up
+    in the same file.
+
+    Parameters
+    ----------
+    filename : filename
+        the trace file to write
+    """
+
+    def __init__(self, filename):
+
+        self.filename = str(filename)
+        self.jsonl = self.filename.endswith('.jsonl')
+
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+
+        # the Chrome trace format allows the closing ] to be omitted
+        if not self.jsonl:
+            os.write(self.fd, b'[\n')
+
+    def write(self, event):
+        line = json.dumps(event, default=str) + ('\n' if self.jsonl else ',\n')
+        os.write(self.fd, line.encode('utf8'))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Span:
+    """
+    A timed region of work, used as a context manager via span().
+
+    Extra information, such as the number of bytes processed or the return code of
+    a subprocess, can be added with set() before the span ends.
+    """
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, **kwargs):
+        self.args.update(kwargs)
+
+    def __enter__(self):
+        for listener in _listeners:
+            listener.start_span(self)
+        self.ts = time.time_ns() // 1000
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args['error'] = repr(exc_value)
+        for listener in reversed(_listeners):
+            listener.end_span(self)
+        if _tracer is not None:
+            _tracer.write({'name': self.name,
+                           'cat': self.category,
+                           'ph': 'X',
+                           'ts': self.ts,
+                           'dur': int(self.duration * 1e6),
+                           'pid': os.getpid(),
+                           'tid': threading.get_ident(),
+                           'args': self.args})
+        return False
+
+
+class NullSpan:
+    """
+    Stands in for a Span when tracing is disabled.
+    """
+
+    def set(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, category='stage', **kwargs):
+    """Time a region of work.
+
+    Parameters
+    ----------
+    name : str
+        e.g. the stage (convert_bams, run_riak..) or the tool run for a sample
+    category : str
+        stage for batch-wide stages, sample for work on a single sample
+    kwargs
+        recorded with the span, e.g. sample=row.name; a value that is expensive to
+        work out, e.g. the size of a file, can be given as a function taking no
+        arguments, which is only called if the span is recorded
+
+    Returns
+    -------
+    Span or NullSpan
+        for use as a context manager
+
+    Example
+    -------
+    >>> with span('hash', category='sample', sample='sample1', bytes=lambda: filename.stat().st_size) as s:
+    ...     s.set(status_code=200)
+    """
+    if _tracer is None and not _listeners:
+        return NULL_SPAN
+    return Span(name, category, {key: value() if callable(value) else value for key, value in kwargs.items()})
+
+
+def traced(name, category='stage', **kwargs):
+    """Decorator that times every call of a function, as span() times a block.
+
+    Parameters
+    ----------
+    name : str
+    category : str
+    kwargs
+        recorded with the span; a value that is a function is called with the
+        arguments of the decorated function
+
+    Example
+    -------
+    >>> @traced('validate', samples=lambda self: len(self.df))
+    ... def validate(self):
+    ...     ...
+    """
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **func_kwargs):
+            if _tracer is None and not _listeners:
+                return func(*args, **func_kwargs)
+            with Span(name, category, {key: value(*args, **func_kwargs) if callable(value) else value for key, value in kwargs.items()}):
+                return func(*args, **func_kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_tracing(filename):
+    """Start writing spans to the specified trace file.
+    """
+    global _tracer
+    stop_tracing()
+    _tracer = Tracer(filename)
+
+
+def stop_tracing():
+    """Stop tracing and close the trace file.
+    """
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+def add_span_listener(listener):
+    """Call listener.start_span(span) and listener.end_span(span) around every span.
+
+    Listeners are called whether or not a trace file is being written, and
+    anything they add with span.set() is recorded in the trace.
+    """
+    _listeners.append(listener)
+
+
+def remove_span_listener(listener):
+    """Stop calling a listener added with add_span_listener.
+    """
+    if listener in _listeners:
+        _listeners.remove(listener)
@@ -4,18 +4,20 @@ import json
 import copy
 import re
 import sys
-import platform
+import time
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import requests
 
 import pandas
 import pandera
-from pandarallel import pandarallel
 from tqdm.auto import tqdm
 tqdm.pandas()
 
 import gpas_uploader
+# used as a decorator, so needed while the package is still being imported
+from .Tracing import traced
 
 
 class UploadBatch:
@@ -27,11 +29,44 @@ class UploadBatch:
     upload_csv : filename
         path to the upload CSV specifying the samples to be uploaded
     run_parallel : bool
-        if True, use pandarallel to remove PII reads in parallel (default False)
+        if True, convert BAMs in parallel, sharing the machine out with a ResourceGovernor (default False)
+    governor : gpas_uploader.ResourceGovernor
+        limits on the CPUs, memory and disk used by parallel jobs (default None, what the machine allows)
+    scratch : gpas_uploader.ScratchSpace
+        where to write intermediate files, deleting each once it has been used (default None, FASTQs
+        converted from BAMs are written next to the BAMs and kept)
+    watchdog : gpas_uploader.Watchdog
+        runs samtools and readItAndKeep, killing them if they hang (default None, no time limits)
+    journal : gpas_uploader.UploadJournal
+        records each sample's progress, and lets a later run skip the work an earlier one
+        completed (default None, nothing is recorded)
+    history : gpas_uploader.UploadHistory
+        the samples already submitted from this machine; samples are added once submitted
+        (default None, no history is kept)
+    duplicates : str
+        if a sample's reads have already been submitted, warn (and submit it again) or
+        skip it; either way it is listed in the instance variable duplicates (default warn)
+    check_fastqs : bool
+        if True, read each FASTQ through when validating to check it is intact, keeping
+        the numbers of reads and bases in the instance variable read_counts (default False)
+    cram_reference : str
+        the FASTA file any CRAMs were compressed against (default None, samtools finds it)
+    compression : str
+        what to do with the decontaminated FASTQs before they are hashed and uploaded: keep
+        them as readItAndKeep wrote them, recompress them as BGZF (bgzf) or recompress them only
+        if that will get them uploaded sooner (auto); the sizes, times and MD5s before recompression
+        are kept in the instance variable compression_report (default keep)
+    compression_level : int
+        the zlib compression level to recompress at (default 9)
+    upload_bandwidth : float
+        the upload speed in bytes per second, for auto (default None, the speed of the last
+        submission in the history; if that is not known either, the FASTQs are kept)
 
     The upload CSV file is stored internally as a pandas.Dataframe. If the upload CSV
-    file specifies BAM files these are first converted to FASTQ files using samtools.
+    file specifies BAM (or CRAM) files these are first converted to FASTQ files using samtools.
     The upload CSV is then validated using pandera.SchemaModels. Any errors are stored in the instance variable errors.
+    If samtools or readItAndKeep fail on a sample, the error is stored against that sample
+    and the other samples carry on.
 
     Example
     -------
@@ -42,7 +77,7 @@ class UploadBatch:
     0
 
     """
-    def __init__(self, upload_csv, token_file=None, environment='prod', run_parallel=False, tags_file=None, output_json=False, reference_genome=None):
+    def __init__(self, upload_csv, token_file=None, environment='prod', run_parallel=False, tags_file=None, output_json=False, reference_genome=None, governor=None, scratch=None, watchdog=None, journal=None, history=None, duplicates='warn', check_fastqs=False, cram_reference=None, compression='keep', compression_level=9, upload_bandwidth=None):
 
         # In the following code it needs to use double-escaped back slash (\\\\) to obtain single-escaped
         # back slash (\\) at runtime inside the regular expression, so the regular expression matches
@@ -55,8 +90,31 @@ class UploadBatch:
         self.wd = self.upload_csv.parent
         self.output_json = output_json
         self.reference_genome = reference_genome
-
-        assert environment in ['dev', 'prod', 'staging']
+        self.run_parallel = run_parallel
+        self.governor = governor
+        self.scratch = scratch
+        self.watchdog = watchdog
+        self.journal = journal
+        self.history = history
+        assert duplicates in gpas_uploader.DUPLICATE_POLICIES, 'duplicates must be one of ' + ', '.join(gpas_uploader.DUPLICATE_POLICIES)
+        self.duplicate_policy = duplicates
+        self.duplicates = pandas.DataFrame(None, columns=['sample_name', 'md5', 'gpas_batch', 'gpas_sample_name', 'submitted_on'])
+        self.check_fastqs = check_fastqs
+        self.cram_reference = cram_reference
+        self.read_counts = pandas.DataFrame(None, columns=['reads', 'bases'])
+        assert compression in gpas_uploader.COMPRESSION_POLICIES, 'compression must be one of ' + ', '.join(gpas_uploader.COMPRESSION_POLICIES)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.upload_bandwidth = upload_bandwidth
+        self.compression_report = pandas.DataFrame(None, columns=['compression', 'bytes_before', 'bytes_after', 'compress_seconds', 'md5_before'])
+        self.upload_throughput = None
+        self.last_schedule = {}
+        self.failed_samples = set()
+        self.resumed = {}
+        self.sources = {}
+        self.identifiers_resumed = False
+
+        assert environment in ['dev', 'prod', 'staging', 'local']
         self.environment = environment
 
         if not self.upload_csv.is_file():
@@ -101,6 +159,7 @@ class UploadBatch:
                 tzStartIndex = len(currentTime) - 6
                 self.uploaded_on = currentTime[:tzStartIndex] + "Z" + currentTime[tzStartIndex:]
 
+    @traced('validate', samples=lambda self: len(self.df))
     def validate(self):
         """Validate the upload CSV.
 
@@ -162,15 +221,34 @@ class UploadBatch:
 
             self.df.set_index('sample_name', inplace=True)
 
+            # check no two samples have the same files, before any time is spent on them
+            columns = [i for i in ['bam', 'fastq', 'fastq1', 'fastq2'] if i in self.df.columns]
+            with gpas_uploader.span('check_duplicate_files', samples=len(self.df)):
+                files_ok, err = gpas_uploader.check_files_not_duplicated_in_df(self.df, columns, self.wd)
+            if not files_ok:
+                self.validation_errors = pandas.concat([self.validation_errors, err])
+
+            # note the sizes and times of each sample's files, so changes are noticed when resuming
+            if self.journal is not None:
+                self.sources = {idx: {str(i): gpas_uploader.fingerprint(i) for i in self._files(row, columns)} for idx, row in self.df.iterrows()}
+
             # number the runs 1,2,3..
             self.run_number_lookup = self._infer_run_numbers()
 
             # if the upload CSV contains BAMs, check they exist, then convert to FASTQ(s)
-            if 'bam' in self.df.columns:
-                self._convert_bams()
+            converted = 'bam' in self.df.columns
+            if converted and files_ok:
+                with gpas_uploader.span('convert_bams', samples=len(self.df)) as s:
+                    self._convert_bams(run_parallel=self.run_parallel)
+                    s.set(**self.last_schedule)
 
             self._apply_pandera_schema()
 
+            # read the FASTQs through once, so that a truncated or corrupt file is found now
+            # rather than by readItAndKeep; those converted from BAMs are known to be intact
+            if self.check_fastqs and not converted and len(self.validation_errors) == 0:
+                self._check_fastqs(run_parallel=self.run_parallel)
+
             self.df.reset_index(inplace=True)
 
             self.df.fillna(value={'run_number':'', 'control':'', 'region': '', 'district': ''}, inplace=True)
@@ -201,46 +279,55 @@ class UploadBatch:
 
             self.validation_json = {"validation": {"status": "failure", "samples": errors}}
 
-    def decontaminate(self, run_parallel=False, outdir=Path('/tmp/')):
+    def decontaminate(self, run_parallel=False, outdir=None, chunk_size=None):
         """Remove personally identifiable genetic reads from the FASTQ files in the batch.
 
         Parameters
         ----------
         outdir : str
-            the folder where to write the decontaminated FASTQ files (Default is /tmp)
+            the folder where to write the decontaminated FASTQ files (Default is the scratch
+            space if there is one, when they are deleted once uploaded, otherwise /tmp)
         run_parallel: bool
-            if True, run readItAndKeep in parallel using pandarallel (default False)
+            if True, run readItAndKeep, recompression and hashing in parallel, as resources allow (default False)
+        chunk_size: int
+            if given, split unpaired FASTQs bigger than this many bytes into chunks and
+            decontaminate those in parallel (default None)
         """
 
+        if outdir is None:
+            outdir = self.scratch.path('decontaminated') if self.scratch is not None else Path('/tmp/')
+
         self.decontamination_errors = pandas.DataFrame(None, columns=['sample_name', 'error_message'])
 
         self.df.set_index('sample_name', inplace=True)
 
-        self._run_riak(outdir, run_parallel=run_parallel)
-
-        self._hash_fastqs()
-
-        self.df.reset_index(inplace=True)
+        if self.scratch is not None:
+            columns = ['fastq1', 'fastq2'] if self.sequencing_platform == 'Illumina' else ['fastq']
+            files = [self._files(row, columns) for idx, row in self.df.iterrows() if self.journal is None or self.journal.completed(idx, 'decontaminated', self.sources.get(idx)) is None]
+            self.scratch.check(self.scratch.estimate(files, gpas_uploader.DECONTAMINATED_PER_FASTQ_BYTE, outdir), outdir)
 
-        if self.connect_to_oci:
+        with gpas_uploader.span('run_riak', samples=len(self.df)) as s:
+            self._run_riak(outdir, run_parallel=run_parallel, chunk_size=chunk_size)
+            s.set(**self.last_schedule)
 
-            guid_lookup = self._get_serverside_guids()
+        # recompressing must come before hashing, so the digests are of the bytes that are uploaded
+        if self.compression != 'keep':
+            with gpas_uploader.span('compress_reads', samples=len(self.df), policy=self.compression) as s:
+                self._compress_reads(outdir, run_parallel=run_parallel)
+                s.set(bytes_before=int(self.compression_report.bytes_before.sum()), bytes_after=int(self.compression_report.bytes_after.sum()), **self.last_schedule)
 
-            self.df[['gpas_sample_name', 'gpas_run_number']] = self.df.apply(gpas_uploader.assign_gpas_identifiers_oci, args=(self.run_number_lookup, guid_lookup,), axis=1)
+        with gpas_uploader.span('hash_fastqs', samples=len(self.df)) as s:
+            self._hash_fastqs(run_parallel=run_parallel)
+            s.set(**self.last_schedule)
 
-        else:
-            # create offline the assumed unique GPAS batch id and sample names
-            self.gpas_batch = 'B-' + gpas_uploader.create_batch_name(self.upload_csv)
-            self.df['gpas_batch'] = self.gpas_batch
-            self.df[['gpas_sample_name', 'gpas_run_number']] = self.df.apply(gpas_uploader.assign_gpas_identifiers_local, args=(self.run_number_lookup,), axis=1)
+        self.df.reset_index(inplace=True)
 
-        # now that the gpas identifiers have been assigned, we need to rename the
-        # decontaminated FASTQ files
-        if self.sequencing_platform == 'Illumina':
-            self.df[['r1_uri', 'r2_uri']] = self.df.apply(gpas_uploader.rename_paired_fastq, axis=1)
-        elif self.sequencing_platform == 'Nanopore':
-            self.df['r_uri'] = self.df.apply(gpas_uploader.rename_unpaired_fastq, axis=1)
+        # look for samples whose reads have been submitted before
+        if self.history is not None and len(self.decontamination_errors) == 0:
+            self._check_history()
 
+        # the samples that did decontaminate are kept, but none are given GPAS identifiers
+        # unless all of them did
         if len(self.decontamination_errors)>0:
 
             self.decontamination_successful = False
@@ -256,9 +343,156 @@ class UploadBatch:
 
             self.decontamination_successful = True
 
+            # an earlier run may have already been given GPAS identifiers and renamed the files
+            self.identifiers_resumed = self._resume_identifiers()
+            if not self.identifiers_resumed:
+                self._assign_identifiers()
+
             # populate the post-decontamination JSON for passing to the Electron Client app
             self.decontamination_json = self._build_submission()
 
+    def _assign_identifiers(self):
+        """Private method that gives the batch and samples their GPAS identifiers and renames
+        the decontaminated FASTQ files after them, recording both in the journal.
+        """
+        with gpas_uploader.span('assign_gpas_identifiers', samples=len(self.df), oci=self.connect_to_oci):
+
+            if self.connect_to_oci:
+
+                guid_lookup = self._get_serverside_guids()
+
+                self.df[['gpas_sample_name', 'gpas_run_number']] = self.df.apply(gpas_uploader.assign_gpas_identifiers_oci, args=(self.run_number_lookup, guid_lookup,), axis=1)
+
+            else:
+                # create offline the assumed unique GPAS batch id and sample names
+                self.gpas_batch = 'B-' + gpas_uploader.create_batch_name(self.upload_csv)
+                self.df['gpas_batch'] = self.gpas_batch
+                self.df[['gpas_sample_name', 'gpas_run_number']] = self.df.apply(gpas_uploader.assign_gpas_identifiers_local, args=(self.run_number_lookup,), axis=1)
+
+        # now that the gpas identifiers have been assigned, we need to rename the
+        # decontaminated FASTQ files
+        if self.sequencing_platform == 'Illumina':
+            self.df[['r1_uri', 'r2_uri']] = self.df.apply(gpas_uploader.rename_paired_fastq, axis=1)
+        elif self.sequencing_platform == 'Nanopore':
+            self.df['r_uri'] = self.df.apply(gpas_uploader.rename_unpaired_fastq, axis=1)
+
+        if self.journal is not None:
+            self.journal.record_batch('identified', {'gpas_batch': self.gpas_batch, 'uploaded_on': self.uploaded_on, 'connect_to_oci': self.connect_to_oci, 'environment': self.environment})
+            columns = ['gpas_batch', 'gpas_sample_name', 'gpas_run_number'] + self._uri_columns()
+            for idx, row in self.df.iterrows():
+                self.journal.record(row.sample_name, 'identified', self.sources.get(row.sample_name), {i: row[i] for i in columns}, outputs=[row[i] for i in self._uri_columns()])
+
+    def _resume_identifiers(self):
+        """Private method that restores the GPAS identifiers given to every sample by an earlier run.
+
+        Returns
+        -------
+        bool
+            True if every sample had been given an identifier and its renamed files are unchanged
+        """
+        if self.journal is None or 'identified' not in self.journal.batch:
+            return False
+
+        batch = self.journal.batch['identified']
+
+        # identifiers made up offline, or registered in another environment, are not GPAS's
+        if batch.get('connect_to_oci') != self.connect_to_oci or batch.get('environment') != self.environment:
+            return False
+
+        values = {}
+        for i in self.df.sample_name:
+            values[i] = self.journal.completed(i, 'identified', self.sources.get(i))
+            if values[i] is None or values[i]['gpas_batch'] != batch['gpas_batch']:
+                return False
+
+        for i in ['gpas_batch', 'gpas_sample_name', 'gpas_run_number'] + self._uri_columns():
+            self.df[i] = [values[j][i] for j in self.df.sample_name]
+
+        self.gpas_batch = batch['gpas_batch']
+        self.uploaded_on = batch['uploaded_on']
+
+        return True
+
+    def _check_history(self):
+        """Private method that lists in duplicates the samples whose reads are in the history,
+        removing them from the batch if the policy is to skip them.
+        """
+        md5_column = 'r1_md5' if self.sequencing_platform == 'Illumina' else 'r_md5'
+
+        found = []
+        for idx, row in self.df.iterrows():
+            previous = self.history.lookup(row[md5_column], self._md5_before(row.sample_name))
+            if previous is not None:
+                found.append([row.sample_name, row[md5_column], previous['gpas_batch'], previous['gpas_sample_name'], previous['submitted_on']])
+
+        self.duplicates = pandas.DataFrame(found, columns=['sample_name', 'md5', 'gpas_batch', 'gpas_sample_name', 'submitted_on'])
+
+        if self.duplicate_policy == 'skip' and len(self.duplicates) > 0:
+
+            self.df = self.df[~self.df.sample_name.isin(self.duplicates.sample_name)].reset_index(drop=True)
+
+            # there has to be something left to submit
+            if len(self.df) == 0:
+                err = pandas.DataFrame([[i.sample_name, 'already submitted as %s in batch %s' % (i.gpas_sample_name, i.gpas_batch)] for i in self.duplicates.itertuples()], columns=['sample_name', 'error_message'])
+                self.decontamination_errors = pandas.concat([self.decontamination_errors, err])
+
+    def _md5_before(self, sample_name):
+        """Private method that returns the MD5 of a sample's first FASTQ before it was recompressed,
+        or None if it was not.
+        """
+        if sample_name in self.compression_report.index:
+            md5 = self.compression_report.md5_before[sample_name]
+            if isinstance(md5, str):
+                return md5
+        return None
+
+    def _record_history(self):
+        """Private method that adds the submitted samples to the history.
+        """
+        md5_column = 'r1_md5' if self.sequencing_platform == 'Illumina' else 'r_md5'
+
+        self.history.record([{'md5': row[md5_column],
+                              'md5_before': self._md5_before(row.sample_name),
+                              'gpas_batch': self.gpas_batch,
+                              'gpas_sample_name': idx,
+                              'sample_name': row.sample_name,
+                              'upload_csv': str(self.upload_csv.resolve()),
+                              'upload_throughput': self.upload_throughput} for idx, row in self.df.iterrows() if row.uploaded])
+
+    def _probe_uploaded(self, url):
+        """Private method that marks as uploaded the samples whose files are all already in
+        the bucket, with the same size and MD5, checking PROBE_THREADS files at a time.
+
+        Returns
+        -------
+        int
+            the number of samples found
+        """
+        columns = self._uri_columns()
+
+        files = {}
+        for idx, row in self.df.loc[~self.df['uploaded']].iterrows():
+            for i in columns:
+                files[(idx, i)] = (url + idx + gpas_uploader.UPLOAD_SUFFIXES[i], self.wd / Path(row[i]), row[i.replace('uri', 'md5')])
+
+        if len(files) == 0:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=gpas_uploader.PROBE_THREADS) as pool:
+            found = dict(zip(files, pool.map(lambda i: gpas_uploader.uploaded_object_matches(*i), files.values())))
+
+        samples = [idx for idx in self.df.index[~self.df['uploaded']] if all(found[(idx, i)] for i in columns)]
+
+        for idx in samples:
+            self.df.loc[idx, 'uploaded'] = True
+            if self.journal is not None:
+                self.journal.record(self.df.sample_name[idx], 'uploaded', self.sources.get(self.df.sample_name[idx]), {'uploaded': True})
+
+        return len(samples)
+
+    def _uri_columns(self):
+        return ['r1_uri', 'r2_uri'] if self.sequencing_platform == 'Illumina' else ['r_uri']
+
     def submit(self):
         """Submit the samples and their metadata to GPAS for processing.
 
@@ -284,19 +518,48 @@ class UploadBatch:
 
         url = par + self.gpas_batch + '/'
 
-        self.df['uploaded'] = False
+        # samples uploaded by an earlier run are not uploaded again
+        if self.journal is not None:
+            self.df['uploaded'] = [self.journal.completed(row.sample_name, 'uploaded', self.sources.get(row.sample_name)) is not None for idx, row in self.df.iterrows()]
+        else:
+            self.df['uploaded'] = False
+
+        # an earlier run of this batch may have uploaded files without living to record them in
+        # the journal; a new batch has new sample names so nothing of it can be in the bucket yet
+        if self.identifiers_resumed:
+            with gpas_uploader.span('probe_uploaded', samples=int((~self.df['uploaded']).sum())) as s:
+                s.set(found=self._probe_uploaded(url))
+
+        if self.sequencing_platform == 'Illumina':
+            upload = self._record_upload(self._release_after(gpas_uploader.upload_fastq_paired, ['r1_uri', 'r2_uri']))
+        else:
+            upload = self._record_upload(self._release_after(gpas_uploader.upload_fastq_unpaired, ['r_uri']))
 
         counter = 0
         samples_not_uploaded = len(self.df.loc[~self.df['uploaded']])
 
-        while samples_not_uploaded > 0 and counter < 3:
+        # time the upload, so that a later run can tell whether recompressing the reads will pay off
+        sizes = {}
+        for idx, row in self.df.loc[~self.df['uploaded']].iterrows():
+            sizes[idx] = sum((self.wd / Path(row[i])).stat().st_size for i in self._uri_columns() if (self.wd / Path(row[i])).is_file())
+        start = time.perf_counter()
 
-            if self.sequencing_platform == 'Illumina':
-                self.df['uploaded'] = self.df.progress_apply(gpas_uploader.upload_fastq_paired, args=(url, headers,), axis=1)
-            else:
-                self.df['uploaded'] = self.df.progress_apply(gpas_uploader.upload_fastq_unpaired, args=(url, headers,), axis=1)
-            samples_not_uploaded = len(self.df.loc[~self.df['uploaded']])
-            counter+=1
+        with gpas_uploader.span('upload', samples=samples_not_uploaded) as s:
+
+            while samples_not_uploaded > 0 and counter < 3:
+
+                # only try again the samples that have not yet been uploaded
+                pending = ~self.df['uploaded']
+                self.df.loc[pending, 'uploaded'] = self.df.loc[pending].progress_apply(upload, args=(url, headers,), axis=1)
+                samples_not_uploaded = len(self.df.loc[~self.df['uploaded']])
+                counter+=1
+
+            seconds = time.perf_counter() - start
+            uploaded_bytes = sum(sizes[i] for i in sizes if self.df.uploaded[i])
+            if uploaded_bytes > 0 and seconds > 0:
+                self.upload_throughput = uploaded_bytes / seconds
+
+            s.set(attempts=counter, samples_not_uploaded=samples_not_uploaded, bytes=uploaded_bytes)
 
         self.submit_json = copy.deepcopy(self.decontamination_json['submission'])
         self.submit_json['batch']['bucket_name'] = bucket
@@ -306,11 +569,26 @@ class UploadBatch:
         # build the API URL
         url  = self.environment_urls[self.environment]['WORLD_URL'] + self.environment_urls[self.environment]['ORDS_PATH'] + '/batches'
 
-        # make the API call
-        a = requests.post(url=url, json=self.submit_json, headers=self.headers)
+        # an earlier run may already have sent the metadata for this batch
+        if self.journal is not None and self.journal.batch.get('submitted', {}).get('gpas_batch') == self.gpas_batch:
+            submitted = True
+
+        else:
+            # make the API call
+            with gpas_uploader.span('submit_metadata') as s:
+                a = requests.post(url=url, json=self.submit_json, headers=self.headers)
+                s.set(status_code=a.status_code)
+
+            submitted = a.ok
+
+            if submitted and self.journal is not None:
+                self.journal.record_batch('submitted', {'gpas_batch': self.gpas_batch})
+
+        if submitted and self.history is not None:
+            self._record_history()
 
         # if it fails raise an Exception, otherwise parse the returned content
-        if not a.ok:
+        if not submitted:
 
             self.submit_errors.append(pandas.DataFrame([[None,'sending metadata JSON to ORDS failed']], columns=['sample_name', 'error_message']))
 
@@ -322,6 +600,8 @@ class UploadBatch:
 
             if not r.ok:
                 self.submit_errors.append(pandas.DataFrame([[None,'uploading finalisation mark failed']], columns=['sample_name', 'error_message']))
+            elif self.journal is not None:
+                self.journal.record_batch('finalised', {'gpas_batch': self.gpas_batch})
 
 
     def _infer_run_numbers(self):
@@ -345,18 +625,28 @@ class UploadBatch:
 
     def _apply_pandera_schema(self):
 
+        # samples whose BAMs could not be converted already have an error recorded
+        df = self.df[~self.df.index.isin(self.failed_samples)]
+
+        # and if that is all of them there is nothing left to check
+        if len(df) == 0:
+            return
+
+        # and the FASTQs converted in an earlier run may since have been deleted, once used
+        present = df[~df.index.isin(self.resumed.get('converted', set()))]
+
         # have to treat the upload CSV differently depending on whether it specifies
         # paired or unpaired reads
         if 'fastq' in self.df.columns:
             self.sequencing_platform = 'Nanopore'
 
-            fastq_files = copy.deepcopy(self.df[['fastq']])
+            fastq_files = copy.deepcopy(present[['fastq']])
             files_ok, err = gpas_uploader.check_files_exist_in_df(fastq_files, 'fastq', self.wd)
             if not files_ok:
                 self.validation_errors = pandas.concat([self.validation_errors,err])
 
             try:
-                gpas_uploader.NanoporeFASTQCheckSchema.validate(self.df, lazy=True)
+                gpas_uploader.NanoporeFASTQCheckSchema.validate(df, lazy=True)
             except pandera.errors.SchemaErrors as err:
                 self.validation_errors = pandas.concat([self.validation_errors, gpas_uploader.build_errors(err)])
 
@@ -364,18 +654,39 @@ class UploadBatch:
             self.sequencing_platform = 'Illumina'
 
             for i in ['fastq1', 'fastq2']:
-                fastq_files = copy.deepcopy(self.df[[i]])
+                fastq_files = copy.deepcopy(present[[i]])
                 files_ok, err = gpas_uploader.check_files_exist_in_df(fastq_files, i, self.wd)
                 if not files_ok:
                     self.validation_errors = pandas.concat([self.validation_errors,err])
 
             try:
-                gpas_uploader.IlluminaFASTQCheckSchema.validate(self.df, lazy=True)
+                gpas_uploader.IlluminaFASTQCheckSchema.validate(df, lazy=True)
             except pandera.errors.SchemaErrors as err:
                 self.validation_errors = pandas.concat([self.validation_errors, gpas_uploader.build_errors(err)])
 
 
 
+    def _check_fastqs(self, run_parallel=False):
+        """Private method that checks every FASTQ file is intact, reading each once.
+
+        The numbers of reads and bases of each sample are kept in read_counts.
+
+        Parameters
+        ----------
+        run_parallel: bool
+            if True, check as many samples at once as the CPUs and memory allow (default False)
+        """
+        if self.sequencing_platform == 'Illumina':
+            func, files = gpas_uploader.check_paired_fastq, ['fastq1', 'fastq2']
+        else:
+            func, files = gpas_uploader.check_unpaired_fastq, ['fastq']
+
+        with gpas_uploader.span('check_fastqs', samples=len(self.df)) as s:
+            counts = self._apply(func, (self.wd,), 'check_fastq', files, ['reads', 'bases'], run_parallel=run_parallel, errors='validation_errors')
+            counts.columns = ['reads', 'bases']
+            self.read_counts = counts.dropna().astype(int)
+            s.set(reads=int(self.read_counts.reads.sum()), bases=int(self.read_counts.bases.sum()), **self.last_schedule)
+
     def _call_ords_userOrgDtls(self):
         """Private method that calls ORDS to find out User Details
 
@@ -425,17 +736,157 @@ class UploadBatch:
 
         return(user_name, user_organisation, permitted_tags)
 
+    def _get_governor(self):
+        """Private method returning the ResourceGovernor for parallel jobs, creating one if none was given.
+        """
+        if self.governor is None:
+            self.governor = gpas_uploader.ResourceGovernor()
+        return self.governor
+
+    def _apply(self, func, args, kind, files, columns, directory=None, run_parallel=False, width=None, errors='decontamination_errors', stage=None):
+        """Private method that applies func to every row of the batch.
+
+        If run_parallel is True the rows are run in threads, as many at once as
+        the ResourceGovernor allows given the estimated cost of each job, largest
+        first. The predicted and actual makespan are then kept in last_schedule.
+
+        If func raises an exception for a row, the error is added to the errors
+        DataFrame against that sample, its outputs are left as None and the other
+        rows carry on, unless it is a MissingToolError, which stops the whole batch.
+        Samples that have already failed are skipped.
+
+        If there is a journal, rows that completed this stage in an earlier run are
+        given the values recorded then rather than being run again, and the rows
+        that are run are recorded.
+
+        Parameters
+        ----------
+        func : function
+            designed to be used with pandas.DataFrame.apply
+        args : tuple
+            passed on to func
+        kind : str
+            the kind of job, a key of gpas_uploader.JOB_COSTS
+        files : list
+            the columns holding the input files of each job, relative to the working directory
+        columns : list
+            the columns func returns values for
+        directory : pathlib.Path
+            where each job writes its output (default None)
+        run_parallel : bool
+            if True, run the rows in parallel (default False)
+        width : function
+            called as width(row), the number of copies of the tool each job runs at once (default None, 1)
+        errors : str
+            the instance variable holding the errors DataFrame for this stage (default decontamination_errors)
+        stage : str
+            the stage to record in the journal, one of gpas_uploader.STAGES (default None, not recorded)
+        """
+        self.last_schedule = {}
+
+        failed = None if len(columns) == 1 else pandas.Series([None] * len(columns))
+        failures = []
+
+        resumed = {}
+        if self.journal is not None and stage is not None:
+            for idx in self.df.index:
+                values = self.journal.completed(idx, stage, self.sources.get(idx))
+                if values is not None and all(i in values for i in columns):
+                    resumed[idx] = [values[i] for i in columns]
+            self.resumed[stage] = set(resumed)
+
+        def isolate(row, *args):
+            if row.name in self.failed_samples:
+                return failed
+            if row.name in resumed:
+                return resumed[row.name][0] if len(columns) == 1 else pandas.Series(resumed[row.name])
+            inputs = self._files(row, files)
+            try:
+                result = func(row, *args)
+            except gpas_uploader.MissingToolError:
+                # every other sample would fail in the same way
+                raise
+            except Exception as err:
+                failures.append([row.name, gpas_uploader.describe_error(err)])
+                return failed
+            if self.journal is not None and stage is not None:
+                values = [result] if len(columns) == 1 else list(result)
+                outputs = [self.wd / Path(i) for i in values if isinstance(i, str) and (self.wd / Path(i)).is_file()]
+                # a stage that writes no files, such as hashing, is only valid while its inputs are unchanged
+                self.journal.record(row.name, stage, self.sources.get(row.name), dict(zip(columns, values)), inputs, outputs if outputs else inputs)
+            return result
+
+        if not run_parallel:
+            result = self.df.apply(isolate, args=args, axis=1)
+
+        else:
+            governor = self._get_governor()
+
+            def cost(row):
+                if row.name in self.failed_samples or row.name in resumed:
+                    return governor.job_cost(kind, [], directory)
+                cost = governor.job_cost(kind, self._files(row, files), directory, 1 if width is None else width(row))
+                # readItAndKeep takes time in proportion to the bases rather than to how well they compressed,
+                # so if the FASTQs have been checked the samples are ordered by those instead
+                if kind == 'readItAndKeep' and row.name in self.read_counts.index:
+                    cost['bytes'] = int(self.read_counts.bases[row.name])
+                return cost
+
+            result = governor.apply(self.df, isolate, cost, args=args)
+            self.last_schedule = governor.last_schedule
+
+        if len(failures) > 0:
+            self.failed_samples.update(i[0] for i in failures)
+            setattr(self, errors, pandas.concat([getattr(self, errors), pandas.DataFrame(failures, columns=['sample_name', 'error_message'])]))
+
+        return result
+
+    def _files(self, row, columns):
+        """Private method that returns the files in the given columns of a row, a FASTQ
+        that is a pattern giving all the files it matches.
+        """
+        return [j for i in columns for j in gpas_uploader.expand_fastq(row[i], self.wd)]
+
+    def _release_after(self, func, columns):
+        """Private method wrapping func so that, unless it returns False, the scratch files
+        named in columns are deleted once it has finished with a row.
+        """
+        if self.scratch is None:
+            return func
+
+        def release_after(row, *args):
+            result = func(row, *args)
+            if result is not False:
+                self.scratch.release([self.wd / Path(row[i]) for i in columns])
+            return result
+
+        return release_after
+
+    def _record_upload(self, func):
+        """Private method wrapping func so that each sample it uploads is recorded in the journal.
+        """
+        if self.journal is None:
+            return func
+
+        def record_upload(row, *args):
+            result = func(row, *args)
+            if result:
+                self.journal.record(row.sample_name, 'uploaded', self.sources.get(row.sample_name), {'uploaded': True})
+            return result
+
+        return record_upload
+
     def _convert_bams(self, run_parallel=False):
         """Private method that converts BAM files to FASTQ files.
 
         Paired or unpaired FASTQ files are produced depending on the instrument_platform
-        specified in the upload CSV file. If run_parallel is True this uses pandarallel
-        to run samtools in parallel, except on Windows.
+        specified in the upload CSV file. If run_parallel is True samtools is run on
+        as many BAMs at once as the CPUs, memory and disk allow.
 
         Parameters
         ----------
         run_parallel: bool
-            if True, run readItAndKeep in parallel using pandarallel (default False)
+            if True, run samtools in parallel (default False)
         """
 
         # check that the BAM files exist in the working directory
@@ -449,78 +900,86 @@ class UploadBatch:
 
         else:
 
-            # From https://github.com/nalepae/pandarallel
-            # "On Windows, Pandaral·lel will works only if the Python session is executed from Windows Subsystem for Linux (WSL)"
-            # Hence disable parallel processing for Windows for now
-            if platform.system() == 'Windows' or run_parallel is False:
-                # run samtools to produce paired/unpaired reads depending on the technology
-                if self.df.instrument_platform.unique()[0] == 'Illumina':
-                    self.sequencing_platform = 'Illumina'
-                    self.df[['fastq1', 'fastq2']] = self.df.apply(gpas_uploader.convert_bam_paired_reads, args=(self.wd,), axis=1)
-
-                elif self.df.instrument_platform.unique()[0] == 'Nanopore':
-                    self.sequencing_platform = 'Nanopore'
-                    self.df['fastq'] = self.df.apply(gpas_uploader.convert_bam_unpaired_reads, args=(self.wd,), axis=1)
-
-                else:
-                    raise gpas_uploader.GpasError("sequencing_platform not recognised!")
-
+            # write the FASTQs to the scratch space, if there is one, rather than next to the BAMs
+            if self.scratch is not None:
+                outdir = self.scratch.path('converted')
+                self.scratch.check(self.scratch.estimate([[self.wd / Path(i)] for i in self.df.bam], gpas_uploader.FASTQ_PER_BAM_BYTE, outdir), outdir)
             else:
+                outdir = None
 
-                pandarallel.initialize(progress_bar=False, verbose=0)
+            # run samtools to produce paired/unpaired reads depending on the technology
+            if self.df.instrument_platform.unique()[0] == 'Illumina':
+                self.sequencing_platform = 'Illumina'
+                self.df[['fastq1', 'fastq2']] = self._apply(gpas_uploader.convert_bam_paired_reads, (self.wd, outdir, self.watchdog, self.cram_reference), 'samtools_sort', ['bam'], ['fastq1', 'fastq2'], outdir or self.wd, run_parallel, errors='validation_errors', stage='converted')
 
-                # run samtools to produce paired/unpaired reads depending on the technology
-                if self.df.instrument_platform.unique()[0] == 'Illumina':
-                    self.sequencing_platform = 'Illumina'
-                    self.df[['fastq1', 'fastq2']] = self.df.parallel_apply(gpas_uploader.convert_bam_paired_reads, args=(self.wd,), axis=1)
+            elif self.df.instrument_platform.unique()[0] == 'Nanopore':
+                self.sequencing_platform = 'Nanopore'
+                self.df['fastq'] = self._apply(gpas_uploader.convert_bam_unpaired_reads, (self.wd, outdir, self.watchdog, self.cram_reference), 'samtools_fastq', ['bam'], ['fastq'], outdir or self.wd, run_parallel, errors='validation_errors', stage='converted')
 
-                elif self.df.instrument_platform.unique()[0] == 'Nanopore':
-                    self.sequencing_platform = 'Nanopore'
-                    self.df['fastq'] = self.df.parallel_apply(gpas_uploader.convert_bam_unpaired_reads, args=(self.wd,), axis=1)
+            else:
+                raise gpas_uploader.GpasError("sequencing_platform not recognised!")
 
             # now that we've added fastq column(s) we need to remove the bam column
             # so that the DataFrame doesn't fail validation
             self.df.drop(columns='bam', inplace=True)
 
-    def _run_riak(self,outdir,run_parallel=False):
+    def _run_riak(self,outdir,run_parallel=False,chunk_size=None):
 
-        # From https://github.com/nalepae/pandarallel
-        # "On Windows, Pandaral·lel will works only if the Python session is executed from Windows Subsystem for Linux (WSL)"
-        # Hence disable parallel processing for Windows for now
-        if platform == 'Windows' or run_parallel is False:
+        if self.sequencing_platform == 'Nanopore' and chunk_size is not None:
 
-            if self.sequencing_platform == 'Nanopore':
-                self.df['r_uri'] = self.df.apply(gpas_uploader.remove_pii_unpaired_reads, args=(self.reference_genome, self.wd, outdir, self.output_json), axis=1)
+            # each sample may run several copies of readItAndKeep, up to the CPUs available
+            max_workers = self._get_governor().cpus if run_parallel else gpas_uploader.machine_cpus()
 
-            elif self.sequencing_platform == 'Illumina':
-                self.df[['r1_uri', 'r2_uri']] = self.df.apply(gpas_uploader.remove_pii_paired_reads, args=(self.reference_genome, self.wd, outdir, self.output_json), axis=1)
+            def width(row):
+                return gpas_uploader.chunk_workers(sum(i.stat().st_size for i in self._files(row, ['fastq'])), chunk_size, max_workers)
 
-        else:
+            self.df['r_uri'] = self._apply(self._release_after(gpas_uploader.remove_pii_unpaired_reads_chunked, ['fastq']), (self.reference_genome, self.wd, outdir, self.output_json, chunk_size, max_workers, self.watchdog), 'readItAndKeep', ['fastq'], ['r_uri'], outdir, run_parallel, width, stage='decontaminated')
+
+        elif self.sequencing_platform == 'Nanopore':
+            self.df['r_uri'] = self._apply(self._release_after(gpas_uploader.remove_pii_unpaired_reads, ['fastq']), (self.reference_genome, self.wd, outdir, self.output_json, self.watchdog), 'readItAndKeep', ['fastq'], ['r_uri'], outdir, run_parallel, stage='decontaminated')
+
+        elif self.sequencing_platform == 'Illumina':
+            self.df[['r1_uri', 'r2_uri']] = self._apply(self._release_after(gpas_uploader.remove_pii_paired_reads, ['fastq1', 'fastq2']), (self.reference_genome, self.wd, outdir, self.output_json, self.watchdog), 'readItAndKeep', ['fastq1', 'fastq2'], ['r1_uri', 'r2_uri'], outdir, run_parallel, stage='decontaminated')
+
+    def _compress_reads(self, outdir, run_parallel=False):
+        """Private method that applies the compression policy to the decontaminated FASTQs.
+
+        Each sample is recompressed on as many threads as there are CPUs, so the samples
+        are done one at a time.
+        """
+        if len(self.df) == 0:
+            return
+
+        columns = self._uri_columns()
+
+        bandwidth = self.upload_bandwidth
+        if bandwidth is None and self.history is not None:
+            bandwidth = self.history.upload_throughput
 
-            pandarallel.initialize(verbose=0)
+        threads = max(1, int(self._get_governor().cpus if run_parallel else gpas_uploader.machine_cpus()))
 
-            if self.sequencing_platform == 'Nanopore':
-                self.df['r_uri'] = self.df.parallel_apply(gpas_uploader.remove_pii_unpaired_reads, args=(self.reference_genome, self.wd, outdir, self.output_json), axis=1)
+        report = self._apply(gpas_uploader.compress_reads, (columns, self.wd, self.compression, self.compression_level, threads, bandwidth), 'compress', columns, ['compression', 'bytes_before', 'bytes_after', 'compress_seconds', 'md5_before'], outdir, run_parallel, lambda row: threads, stage='compressed')
+        report.columns = ['compression', 'bytes_before', 'bytes_after', 'compress_seconds', 'md5_before']
 
-            elif self.sequencing_platform == 'Illumina':
-                self.df[['r1_uri', 'r2_uri']] = self.df.parallel_apply(gpas_uploader.remove_pii_paired_reads, args=(self.reference_genome, self.wd, outdir, self.output_json), axis=1)
+        # samples that failed have no compression
+        self.compression_report = report.loc[report.compression.notna()]
 
-    def _hash_fastqs(self):
+    def _hash_fastqs(self, run_parallel=False):
 
         if self.sequencing_platform == 'Illumina':
 
-            self.df[['r1_md5', 'r1_sha', 'r2_md5', 'r2_sha']] = self.df.apply(gpas_uploader.hash_paired_reads, args=(self.wd,), axis=1)
+            self.df[['r1_md5', 'r1_sha', 'r2_md5', 'r2_sha']] = self._apply(gpas_uploader.hash_paired_reads, (self.wd,), 'hash', ['r1_uri', 'r2_uri'], ['r1_md5', 'r1_sha', 'r2_md5', 'r2_sha'], run_parallel=run_parallel, stage='hashed')
 
             for i in ['r1_uri', 'r2_uri']:
-                fastq_files = copy.deepcopy(self.df[[i]])
+                fastq_files = copy.deepcopy(self.df.loc[~self.df.index.isin(self.resumed.get('hashed', set())), [i]])
                 files_ok, err = gpas_uploader.check_files_exist_in_df(fastq_files, i, self.wd)
                 if not files_ok:
                     self.decontamination_errors = pandas.concat([self.decontamination_errors,err])
 
         elif self.sequencing_platform == 'Nanopore':
-            self.df[['r_md5', 'r_sha',]] = self.df.apply(gpas_uploader.hash_unpaired_reads, args=(self.wd,), axis=1)
+            self.df[['r_md5', 'r_sha',]] = self._apply(gpas_uploader.hash_unpaired_reads, (self.wd,), 'hash', ['r_uri'], ['r_md5', 'r_sha'], run_parallel=run_parallel, stage='hashed')
 
-            fastq_files = copy.deepcopy(self.df[['r_uri']])
+            fastq_files = copy.deepcopy(self.df.loc[~self.df.index.isin(self.resumed.get('hashed', set())), ['r_uri']])
             files_ok, err = gpas_uploader.check_files_exist_in_df(fastq_files, 'r_uri', self.wd)
             if not files_ok:
                 self.decontamination_errors = pandas.concat([self.decontamination_errors,err])
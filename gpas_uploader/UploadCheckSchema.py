@@ -8,6 +8,13 @@ import pycountry
 from gpas_uploader import BaseCheckSchema
 
 
+# the endings allowed for each file column: uncompressed, gzipped or zstd-compressed FASTQs, and BAMs or CRAMs
+FILE_SUFFIXES = {'fastq': ['.fastq', '.fastq.gz', '.fastq.zst'],
+                 'fastq1': ['_1.fastq', '_1.fastq.gz', '_1.fastq.zst'],
+                 'fastq2': ['_2.fastq', '_2.fastq.gz', '_2.fastq.zst'],
+                 'bam': ['.bam', '.cram']}
+
+
 @extensions.register_check_method()
 def region_is_valid(df):
     """
@@ -56,11 +63,15 @@ class IlluminaFASTQCheckSchema(BaseCheckSchema):
     #
     # gpas_sample_name: Index[str] = pandera.Field(str_matches=r'^[A-Za-z0-9]')
 
-    # validate that the fastq1 file is alphanumeric and unique
-    fastq1: Series[str] = pandera.Field(unique=True, str_matches=r'^[A-Za-z0-9/._-]+$', str_endswith='_1.fastq.gz', coerce=True, nullable=False)
+    # validate that the fastq1 file is alphanumeric and unique; it may be a pattern matching several files
+    fastq1: Series[str] = pandera.Field(unique=True, str_matches=r'^[A-Za-z0-9/._*?\[\]-]+$', coerce=True, nullable=False)
+
+    # validate that the fastq2 file is alphanumeric and unique; it may be a pattern matching several files
+    fastq2: Series[str] = pandera.Field(unique=True, str_matches=r'^[A-Za-z0-9/._*?\[\]-]+$', coerce=True, nullable=False)
 
-    # validate that the fastq2 file is alphanumeric and unique
-    fastq2: Series[str] = pandera.Field(unique=True, str_matches=r'^[A-Za-z0-9/._-]+$', str_endswith='_2.fastq.gz', coerce=True, nullable=False)
+    @pandera.check('fastq1', 'fastq2', name='file_suffix')
+    def file_suffix(cls, a):
+        return a.str.endswith(tuple(FILE_SUFFIXES[a.name]))
 
     class Config:
         region_is_valid = ()
@@ -82,8 +93,12 @@ class NanoporeFASTQCheckSchema(BaseCheckSchema):
     #
     # gpas_sample_name: Index[str] = pandera.Field(str_matches=r'^[A-Za-z0-9]')
 
-    # validate that the fastq file is alphanumeric and unique
-    fastq: Series[str] = pandera.Field(unique=True, str_matches=r'^[A-Za-z0-9/._-]+$', str_endswith='.fastq.gz', coerce=True, nullable=False)
+    # validate that the fastq file is alphanumeric and unique; it may be a pattern matching several files
+    fastq: Series[str] = pandera.Field(unique=True, str_matches=r'^[A-Za-z0-9/._*?\[\]-]+$', coerce=True, nullable=False)
+
+    @pandera.check('fastq', name='file_suffix')
+    def file_suffix(cls, a):
+        return a.str.endswith(tuple(FILE_SUFFIXES[a.name]))
 
     class Config:
         region_is_valid = ()
@@ -105,7 +120,11 @@ class BAMCheckSchema(BaseCheckSchema):
     # gpas_sample_name: Index[str] = pandera.Field(str_matches=r'^[A-Za-z0-9]')
 
     # validate that the bam file is alphanumeric and unique
-    bam: Series[str] = pandera.Field(unique=True, str_matches=r'^[A-Za-z0-9/._-]+$', str_endswith='.bam', coerce=True, nullable=False)
+    bam: Series[str] = pandera.Field(unique=True, str_matches=r'^[A-Za-z0-9/._-]+$', coerce=True, nullable=False)
+
+    @pandera.check('bam', name='file_suffix')
+    def file_suffix(cls, a):
+        return a.str.endswith(tuple(FILE_SUFFIXES[a.name]))
 
     # insist that the path to the bam exists
     # @pandera.check('bam_path')
@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+
+import os
+import json
+import time
+from pathlib import Path
+
+
+# what to do with a sample whose reads have already been submitted
+DUPLICATE_POLICIES = ['warn', 'skip']
+
+
+def default_history_file():
+    """Return where the upload history is kept, $GPAS_HISTORY_FILE or ~/.gpas-uploader/history.jsonl
+    """
+    if 'GPAS_HISTORY_FILE' in os.environ:
+        return Path(os.environ['GPAS_HISTORY_FILE'])
+    return Path.home() / '.gpas-uploader' / 'history.jsonl'
+
+
+class UploadHistory:
+    """
+    An index of every sample submitted to GPAS from this machine, by the MD5 of its
+    decontaminated reads.
+
+    The MD5 is the one sent to GPAS to create the sample's identifier, i.e. of the
+    only or first FASTQ. The index is a JSON lines file which is read into a dict,
+    so each lookup takes the same time however many samples have been submitted,
+    and each submission is appended to it. How fast the reads were uploaded is
+    recorded too, and the most recent speed is kept in upload_throughput.
+
+    Reads recompressed before they were uploaded are also indexed by the MD5 of
+    the FASTQ as readItAndKeep wrote it, so they are found again whether or not a
+    later run recompresses them.
+
+    Parameters
+    ----------
+    filename : pathlib.Path
+        the history file, created if need be (default default_history_file())
+    """
+
+    def __init__(self, filename=None):
+
+        self.filename = Path(filename) if filename is not None else default_history_file()
+        self.index = {}
+        self.before = {}
+        self.upload_throughput = None
+
+        if self.filename.exists():
+            with open(self.filename) as INPUT:
+                for line in INPUT:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._add(entry)
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, md5, md5_before=None):
+        """Return the earlier submission of reads with this MD5, or None.
+
+        Parameters
+        ----------
+        md5 : str
+            the MD5 of the reads as they are to be uploaded
+        md5_before : str
+            if they were recompressed, the MD5 before that (default None)
+
+        Returns
+        -------
+        dict
+            with md5, gpas_batch, gpas_sample_name, sample_name, upload_csv and submitted_on
+        """
+        for i in [md5, md5_before]:
+            if i is None:
+                continue
+            if i in self.index:
+                return self.index[i]
+            if i in self.before:
+                return self.before[i]
+        return None
+
+    def record(self, samples):
+        """Add submitted samples to the history.
+
+        Parameters
+        ----------
+        samples : list of dict
+            each with md5, gpas_batch, gpas_sample_name, sample_name and upload_csv,
+            and optionally md5_before and upload_throughput, in bytes per second
+        """
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(self.filename, 'a') as OUTPUT:
+            for i in samples:
+                previous = self.index.get(i['md5'])
+                if previous is not None and previous['gpas_batch'] == i['gpas_batch'] and previous['gpas_sample_name'] == i['gpas_sample_name']:
+                    continue
+                entry = dict(i, submitted_on=time.strftime('%Y-%m-%dT%H:%M:%S%z'))
+                OUTPUT.write(json.dumps(entry) + '\n')
+                self._add(entry)
+
+    def _add(self, entry):
+        self.index[entry['md5']] = entry
+        if entry.get('md5_before') is not None:
+            self.before[entry['md5_before']] = entry
+        if entry.get('upload_throughput') is not None:
+            self.upload_throughput = entry['upload_throughput']
@@ -0,0 +1,167 @@
+#! /usr/bin/env python3
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+
+# the stages each sample goes through, in order
+STAGES = ['converted', 'decontaminated', 'compressed', 'hashed', 'identified', 'uploaded']
+
+
+def fingerprint(filename):
+    """Return the size and modification time of a file, or None if it does not exist.
+
+    Parameters
+    ----------
+    filename : pathlib.Path
+
+    Returns
+    -------
+    list
+        [size in bytes, modification time in ns]
+    """
+    try:
+        stat = os.stat(filename)
+    except (OSError, TypeError):
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class UploadJournal:
+    """
+    An append-only record of how far each sample in a batch has got, so that an
+    interrupted run can carry on from where it stopped.
+
+    Each line of the journal is a JSON object recording that a sample completed a
+    stage (see STAGES), the values, e.g. paths, digests or GPAS identifiers, that
+    the stage produced and the size and modification time of the files it read and
+    wrote. Lines with no sample record the batch, e.g. its GPAS identifier. A stage
+    is only treated as complete if the sample's own BAM or FASTQ files are unchanged,
+    the files the stage wrote are still as they were, and the files it read are
+    either unchanged or have since been deleted (as intermediate files are).
+
+    Parameters
+    ----------
+    filename : pathlib.Path
+        the journal, a JSON lines file
+    resume : bool
+        if True, read what an earlier run recorded, otherwise start afresh (default False)
+    """
+
+    def __init__(self, filename, resume=False):
+
+        self.filename = Path(filename)
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.batch = {}
+
+        if resume and self.filename.exists():
+            with open(self.filename) as INPUT:
+                for line in INPUT:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be incomplete if the run was killed while writing it
+                        continue
+                    self._add(entry)
+            self.output = open(self.filename, 'a')
+        else:
+            self.output = open(self.filename, 'w')
+
+    def close(self):
+        with self.lock:
+            self.output.close()
+
+    def _add(self, entry):
+        if entry.get('sample') is None:
+            self.batch[entry['stage']] = entry['values']
+        else:
+            # redoing a stage makes what was recorded for it and any later stage out of date
+            stage = STAGES.index(entry['stage'])
+            entries = [i for i in self.samples.get(entry['sample'], []) if STAGES.index(i['stage']) < stage]
+            self.samples[entry['sample']] = entries + [entry]
+
+    def _write(self, entry):
+        with self.lock:
+            # numpy integers, e.g. run numbers, are not JSON serialisable
+            self.output.write(json.dumps(entry, default=lambda i: i.item() if hasattr(i, 'item') else str(i)) + '\n')
+            self.output.flush()
+            os.fsync(self.output.fileno())
+            self._add(entry)
+
+    def record(self, sample, stage, source, values, inputs=(), outputs=()):
+        """Record that a sample has completed a stage.
+
+        Parameters
+        ----------
+        sample : str
+            the name of the sample in the upload CSV
+        stage : str
+            one of STAGES
+        source : dict
+            the fingerprints of the sample's own BAM or FASTQ files, see fingerprint()
+        values : dict
+            what the stage produced, keyed by the name of the column in UploadBatch.df
+        inputs : list
+            the files the stage read
+        outputs : list
+            the files the stage wrote
+        """
+        self._write({'sample': sample,
+                     'stage': stage,
+                     'time': time.time(),
+                     'source': source,
+                     'values': values,
+                     'inputs': {str(i): fingerprint(i) for i in inputs},
+                     'outputs': {str(i): fingerprint(i) for i in outputs}})
+
+    def record_batch(self, stage, values):
+        """Record something about the batch as a whole, e.g. its GPAS identifier.
+        """
+        self._write({'sample': None, 'stage': stage, 'time': time.time(), 'values': values})
+
+    def completed(self, sample, stage, source):
+        """Return what a sample's stage produced if it has completed, otherwise None.
+
+        A later stage having completed counts, e.g. a sample that has been uploaded
+        needs neither converting nor decontaminating again.
+
+        Parameters
+        ----------
+        sample : str
+        stage : str
+            one of STAGES
+        source : dict
+            the fingerprints of the sample's own BAM or FASTQ files as they are now
+
+        Returns
+        -------
+        dict
+            the values recorded by all the stages completed, later ones taking precedence
+        """
+        with self.lock:
+            entries = list(self.samples.get(sample, []))
+
+        entries = [i for i in entries if i['source'] == source]
+
+        later = [i for i in entries if STAGES.index(i['stage']) >= STAGES.index(stage)]
+        if len(later) == 0:
+            return None
+
+        latest = later[-1]
+
+        for filename, recorded in latest['outputs'].items():
+            if fingerprint(filename) != recorded:
+                return None
+        for filename, recorded in latest['inputs'].items():
+            current = fingerprint(filename)
+            if current is not None and current != recorded:
+                return None
+
+        values = {}
+        for i in entries:
+            values.update(i['values'])
+        return values
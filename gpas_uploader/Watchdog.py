@@ -0,0 +1,149 @@
+#! /usr/bin/env python3
+
+import os
+import threading
+import subprocess
+import time
+
+import gpas_uploader
+
+
+class Watchdog:
+    """
+    Run the external tools for a sample, killing any that hang.
+
+    A tool is killed if it runs for longer than timeout seconds in total, or if it
+    goes stall_timeout seconds without reading any input or growing any of its
+    output files. A killed tool is run again up to retries times; a tool that
+    exits with an error is not, as a corrupt BAM will fail the same way twice.
+    Without any timeouts this simply waits for the tool to finish.
+
+    Parameters
+    ----------
+    timeout : float
+        seconds a tool may run for before it is killed (default None, no limit)
+    stall_timeout : float
+        seconds a tool may make no progress for before it is killed (default None, no limit)
+    retries : int
+        how many times to rerun a tool that has been killed (default 0)
+    poll : float
+        seconds between checks on the tool (default 1)
+    """
+
+    def __init__(self, timeout=None, stall_timeout=None, retries=0, poll=1):
+
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.retries = retries
+        self.poll = poll
+
+        self.lock = threading.Lock()
+        self.kills = 0
+
+    def run(self, start, outputs=(), tool='tool', sample=None):
+        """Run a tool, or a pipeline of tools, to completion.
+
+        Parameters
+        ----------
+        start : function
+            called with no arguments to start the tool, returning a list of
+            subprocess.Popen; the last is the one whose output is collected
+        outputs : list
+            the files the tool writes, whose growth counts as progress
+        tool : str
+            the name of the tool, for error messages
+        sample : str
+            the name of the sample, for error messages
+
+        Returns
+        -------
+        list of int
+            the return code of each process
+        bytes
+            the STDOUT of the last process, if it was piped
+        int
+            the number of attempts made
+        """
+        for attempt in range(1, self.retries + 2):
+
+            try:
+                processes = start()
+            except FileNotFoundError as err:
+                raise gpas_uploader.MissingToolError({tool: "%s not found: %s" % (tool, err.filename)})
+            reason, stdout = self._watch(processes, outputs)
+
+            if reason is None:
+                return [i.returncode for i in processes], stdout, attempt
+
+            with self.lock:
+                self.kills += 1
+
+        raise gpas_uploader.GpasError({tool: "%s was killed%s as it %s (%i attempt%s)" % (tool, '' if sample is None else ' on ' + str(sample), reason, attempt, '' if attempt == 1 else 's')})
+
+    def _watch(self, processes, outputs):
+        """Wait for the processes to finish, killing them if they hang.
+
+        Returns
+        -------
+        str
+            why the processes were killed, or None if they finished
+        bytes
+            the STDOUT of the last process
+        """
+        started = last_progress = time.monotonic()
+        progress = self._progress(processes, outputs)
+
+        while True:
+
+            try:
+                stdout, stderr = processes[-1].communicate(timeout=self.poll)
+                for i in processes[:-1]:
+                    i.wait()
+                return None, stdout
+            except subprocess.TimeoutExpired:
+                pass
+
+            now = time.monotonic()
+
+            current = self._progress(processes, outputs)
+            if current != progress:
+                progress = current
+                last_progress = now
+
+            if self.timeout is not None and now - started > self.timeout:
+                reason = 'ran for more than %g seconds' % self.timeout
+            elif self.stall_timeout is not None and now - last_progress > self.stall_timeout:
+                reason = 'made no progress for %g seconds' % self.stall_timeout
+            else:
+                continue
+
+            for i in processes:
+                i.kill()
+            for i in processes:
+                i.wait()
+                # rather than wait for the pipes to close, as anything the tool started may hold them open
+                for stream in [i.stdout, i.stderr]:
+                    if stream is not None:
+                        stream.close()
+
+            return reason, None
+
+    @staticmethod
+    def _progress(processes, outputs):
+        """Return something that changes whenever the tools read input or write output.
+
+        The bytes each process has read are taken from /proc where there is one.
+        """
+        progress = []
+        for i in processes:
+            try:
+                with open('/proc/%i/io' % i.pid) as INPUT:
+                    progress.append(INPUT.readline())
+            except OSError:
+                progress.append(None)
+        for i in outputs:
+            try:
+                progress.append(os.stat(i).st_size)
+            except OSError:
+                progress.append(None)
+        return progress
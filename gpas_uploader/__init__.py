@@ -9,6 +9,22 @@ from .BaseCheckSchema import *
 from .UploadCheckSchema import *
 from .PandasApplyFunctions import *
 from .Misc import *
+from .Bgzf import *
+from .MultiFasta import *
+from .ArchiveSink import *
+from .DownloadVerifier import *
+from .HashingReader import *
+from .BatchState import *
+from .Tracing import *
+from .Profiling import *
+from .Metrics import *
+from .ResourceGovernor import *
+from .ScratchSpace import *
+from .Watchdog import *
+from .UploadJournal import *
+from .UploadHistory import *
+from .FastqStream import *
+from .Recompression import *
 
 '''
 Use of semantic versioning, MAJOR.MINOR.MAINTAINANCE where
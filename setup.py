@@ -15,7 +15,6 @@ setup(
     install_requires=[
         'pandas',
         'pandera',
-        'pandarallel',
         'pycountry',
         'requests',
         'tqdm'
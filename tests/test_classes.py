@@ -1,6 +1,9 @@
 import pytest, pathlib
+import time
+import requests
 
 import gpas_uploader
+from benchmarks.local_server import LocalServer
 
 def test_nonASCII_upload_csv_fails():
 
@@ -1039,3 +1042,782 @@ def test_illumina_fastq_fail_2():
         ]
       }
     }
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, content=b''):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = content
+        self.text = content.decode(errors='replace')
+        self.headers = {'Content-Length': str(len(content))}
+
+    def iter_content(self, chunk_size=1024):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i+chunk_size]
+
+
+def test_download_watch(tmp_path, monkeypatch):
+
+    token = tmp_path / 'token.tok'
+    token.write_text('{"access_token": "abc"}')
+
+    mapping = tmp_path / 'sample_names.csv'
+    mapping.write_text('gpas_sample_name\nsample1\nsample2\n')
+
+    # sample1 is released straight away, sample2 only after being polled twice
+    statuses = {'sample1': ['Released'], 'sample2': ['Uploaded', 'Unreleased', 'Released']}
+    calls = []
+
+    def fake_get(url, headers=None, **kwargs):
+        calls.append(url)
+        if '/get_sample_detail/' in url:
+            sample = url.split('/')[-1]
+            status = statuses[sample].pop(0) if len(statuses[sample]) > 1 else statuses[sample][0]
+            return FakeResponse(200, bytes('[{"status": "' + status + '"}]', encoding='utf8'))
+        return FakeResponse(200, b'ACGT')
+
+    monkeypatch.setattr(requests, 'get', fake_get)
+
+    a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token)
+
+    assert a.watch(filetypes=['vcf'], outdir=tmp_path, interval=0, max_interval=0)
+
+    assert list(a.df.status) == ['Released', 'Released']
+    assert all(a.df.vcf_downloaded)
+    assert (tmp_path / 'sample2.vcf').read_bytes() == b'ACGT'
+
+    # sample1 is only polled once as it was finished after the first poll
+    assert len([i for i in calls if i.endswith('get_sample_detail/sample1')]) == 1
+    assert len([i for i in calls if i.endswith('get_output/sample1/vcf')]) == 1
+
+
+def test_download_watch_timeout(tmp_path, monkeypatch):
+
+    token = tmp_path / 'token.tok'
+    token.write_text('{"access_token": "abc"}')
+
+    mapping = tmp_path / 'sample_names.csv'
+    mapping.write_text('gpas_sample_name\nsample1\n')
+
+    monkeypatch.setattr(requests, 'get', lambda url, headers=None, **kwargs: FakeResponse(200, b'[{"status": "Uploaded"}]'))
+
+    a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token)
+
+    assert not a.watch(filetypes=['fasta'], outdir=tmp_path, interval=0.01, max_interval=0.01, timeout=0.05)
+
+    assert list(a.df.status) == ['Uploaded']
+
+
+def test_download_watch_gives_up(tmp_path, monkeypatch):
+
+    token = tmp_path / 'token.tok'
+    token.write_text('{"access_token": "abc"}')
+
+    mapping = tmp_path / 'sample_names.csv'
+    mapping.write_text('gpas_sample_name\nsample1\nsample2\n')
+
+    calls = []
+
+    # sample1 is released but its file can never be downloaded
+    def fake_get(url, headers=None, **kwargs):
+        calls.append(url)
+        if '/get_sample_detail/' in url:
+            return FakeResponse(200, b'[{"status": "Released"}]')
+        if url.endswith('sample1/vcf'):
+            return FakeResponse(500)
+        return FakeResponse(200, b'ACGT')
+
+    monkeypatch.setattr(requests, 'get', fake_get)
+
+    a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token)
+
+    start = time.monotonic()
+    assert not a.watch(filetypes=['vcf'], outdir=tmp_path, interval=0.01, max_interval=0.01, max_failures=3)
+
+    assert a.download_failures == ['sample1']
+    assert list(a.df.vcf_downloaded) == [False, True]
+    assert len([i for i in calls if i.endswith('get_output/sample1/vcf')]) == 3
+    assert len([i for i in calls if i.endswith('get_output/sample2/vcf')]) == 1
+
+    # there is no wait after the last poll
+    assert time.monotonic() - start < 1
+
+    # nor once every sample is finished, however long the interval
+    mapping.write_text('gpas_sample_name\nsample2\n')
+    a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token)
+    start = time.monotonic()
+    assert a.watch(filetypes=['vcf'], outdir=tmp_path, interval=60, max_interval=60)
+    assert time.monotonic() - start < 1
+
+
+def test_download_watch_poll_fails(tmp_path, monkeypatch):
+
+    token = tmp_path / 'token.tok'
+    token.write_text('{"access_token": "abc"}')
+
+    mapping = tmp_path / 'sample_names.csv'
+    mapping.write_text('gpas_sample_name\nsample1\nsample2\n')
+
+    # the second poll of sample2 fails outright and the third gets an HTML error page
+    polls = {'sample1': 0, 'sample2': 0}
+
+    def fake_get(url, headers=None, **kwargs):
+        if '/get_sample_detail/' in url:
+            sample = url.split('/')[-1]
+            polls[sample] += 1
+            if sample == 'sample2' and polls[sample] == 2:
+                raise requests.exceptions.ConnectionError('connection reset')
+            elif sample == 'sample2' and polls[sample] == 3:
+                return FakeResponse(502, b'<html>Bad Gateway</html>')
+            elif sample == 'sample2' and polls[sample] == 1:
+                return FakeResponse(200, b'[{"status": "Uploaded"}]')
+            return FakeResponse(200, b'[{"status": "Released"}]')
+        return FakeResponse(200, b'ACGT')
+
+    monkeypatch.setattr(requests, 'get', fake_get)
+
+    a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token)
+
+    assert a.watch(filetypes=['vcf'], outdir=tmp_path, interval=0, max_interval=0)
+    assert list(a.df.status) == ['Released', 'Released']
+    assert all(a.df.vcf_downloaded)
+    assert polls == {'sample1': 1, 'sample2': 4}
+
+    # a one-off status check keeps the previous status of a sample that cannot be polled
+    monkeypatch.setattr(requests, 'get', lambda url, headers=None, **kwargs: FakeResponse(502, b'<html>Bad Gateway</html>'))
+    a.get_status()
+    assert list(a.df.status) == ['Released', 'Released']
+
+    b = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token)
+    b.get_status()
+    assert list(b.df.status) == ['Unknown', 'Unknown']
+
+
+def test_download_verification_fails(tmp_path, monkeypatch):
+
+    import gzip
+
+    token = tmp_path / 'token.tok'
+    token.write_text('{"access_token": "abc"}')
+
+    mapping = tmp_path / 'sample_names.csv'
+    mapping.write_text('gpas_sample_name\nsample1\nsample2\n')
+
+    fasta = gzip.compress(b'>sample\nACGT\n')
+
+    def fake_get(url, headers=None, **kwargs):
+        if '/get_sample_detail/' in url:
+            return FakeResponse(200, b'[{"status": "Released"}]')
+        # the download of sample2 is truncated
+        elif 'sample2' in url:
+            return FakeResponse(200, fasta[:-4])
+        return FakeResponse(200, fasta)
+
+    monkeypatch.setattr(requests, 'get', fake_get)
+
+    a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token)
+    a.get_status()
+    a.download(filetype='fasta', outdir=tmp_path)
+
+    assert list(a.df.fasta_downloaded) == [True, False]
+    assert list(a.df.fasta_verified) == ['verified', 'failed']
+    assert (tmp_path / 'sample1.fasta.gz').is_file()
+    assert not (tmp_path / 'sample2.fasta.gz').is_file()
+
+
+def test_download_fasta_not_gzipped(tmp_path, monkeypatch):
+
+    import gzip
+
+    token = tmp_path / 'token.tok'
+    token.write_text('{"access_token": "abc"}')
+
+    mapping = tmp_path / 'sample_names.csv'
+    mapping.write_text('local_batch,local_run_number,local_sample_name,gpas_batch,gpas_run_number,gpas_sample_name\nb1,1,local1,B1,1,sample1\nb1,1,local2,B1,1,sample2\n')
+
+    def fake_get(url, headers=None, **kwargs):
+        if '/get_sample_detail/' in url:
+            return FakeResponse(200, b'[{"status": "Released"}]')
+        # sample2 is sent uncompressed, so cannot be renamed or added to the multi-FASTA
+        elif 'sample2' in url:
+            return FakeResponse(200, b'>sample2\nACGT\n')
+        return FakeResponse(200, gzip.compress(b'>sample1 consensus\nACGT\n'))
+
+    monkeypatch.setattr(requests, 'get', fake_get)
+
+    for rename, multi_fasta in [(True, None), (False, tmp_path / 'consensus.fasta.gz')]:
+        a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token)
+        a.get_status()
+        a.download(filetype='fasta', outdir=tmp_path, rename=rename, multi_fasta=multi_fasta)
+        assert list(a.df.fasta_downloaded) == [True, False]
+        assert list(a.df.fasta_verified) == ['verified', 'failed']
+
+    assert gzip.decompress((tmp_path / 'local1.fasta.gz').read_bytes()) == b'>local1|sample1\nACGT\n'
+    assert not (tmp_path / 'local2.fasta.gz').exists()
+
+    # without renaming the multi-FASTA keeps the header as downloaded
+    assert gzip.decompress((tmp_path / 'consensus.fasta.gz').read_bytes()) == b'>sample1 consensus\nACGT\n'
+
+
+def test_download_connection_dropped(tmp_path, monkeypatch):
+
+    import threading
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    class TruncatingHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if '/get_sample_detail/' in self.path:
+                body = b'[{"status": "Released"}]'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                # promise more than is sent, then drop the connection
+                self.send_response(200)
+                self.send_header('Content-Length', '100000')
+                self.end_headers()
+                self.wfile.write(b'##fileformat=VCFv4.2\n' * 100)
+                self.wfile.flush()
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), TruncatingHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        monkeypatch.setenv('GPAS_LOCAL_URL', 'http://127.0.0.1:%i' % server.server_address[1])
+
+        token = tmp_path / 'token.tok'
+        token.write_text('{"access_token": "abc"}')
+
+        mapping = tmp_path / 'sample_names.csv'
+        mapping.write_text('gpas_sample_name\nsample1\n')
+
+        a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token, environment='local')
+        a.get_status()
+        a.download(filetype='vcf', outdir=tmp_path)
+
+        assert list(a.df.vcf_downloaded) == [False]
+        assert list(a.df.vcf_verified) == ['failed']
+        assert not (tmp_path / 'sample1.vcf').exists()
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize('suffix', ['.parquet', '.arrow'])
+def test_download_state_columnar(tmp_path, monkeypatch, suffix):
+
+    pytest.importorskip('pyarrow')
+
+    token = tmp_path / 'token.tok'
+    token.write_text('{"access_token": "abc"}')
+
+    mapping = tmp_path / 'sample_names.csv'
+    mapping.write_text('local_batch,local_run_number,local_sample_name,gpas_batch,gpas_run_number,gpas_sample_name\nrun1,,sample1,B-1,,guid1\nrun1,run1.2,sample2,B-1,1,guid2\n')
+
+    monkeypatch.setattr(requests, 'get', lambda url, headers=None, **kwargs: FakeResponse(200, b'[{"status": "Released"}]'))
+
+    a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token)
+    a.get_status()
+    a.df['vcf_downloaded'] = [True, False]
+
+    gpas_uploader.write_batch_state(a.df, tmp_path / ('state' + suffix))
+
+    # the repetitive columns are stored as categoricals
+    df = gpas_uploader.read_batch_state(tmp_path / ('state' + suffix))
+    assert df.status.dtype == 'category'
+    assert df.local_batch.dtype == 'category'
+
+    # and the saved state can be loaded straight back in
+    b = gpas_uploader.DownloadBatch(mapping_csv=tmp_path / ('state' + suffix), token_file=token)
+    assert b.mapping_csv_type == 'wide'
+    assert list(b.df.vcf_downloaded) == [True, False]
+    assert list(b.df.gpas_sample_name) == ['guid1', 'guid2']
+
+
+def test_download_state_csv(tmp_path, monkeypatch):
+
+    token = tmp_path / 'token.tok'
+    token.write_text('{"access_token": "abc"}')
+
+    mapping = tmp_path / 'sample_names.csv'
+    mapping.write_text('local_batch,local_run_number,local_sample_name,gpas_batch,gpas_run_number,gpas_sample_name\nrun1,1,sample1,B-1,1,guid1\nrun1,2,sample2,B-1,1,guid2\n')
+
+    monkeypatch.setattr(requests, 'get', lambda url, headers=None, **kwargs: FakeResponse(200, b'[{"status": "Released"}]'))
+
+    a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token)
+    a.get_status()
+    a.df['vcf_downloaded'] = [True, False]
+
+    # the saved CSV can be loaded straight back in
+    gpas_uploader.write_batch_state(a.df, tmp_path / 'state.csv')
+    assert open(tmp_path / 'state.csv').readline().startswith('local_batch,')
+    b = gpas_uploader.DownloadBatch(mapping_csv=tmp_path / 'state.csv', token_file=token)
+    assert b.mapping_csv_type == 'wide'
+    assert list(b.df.vcf_downloaded) == [True, False]
+
+    # as can one saved, with its index, by an earlier version
+    a.df.to_csv(tmp_path / 'old.csv')
+    b = gpas_uploader.DownloadBatch(mapping_csv=tmp_path / 'old.csv', token_file=token)
+    assert b.mapping_csv_type == 'wide'
+    assert list(b.df.gpas_sample_name) == ['guid1', 'guid2']
+
+
+def test_local_server(tmp_path, monkeypatch):
+
+    with LocalServer(token='abc') as server:
+
+        monkeypatch.setenv('GPAS_LOCAL_URL', server.url)
+        token = server.write_token(tmp_path / 'token.json')
+
+        # the user details and permitted tags come from userOrgDtls
+        a = gpas_uploader.UploadBatch('tests/files/illumina-fastq-upload-csv-pass-1.csv', token_file=token, environment='local')
+        assert a.user_name == server.user_name
+        assert a.permitted_tags == ['site0', 'site1']
+
+        par = a._call_ords_PAR()
+        assert par.split('/')[-3] == server.bucket
+
+        r = requests.put(par + 'B-1/sample1.reads_1.fastq.gz', b'ACGT')
+        assert r.ok
+        assert server.objects['B-1/sample1.reads_1.fastq.gz']['size'] == 4
+        assert requests.head(par + 'B-1/sample1.reads_1.fastq.gz').headers['Content-Length'] == '4'
+
+        mapping = tmp_path / 'sample_names.csv'
+        mapping.write_text('gpas_sample_name\nguid1\nguid2\n')
+        server.statuses['guid2'] = 'Uploaded'
+
+        b = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token, environment='local')
+        b.get_status()
+        assert list(b.df.status) == ['Released', 'Uploaded']
+        b.download(filetype='fasta', outdir=tmp_path)
+        assert list(b.df.fasta_downloaded) == [True, False]
+        assert b.df.fasta_verified[0] == 'verified'
+
+        # a wrong token is refused
+        token.write_text('{"access_token": "xyz"}')
+        c = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token, environment='local')
+        c.get_status()
+        assert list(c.df.status) == ['Authorization required'] * 2
+
+
+def test_upload_file(tmp_path, monkeypatch):
+
+    import hashlib
+    import pandas
+
+    fastq = tmp_path / 'sample1.reads.fastq.gz'
+    fastq.write_bytes(b'ACGT' * 10000)
+    md5 = hashlib.md5(fastq.read_bytes()).hexdigest()
+
+    with LocalServer(token='abc') as server:
+
+        monkeypatch.setenv('GPAS_LOCAL_URL', server.url)
+        token = server.write_token(tmp_path / 'token.json')
+        a = gpas_uploader.UploadBatch('tests/files/illumina-fastq-upload-csv-pass-1.csv', token_file=token, environment='local')
+        url = a._call_ords_PAR() + 'B-1/'
+
+        # the file is sent with its length and MD5 rather than chunked
+        r, md5_ok = gpas_uploader.upload_file(url + 'sample1.reads.fastq.gz', fastq, md5, {})
+        assert r.ok and md5_ok
+        assert r.request.headers['Content-Length'] == '40000'
+        assert server.objects['B-1/sample1.reads.fastq.gz'] == {'size': 40000, 'md5': md5}
+
+        row = pandas.Series({'r_uri': str(fastq), 'r_md5': md5, 'uploaded': False}, name='sample2')
+        assert gpas_uploader.upload_fastq_unpaired(row, url, {})
+
+        # a file that has changed since it was hashed is refused by the bucket
+        fastq.write_bytes(b'ACGA' * 10000)
+        assert not gpas_uploader.upload_fastq_unpaired(row, url, {})
+        assert 'B-1/sample2.reads.fastq.gz' in server.objects
+        r, md5_ok = gpas_uploader.upload_file(url + 'sample3.reads.fastq.gz', fastq, md5, {})
+        assert r.status_code == 400 and not md5_ok
+        assert 'B-1/sample3.reads.fastq.gz' not in server.objects
+
+        # an object already in the bucket is only taken as the file if its size and MD5 match
+        fastq.write_bytes(b'ACGT' * 10000)
+        assert gpas_uploader.uploaded_object_matches(url + 'sample1.reads.fastq.gz', fastq, md5)
+        assert not gpas_uploader.uploaded_object_matches(url + 'sample1.reads.fastq.gz', fastq, '0' * 32)
+        assert not gpas_uploader.uploaded_object_matches(url + 'sample3.reads.fastq.gz', fastq, md5)
+        fastq.write_bytes(b'ACGT' * 10001)
+        assert not gpas_uploader.uploaded_object_matches(url + 'sample1.reads.fastq.gz', fastq, md5)
+
+
+def test_local_server_errors(tmp_path, monkeypatch):
+
+    with LocalServer(error_rate=1, error_endpoints=['get_output']) as server:
+
+        monkeypatch.setenv('GPAS_LOCAL_URL', server.url)
+        token = server.write_token(tmp_path / 'token.json')
+
+        mapping = tmp_path / 'sample_names.csv'
+        mapping.write_text('gpas_sample_name\nguid1\n')
+
+        a = gpas_uploader.DownloadBatch(mapping_csv=mapping, token_file=token, environment='local')
+        a.get_status()
+        a.download(filetype='vcf', outdir=tmp_path)
+
+        assert list(a.df.status) == ['Released']
+        assert list(a.df.vcf_downloaded) == [False]
+        assert server.failures['get_output'] == 1
+        assert server.requests['get_sample_detail'] == 1
+
+    # uploaded objects are kept under store_dir, and cannot be written outside it
+    import http.client
+    from urllib.parse import urlparse
+
+    with LocalServer(store_dir=tmp_path / 'bucket') as server:
+        par = urlparse(server.par_for(server.url))
+        for name, status in [('B-1/sample1.reads.fastq.gz', 200), ('../escaped.txt', 400), ('B-1/../../escaped.txt', 400)]:
+            connection = http.client.HTTPConnection(par.hostname, par.port)
+            connection.request('PUT', par.path + name, body=b'ACGT')
+            assert connection.getresponse().status == status
+            connection.close()
+
+    assert (tmp_path / 'bucket' / 'B-1' / 'sample1.reads.fastq.gz').read_bytes() == b'ACGT'
+    assert not (tmp_path / 'escaped.txt').exists()
+
+
+def test_resource_governor(tmp_path):
+
+    import threading, time
+    import pandas
+
+    assert gpas_uploader.machine_cpus() >= 1
+
+    df = pandas.DataFrame({'file': ['a', 'b', 'c', 'd', 'e', 'f']})
+    for i in df.file:
+        (tmp_path / i).write_bytes(b'x' * 1000)
+
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def job(row, suffix):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return pandas.Series([row.file + suffix, len(row.file)])
+
+    # CPUs limit the number of jobs at once
+    governor = gpas_uploader.ResourceGovernor(cpus=2, memory=1e9)
+    result = governor.apply(df, job, cost=lambda row: governor.job_cost('hash', [tmp_path / row.file]), args=('.fastq',))
+    assert list(result[0]) == [i + '.fastq' for i in df.file]
+    assert governor.peak_running == running[1] == 2
+    assert governor.in_use == {'cpus': 0, 'memory': 0, 'disk': 0}
+
+    # as does memory, and a job bigger than the governor still runs on its own
+    governor = gpas_uploader.ResourceGovernor(cpus=8, memory=1e9, costs={'samtools_sort': {'memory': 600e6}})
+    governor.apply(df, job, cost=lambda row: governor.job_cost('samtools_sort', [tmp_path / row.file]), args=('',))
+    assert governor.peak_running == 1
+    assert governor.job_cost('samtools_sort')['memory'] == 600e6
+
+    # the biggest jobs are started first and the makespan is reported
+    for i, size in zip(df.file, [10, 5000, 20, 3000, 1, 4000]):
+        (tmp_path / i).write_bytes(b'x' * size)
+    started = []
+    def record(row):
+        started.append(row.file)
+        return row.file
+    governor = gpas_uploader.ResourceGovernor(cpus=1, memory=1e9)
+    result = governor.apply(df, record, cost=lambda row: governor.job_cost('hash', [tmp_path / row.file]))
+    assert started == ['b', 'f', 'd', 'c', 'a', 'e']
+    assert list(result) == list(df.file)
+    assert governor.last_schedule['jobs'] == 6 and governor.last_schedule['actual_makespan'] >= 0
+
+    # replaying a schedule on 2 CPUs: one long job listed last is the straggler
+    costs = [governor.job_cost('hash') for i in range(5)]
+    governor = gpas_uploader.ResourceGovernor(cpus=2, memory=1e9)
+    assert governor.simulate(costs, [1, 1, 1, 1, 4]) == 6
+    assert governor.simulate(costs, [4, 1, 1, 1, 1]) == 4
+
+    # a job that cannot fit on the disk fails
+    governor = gpas_uploader.ResourceGovernor(cpus=2, disk_reserve=1e18)
+    with pytest.raises(gpas_uploader.GpasError):
+        governor.apply(df, job, cost=lambda row: governor.job_cost('readItAndKeep', [tmp_path / row.file], tmp_path), args=('',))
+
+
+def test_scratch_space(tmp_path):
+
+    with gpas_uploader.ScratchSpace(tmp_path, reserve=0) as scratch:
+
+        assert scratch.directory.parent == tmp_path.resolve()
+
+        converted = scratch.path('converted')
+        for i in ['a_1.fastq.gz', 'a_2.fastq.gz', 'b_1.fastq.gz']:
+            (converted / i).write_bytes(b'x' * 100)
+        kept = tmp_path / 'input.fastq.gz'
+        kept.write_bytes(b'x' * 1000)
+
+        # scratch inputs are deleted as they are used, so only the largest sample counts
+        assert scratch.estimate([[converted / 'a_1.fastq.gz', converted / 'a_2.fastq.gz'], [converted / 'b_1.fastq.gz']], 1.0, converted) == 200
+        assert scratch.estimate([[kept], [converted / 'b_1.fastq.gz']], 2.0, converted) == 2200
+
+        with pytest.raises(gpas_uploader.GpasError):
+            scratch.check(1e18, converted)
+
+        # only files in the scratch folder are ever deleted
+        scratch.release([converted / 'a_1.fastq.gz', converted / 'a_2.fastq.gz', kept])
+        assert sorted(i.name for i in converted.iterdir()) == ['b_1.fastq.gz']
+        assert kept.exists()
+        assert scratch.files_deleted == 2 and scratch.bytes_freed == 200
+
+    assert not scratch.directory.exists()
+
+    # a named folder is reused by a resumed run, and emptied otherwise
+    scratch = gpas_uploader.ScratchSpace(tmp_path, name='batch')
+    (scratch.path('decontaminated') / 'a.reads.fastq.gz').write_bytes(b'x')
+    assert gpas_uploader.ScratchSpace(tmp_path, name='batch', resume=True).directory == tmp_path.resolve() / 'batch'
+    assert (tmp_path / 'batch' / 'decontaminated' / 'a.reads.fastq.gz').exists()
+    gpas_uploader.ScratchSpace(tmp_path, name='batch')
+    assert list((tmp_path / 'batch').iterdir()) == []
+
+
+def test_missing_samtools(tmp_path, monkeypatch):
+
+    import csv, shutil, sys
+
+    shutil.copy('tests/files/nanopore-bam-upload-csv-pass-1.csv', tmp_path / 'upload.csv')
+    with open(tmp_path / 'upload.csv') as f:
+        for row in csv.DictReader(f):
+            shutil.copy('tests/files/' + row['bam'], tmp_path / row['bam'])
+
+    (tmp_path / 'bin').mkdir()
+    monkeypatch.setenv('PATH', str(tmp_path / 'bin'))
+    monkeypatch.chdir(tmp_path)
+
+    # without samtools the whole batch fails, rather than each sample in turn
+    for run_parallel in [False, True]:
+        a = gpas_uploader.UploadBatch(tmp_path / 'upload.csv', run_parallel=run_parallel)
+        with pytest.raises(gpas_uploader.MissingToolError, match='samtools not found'):
+            a.validate()
+
+    # whereas a samtools that fails on every sample fails each of them
+    samtools = tmp_path / 'bin' / 'samtools'
+    samtools.write_text('#!%s\nimport sys\nsys.exit(1)\n' % sys.executable)
+    samtools.chmod(0o755)
+    a = gpas_uploader.UploadBatch(tmp_path / 'upload.csv')
+    a.validate()
+    assert not a.valid
+    assert len(a.validation_errors) == len(a.df)
+
+
+def test_resume_identifiers(tmp_path):
+
+    import shutil
+
+    shutil.copy('tests/files/nanopore-fastq-upload-csv-pass-1.csv', tmp_path / 'upload.csv')
+    shutil.copy('tests/files/unpaired1.fastq.gz', tmp_path / 'unpaired1.fastq.gz')
+
+    journal = gpas_uploader.UploadJournal(tmp_path / 'upload.journal.jsonl')
+    a = gpas_uploader.UploadBatch(tmp_path / 'upload.csv', journal=journal)
+    a.validate()
+    assert a.valid
+
+    # identifiers given by an earlier run made offline, as decontaminate does without a token
+    reads = tmp_path / 'guid1.reads.fastq.gz'
+    reads.write_bytes(b'x' * 100)
+    journal.record_batch('identified', {'gpas_batch': 'B-1', 'uploaded_on': '2022-02-01', 'connect_to_oci': False, 'environment': 'prod'})
+    journal.record('sample1', 'identified', a.sources.get('sample1'), {'gpas_batch': 'B-1', 'gpas_sample_name': 'guid1', 'gpas_run_number': 1, 'r_uri': reads.name}, outputs=[reads])
+
+    assert a._resume_identifiers()
+    assert a.gpas_batch == 'B-1' and list(a.df.gpas_sample_name) == ['guid1']
+
+    # are not GPAS's, so are not reused when submitting, nor in another environment
+    a.connect_to_oci = True
+    assert not a._resume_identifiers()
+    a.connect_to_oci, a.environment = False, 'dev'
+    assert not a._resume_identifiers()
+
+
+def test_watchdog(tmp_path):
+
+    import subprocess, sys
+
+    def start(code):
+        return lambda: [subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE)]
+
+    watchdog = gpas_uploader.Watchdog(stall_timeout=1, retries=1, poll=0.1)
+
+    assert watchdog.run(start("print('done')")) == ([0], b'done\n', 1)
+
+    # a tool that keeps writing is making progress, however long it takes
+    output = tmp_path / 'output.txt'
+    returncodes, stdout, attempts = watchdog.run(start("import time\nfor i in range(20):\n    open(%r, 'a').write('x')\n    time.sleep(0.1)" % str(output)), [output])
+    assert returncodes == [0] and output.stat().st_size == 20
+
+    # a tool that hangs is killed, then run again once
+    with pytest.raises(gpas_uploader.GpasError):
+        watchdog.run(start("import time; time.sleep(60)"), tool='samtools', sample='sample1')
+    assert watchdog.kills == 2
+
+    with pytest.raises(gpas_uploader.GpasError):
+        gpas_uploader.Watchdog(timeout=0.5, poll=0.1).run(start("import time; time.sleep(60)"))
+
+
+def test_decontamination_sample_fails(tmp_path, monkeypatch):
+
+    import shutil
+
+    with open('tests/files/nanopore-fastq-upload-csv-pass-1.csv') as INPUT:
+        header, row = INPUT.read().splitlines()[:2]
+    with open(tmp_path / 'upload.csv', 'w') as OUTPUT:
+        OUTPUT.write(header + '\n' + row + '\n' + row.replace('sample1', 'sample2').replace('unpaired1', 'unpaired2') + '\n')
+    # different reads, as two samples with the same reads would not validate
+    shutil.copy('tests/files/unpaired1.fastq.gz', tmp_path / 'unpaired1.fastq.gz')
+    shutil.copy('tests/files/unpaired3.fastq.gz', tmp_path / 'unpaired2.fastq.gz')
+
+    def remove_pii(row, *args):
+        if row.name == 'sample2':
+            raise gpas_uploader.GpasError({"decontamination": "read removal tool failed on %s" % row.fastq})
+        return str(tmp_path / row.fastq)
+
+    monkeypatch.setattr(gpas_uploader, 'remove_pii_unpaired_reads', remove_pii)
+
+    a = gpas_uploader.UploadBatch(tmp_path / 'upload.csv')
+    a.validate()
+    assert a.valid
+
+    a.decontaminate(outdir=tmp_path)
+
+    # the failure is recorded against the one sample and the other is still processed
+    assert not a.decontamination_successful
+    assert a.decontamination_json == {"submission": {"status": "failure", "samples": [{"sample": "sample2", "error": "read removal tool failed on unpaired2.fastq.gz"}]}}
+    assert a.failed_samples == {'sample2'}
+    assert a.df.set_index('sample_name').r_md5.notna().tolist() == [True, False]
+
+
+def test_upload_journal(tmp_path):
+
+    bam = tmp_path / 'sample1.bam'
+    bam.write_bytes(b'x' * 100)
+    fastq = tmp_path / 'sample1.fastq.gz'
+    fastq.write_bytes(b'y' * 200)
+    source = {'sample1.bam': gpas_uploader.fingerprint(bam)}
+
+    journal = gpas_uploader.UploadJournal(tmp_path / 'upload.journal.jsonl')
+    journal.record('sample1', 'converted', source, {'fastq': str(fastq)}, [bam], [fastq])
+    journal.record('sample1', 'hashed', source, {'r_md5': 'abc'}, outputs=[fastq])
+    journal.record_batch('identified', {'gpas_batch': 'B-1'})
+    journal.close()
+
+    # a run killed while writing leaves an incomplete last line
+    with open(tmp_path / 'upload.journal.jsonl', 'a') as OUTPUT:
+        OUTPUT.write('{"sample": "sample1", "sta')
+
+    journal = gpas_uploader.UploadJournal(tmp_path / 'upload.journal.jsonl', resume=True)
+    assert journal.batch == {'identified': {'gpas_batch': 'B-1'}}
+
+    # a later stage completing counts, and the values of every stage are returned
+    assert journal.completed('sample1', 'converted', source) == {'fastq': str(fastq), 'r_md5': 'abc'}
+    assert journal.completed('sample1', 'uploaded', source) is None
+
+    # not if the sample's own files have changed..
+    assert journal.completed('sample1', 'converted', {'sample1.bam': [1, 2]}) is None
+
+    # ..or what the stage wrote has
+    fastq.write_bytes(b'y' * 201)
+    assert journal.completed('sample1', 'hashed', source) is None
+
+    # redoing a stage discards what was recorded for the later ones
+    journal.record('sample1', 'converted', source, {'fastq': str(fastq)}, [bam], [fastq])
+    assert journal.completed('sample1', 'converted', source) == {'fastq': str(fastq)}
+    journal.close()
+
+    # without resume the journal starts afresh
+    journal = gpas_uploader.UploadJournal(tmp_path / 'upload.journal.jsonl')
+    assert journal.completed('sample1', 'converted', source) is None
+    journal.close()
+
+
+def test_upload_history(tmp_path):
+
+    history = gpas_uploader.UploadHistory(tmp_path / 'history' / 'history.jsonl')
+    assert len(history) == 0 and history.lookup('abc') is None
+
+    history.record([{'md5': 'abc', 'gpas_batch': 'B-1', 'gpas_sample_name': 'guid1', 'sample_name': 'sample1', 'upload_csv': 'upload.csv'},
+                    {'md5': 'def', 'gpas_batch': 'B-1', 'gpas_sample_name': 'guid2', 'sample_name': 'sample2', 'upload_csv': 'upload.csv'}])
+
+    # recording the same submission again adds nothing
+    history.record([{'md5': 'abc', 'gpas_batch': 'B-1', 'gpas_sample_name': 'guid1', 'sample_name': 'sample1', 'upload_csv': 'upload.csv'}])
+
+    history = gpas_uploader.UploadHistory(tmp_path / 'history' / 'history.jsonl')
+    assert len(history) == 2
+    assert history.lookup('abc')['gpas_sample_name'] == 'guid1'
+    assert len(open(tmp_path / 'history' / 'history.jsonl').readlines()) == 2
+
+    # a resubmission replaces the earlier one
+    history.record([{'md5': 'abc', 'gpas_batch': 'B-2', 'gpas_sample_name': 'guid3', 'sample_name': 'sample1', 'upload_csv': 'upload2.csv', 'upload_throughput': 2e6}])
+    history = gpas_uploader.UploadHistory(tmp_path / 'history' / 'history.jsonl')
+    assert history.lookup('abc')['gpas_batch'] == 'B-2'
+
+    # the speed of the last upload is kept, for deciding whether to recompress the reads
+    assert history.upload_throughput == 2e6
+
+    # recompressed reads are found by their MD5 before recompression too
+    history.record([{'md5': 'bgzf', 'md5_before': 'xyz', 'gpas_batch': 'B-3', 'gpas_sample_name': 'guid4', 'sample_name': 'sample3', 'upload_csv': 'upload3.csv'}])
+    history = gpas_uploader.UploadHistory(tmp_path / 'history' / 'history.jsonl')
+    assert history.lookup('xyz')['gpas_sample_name'] == 'guid4'
+    assert history.lookup('bgzf2', 'xyz')['gpas_sample_name'] == 'guid4'
+    assert history.lookup('bgzf2', 'ghi') is None
+
+def test_check_fastqs(tmp_path):
+
+    import shutil
+
+    shutil.copy('tests/files/nanopore-fastq-upload-csv-pass-1.csv', tmp_path / 'upload.csv')
+    shutil.copy('tests/files/unpaired1.fastq.gz', tmp_path / 'unpaired1.fastq.gz')
+
+    for run_parallel in [False, True]:
+        a = gpas_uploader.UploadBatch(tmp_path / 'upload.csv', run_parallel=run_parallel, check_fastqs=True)
+        a.validate()
+        assert a.valid
+        assert a.read_counts.loc['sample1'].to_dict() == {'reads': 1819, 'bases': 1012533}
+
+    # a truncated FASTQ is found when validating, but only if asked to look
+    data = open('tests/files/unpaired1.fastq.gz', 'rb').read()
+    with open(tmp_path / 'unpaired1.fastq.gz', 'wb') as OUTPUT:
+        OUTPUT.write(data[:len(data) // 2])
+
+    a = gpas_uploader.UploadBatch(tmp_path / 'upload.csv')
+    a.validate()
+    assert a.valid
+
+    a = gpas_uploader.UploadBatch(tmp_path / 'upload.csv', check_fastqs=True)
+    a.validate()
+    assert not a.valid
+    assert 'corrupt' in a.validation_errors.loc['sample1', 'error_message']
+
+def test_file_suffixes(tmp_path):
+
+    import gzip
+    import shutil
+
+    shutil.copy('tests/files/unpaired1.fastq.gz', tmp_path / 'unpaired1.fastq.gz')
+
+    with open('tests/files/nanopore-fastq-upload-csv-pass-1.csv') as INPUT:
+        header, row = INPUT.read().splitlines()[:2]
+
+    # an uncompressed FASTQ is accepted as it is
+    with gzip.open(tmp_path / 'unpaired1.fastq.gz') as INPUT:
+        (tmp_path / 'unpaired1.fastq').write_bytes(INPUT.read())
+
+    for fastq, valid in [('unpaired1.fastq', True), ('unpaired1.fastq.bz2', False)]:
+        with open(tmp_path / 'upload.csv', 'w') as OUTPUT:
+            OUTPUT.write(header + '\n' + row.replace('unpaired1.fastq.gz', fastq) + '\n')
+        a = gpas_uploader.UploadBatch(tmp_path / 'upload.csv')
+        a.validate()
+        assert a.valid == valid
+
+    assert 'fastq must end in .fastq, .fastq.gz or .fastq.zst' in list(a.validation_errors.error_message)
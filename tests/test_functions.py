@@ -68,3 +68,590 @@ def test_samtools_ok(tmp_path):
 
     # insist that the above command did not fail
     assert process.returncode == 0
+
+
+def test_multi_fasta_writer(tmp_path):
+
+    import gzip
+    import gpas_uploader
+
+    filename = tmp_path / 'consensus.fasta.gz'
+
+    def gzi_from_scratch():
+        offsets, uncompressed = [], 0
+        with open(filename, 'rb') as f:
+            for offset, compressed_size, uncompressed_size in gpas_uploader.read_bgzf_blocks(f):
+                if uncompressed_size > 0:
+                    offsets.append((offset, uncompressed))
+                uncompressed += uncompressed_size
+        gpas_uploader.write_gzi(tmp_path / 'expected.gzi', offsets)
+        return (tmp_path / 'expected.gzi').read_bytes()
+
+    a = gpas_uploader.MultiFastaWriter(filename, line_length=4)
+    assert a.append('sample1|guid1', b'ACGTAC\nGT')
+    assert a.append('sample2|guid2', b'TTTT' * 40000)
+    assert not a.append('sample1|guid1', b'ACGT')
+
+    # there can only be one writer at a time
+    with pytest.raises(gpas_uploader.GpasError):
+        gpas_uploader.MultiFastaWriter(filename, line_length=4)
+    a.close()
+
+    # the .gzi is only added to on each append, yet matches one written from scratch
+    assert (tmp_path / 'consensus.fasta.gz.gzi').read_bytes() == gzi_from_scratch()
+
+    # simulate a run that died part way through writing a third record
+    with open(filename, 'ab') as f:
+        f.write(b'\x1f\x8b\x08\x04 junk')
+    with open(str(filename) + '.fai', 'a') as f:
+        f.write('sample3|guid3\t4')
+
+    b = gpas_uploader.MultiFastaWriter(filename, line_length=4)
+    assert 'sample2|guid2' in b and 'sample3|guid3' not in b
+    assert b.append('sample3|guid3', b'CCCC')
+
+    contents = gzip.decompress(filename.read_bytes())
+    assert contents.startswith(b'>sample1|guid1\nACGT\nACGT\n>sample2|guid2\nTTTT\n')
+    assert contents.endswith(b'>sample3|guid3\nCCCC\n')
+
+    # the .fai offsets point at the start of each sequence in the uncompressed file
+    for line in (tmp_path / 'consensus.fasta.gz.fai').read_text().splitlines():
+        name, length, offset, line_bases, line_width = line.split('\t')
+        assert contents[int(offset) - len(name) - 2:int(offset)] == b'>' + bytes(name, encoding='utf8') + b'\n'
+
+    # the .gzi lists every block after the first
+    with open(filename, 'rb') as f:
+        blocks = [i for i in gpas_uploader.read_bgzf_blocks(f)]
+    assert int.from_bytes((tmp_path / 'consensus.fasta.gz.gzi').read_bytes()[:8], 'little') == len(blocks) - 2
+    assert (tmp_path / 'consensus.fasta.gz.gzi').read_bytes() == gzi_from_scratch()
+
+
+@pytest.mark.parametrize('archive_format', ['tar', 'zip'])
+def test_archive_sink(tmp_path, archive_format):
+
+    import csv
+    import hashlib
+    import tarfile
+    import zipfile
+    import gpas_uploader
+
+    a = gpas_uploader.ArchiveSink(tmp_path / 'batch', max_size=2000, archive_format=archive_format)
+
+    files = {'guid1.bam': b'A' * 2500, 'guid1.vcf': b'C' * 700, 'guid2.bam': b'G' * 10}
+    for name, contents in files.items():
+        a.add(name, (contents[i:i+256] for i in range(0, len(contents), 256)), name.split('.')[0], name.split('.')[1])
+    a.close()
+
+    assert ('guid1', 'vcf') in a
+
+    # the archives have been capped at (roughly) 2000 bytes
+    archives = sorted(tmp_path.glob('batch.???.' + archive_format))
+    assert len(archives) == 2
+
+    contents, location = {}, {}
+    for i in archives:
+        if archive_format == 'tar':
+            with tarfile.open(i) as f:
+                for member in f.getmembers():
+                    contents[member.name] = f.extractfile(member).read()
+                    location[member.name] = i.name
+        else:
+            with zipfile.ZipFile(i) as f:
+                for member in f.namelist():
+                    contents[member] = f.read(member)
+                    location[member] = i.name
+    assert contents == files
+
+    with open(tmp_path / 'batch.manifest.csv', newline='') as f:
+        manifest = list(csv.DictReader(f))
+    assert {i['member']: i['archive'] for i in manifest} == location
+    assert manifest[1]['sha256'] == hashlib.sha256(files['guid1.vcf']).hexdigest()
+    assert manifest[1]['size'] == '700'
+
+    # reopening picks up the manifest and starts a new archive
+    b = gpas_uploader.ArchiveSink(tmp_path / 'batch', archive_format=archive_format)
+    assert ('guid2', 'bam') in b
+    assert b.archive_number == 2
+
+    # a zip member is only in the manifest once the zip has been closed, as it cannot be read before then
+    b.add('guid3.vcf', [b'T' * 10], 'guid3', 'vcf')
+    assert ('guid3', 'vcf') in b
+    resumed = gpas_uploader.ArchiveSink(tmp_path / 'batch', archive_format=archive_format)
+    assert (('guid3', 'vcf') in resumed) == (archive_format == 'tar')
+    b.close()
+    assert ('guid3', 'vcf') in gpas_uploader.ArchiveSink(tmp_path / 'batch', archive_format=archive_format)
+
+    # a download that fails part way leaves nothing behind, so a retry gives a single, complete member
+    def dropped():
+        yield b'N' * 300
+        raise ConnectionError('dropped')
+
+    c = gpas_uploader.ArchiveSink(tmp_path / 'retry', archive_format=archive_format)
+    with pytest.raises(ConnectionError):
+        c.add('guid4.fasta', dropped(), 'guid4', 'fasta')
+    c.add('guid4.fasta', [b'N' * 300, b'N' * 20], 'guid4', 'fasta')
+    c.close()
+    if archive_format == 'tar':
+        with tarfile.open(tmp_path / 'retry.001.tar') as f:
+            assert [(i.name, i.size) for i in f.getmembers()] == [('guid4.fasta', 320)]
+    else:
+        with zipfile.ZipFile(tmp_path / 'retry.001.zip') as f:
+            assert [(i.filename, i.file_size) for i in f.infolist()] == [('guid4.fasta', 320)]
+
+    # the next archive is numbered after the highest existing one, so none is overwritten
+    (tmp_path / ('batch.007.' + archive_format)).write_bytes(b'')
+    assert gpas_uploader.ArchiveSink(tmp_path / 'batch', archive_format=archive_format).archive_number == 7
+
+
+def test_download_verifier():
+
+    import base64
+    import gzip
+    import hashlib
+    import gpas_uploader
+
+    def verify(filetype, contents, headers):
+        a = gpas_uploader.DownloadVerifier(filetype, headers)
+        try:
+            b''.join(a.wrap(contents[i:i+7] for i in range(0, len(contents), 7)))
+        except gpas_uploader.GpasError:
+            pass
+        return a.result()
+
+    fasta = gzip.compress(b'>guid1\nACGT\n') + gzip.compress(b'ACGT\n')
+    assert verify('fasta', fasta, {'Content-Length': str(len(fasta))})['status'] == 'verified'
+
+    # a proxy cut the download short
+    result = verify('fasta', fasta[:-5], {})
+    assert result['status'] == 'failed'
+    assert result['errors'] == ['gzip stream is truncated']
+
+    assert verify('fasta', fasta[:-5], {'Content-Length': str(len(fasta))})['errors'][0] == 'expected %i bytes but received %i' % (len(fasta), len(fasta) - 5)
+
+    # a FASTA must be gzipped, and each member's trailer must match its contents
+    assert verify('fasta', b'>guid1\nACGT\n', {})['errors'] == ['FASTA is not gzip-compressed']
+    assert verify('fasta', b'', {})['errors'] == ['FASTA is not gzip-compressed']
+    for i in [-8, -1]:
+        corrupt = bytearray(fasta)
+        corrupt[i] ^= 1
+        result = verify('fasta', bytes(corrupt), {})
+        assert result['status'] == 'failed'
+        assert result['errors'][0].startswith('gzip stream is corrupt')
+    assert verify('fasta', fasta + b'junk', {})['status'] == 'failed'
+
+    bam = gpas_uploader.compress_bgzf_block(b'BAM\x01') + gpas_uploader.BGZF_EOF
+    assert verify('bam', bam, {})['status'] == 'verified'
+    assert verify('bam', bam[:-1], {})['errors'] == ['BAM is missing its BGZF EOF block']
+
+    md5 = base64.b64encode(hashlib.md5(b'{"a": 1}').digest()).decode()
+    assert verify('json', b'{"a": 1}', {'Content-MD5': md5})['status'] == 'verified'
+    assert verify('json', b'{"a": 2}', {'Content-MD5': md5})['errors'] == ['MD5 does not match the server']
+
+
+def test_tracing(tmp_path):
+
+    import json
+    import gpas_uploader
+
+    def failed():
+        raise AssertionError('only worked out when tracing')
+
+    @gpas_uploader.traced('validate', samples=lambda x: len(x))
+    def validate(x):
+        return sum(x)
+
+    # tracing is off by default and spans do nothing
+    with gpas_uploader.span('validate', bytes=failed) as s:
+        s.set(samples=1)
+    assert s is gpas_uploader.NULL_SPAN
+    assert validate([1, 2]) == 3
+
+    gpas_uploader.start_tracing(tmp_path / 'trace.jsonl')
+    try:
+        with gpas_uploader.span('hash', category='sample', sample='sample1', bytes=lambda: 100) as s:
+            s.set(status_code=200)
+        with pytest.raises(gpas_uploader.GpasError):
+            with gpas_uploader.span('upload', samples=1):
+                raise gpas_uploader.GpasError({'upload': 'failed'})
+        assert validate([1, 2]) == 3
+    finally:
+        gpas_uploader.stop_tracing()
+
+    events = [json.loads(i) for i in open(tmp_path / 'trace.jsonl')]
+    assert [i['name'] for i in events] == ['hash', 'upload', 'validate']
+    assert events[0]['cat'] == 'sample'
+    assert events[0]['ph'] == 'X'
+    assert events[0]['args'] == {'sample': 'sample1', 'bytes': 100, 'status_code': 200}
+    assert 'error' in events[1]['args']
+    assert events[2]['args'] == {'samples': 2}
+
+    # the Chrome trace format is a JSON array whose closing bracket may be omitted
+    gpas_uploader.start_tracing(tmp_path / 'trace.json')
+    with gpas_uploader.span('validate', samples=2):
+        pass
+    gpas_uploader.stop_tracing()
+    events = json.loads(open(tmp_path / 'trace.json').read().rstrip().rstrip(',') + ']')
+    assert events[0]['args'] == {'samples': 2}
+
+
+def test_profiling(tmp_path, monkeypatch):
+
+    import io
+    import pstats
+    import gpas_uploader
+
+    a = gpas_uploader.MemoryProfiler()
+    a.start()
+    try:
+        with gpas_uploader.span('decontaminate'):
+            with gpas_uploader.span('run_riak'):
+                x = bytearray(5000000)
+            del x
+            # per-sample spans are ignored
+            with gpas_uploader.span('hash', category='sample'):
+                pass
+    finally:
+        a.stop()
+
+    assert [i['stage'] for i in a.stages] == ['run_riak', 'decontaminate']
+    assert a.stages[0]['peak_bytes'] - a.stages[0]['start_bytes'] >= 5000000
+    # the peak of the inner stage counts towards the outer one
+    assert a.stages[1]['peak_bytes'] >= a.stages[0]['peak_bytes']
+    assert 'run_riak' in a.report(stream=None)
+
+    # spans do nothing again once the profiler has stopped
+    assert gpas_uploader.span('validate') is gpas_uploader.NULL_SPAN
+
+    # Python 3.7 and 3.8 cannot reset the peak, which only makes the peaks higher
+    import tracemalloc
+    monkeypatch.delattr(tracemalloc, 'reset_peak')
+    a = gpas_uploader.MemoryProfiler()
+    a.start()
+    try:
+        with gpas_uploader.span('validate'):
+            pass
+    finally:
+        a.stop()
+    assert [i['stage'] for i in a.stages] == ['validate']
+
+    import threading
+
+    def in_worker_thread():
+        sorted(range(10000), key=lambda i: -i)
+
+    b = gpas_uploader.CpuProfiler(tmp_path / 'run.prof', top=5)
+    b.start()
+    sorted(range(10000), key=lambda i: -i)
+    thread = threading.Thread(target=in_worker_thread)
+    thread.start()
+    thread.join()
+    summary = b.stop(stream=None)
+    assert 'function calls' in summary
+    stats = pstats.Stats(str(tmp_path / 'run.prof'))
+    assert stats.total_calls > 0
+
+    # the work done in other threads is included
+    assert any(i[2] == 'in_worker_thread' for i in stats.stats)
+
+
+def test_metrics_writer(tmp_path):
+
+    import gpas_uploader
+
+    a = gpas_uploader.MetricsWriter(tmp_path / 'gpas.prom', command='submit', interval=None)
+    a.start()
+    try:
+        with gpas_uploader.span('hash_fastqs', samples=2):
+            for i in [100, 250]:
+                with gpas_uploader.span('hash', category='sample') as s:
+                    s.set(bytes=i)
+        with gpas_uploader.span('upload', samples=2) as s:
+            with gpas_uploader.span('upload', category='sample', bytes=10) as t:
+                t.set(status_code=[200, 503])
+            s.set(attempts=3, samples_not_uploaded=1, error='1 sample not uploaded')
+        with gpas_uploader.span('submit_metadata') as s:
+            s.set(status_code=500)
+    finally:
+        a.stop()
+
+    lines = open(tmp_path / 'gpas.prom').read().splitlines()
+    assert lines[-1] == '# EOF'
+    assert 'gpas_uploader_run_finished{command="submit"} 1' in lines
+    assert 'gpas_uploader_samples_processed_total{command="submit",step="hash"} 2' in lines
+    assert 'gpas_uploader_bytes_total{command="submit",step="hash"} 350' in lines
+    assert 'gpas_uploader_stage_samples_total{command="submit",stage="upload"} 2' in lines
+    assert 'gpas_uploader_retries_total{command="submit",stage="upload"} 2' in lines
+    # a stage and a per-sample step of the same name are counted apart
+    assert 'gpas_uploader_failures_total{command="submit",step="upload"} 1' in lines
+    assert 'gpas_uploader_stage_failures_total{command="submit",stage="upload"} 1' in lines
+    assert 'gpas_uploader_stage_failures_total{command="submit",stage="submit_metadata"} 1' in lines
+    assert any(i.startswith('gpas_uploader_stage_duration_seconds_total{command="submit",stage="hash_fastqs"} ') for i in lines)
+
+    # every sample follows the HELP and TYPE of exactly its name, as the Prometheus text format needs
+    types, help = {}, {}
+    for line in lines[:-1]:
+        if line.startswith('# HELP '):
+            name = line.split()[2]
+            help[name] = line
+        elif line.startswith('# TYPE '):
+            name, metric_type = line.split()[2:]
+            assert name in help
+            types[name] = metric_type
+        else:
+            sample, value = line.rsplit(' ', 1)
+            float(value)
+            assert sample.split('{')[0] == name
+            assert (types[name] == 'counter') == name.endswith('_total')
+    assert types['gpas_uploader_failures_total'] == 'counter'
+    assert types['gpas_uploader_run_finished'] == 'gauge'
+
+    # no temporary files are left behind
+    assert [i.name for i in tmp_path.iterdir()] == ['gpas.prom']
+
+
+def test_split_fastq(tmp_path):
+
+    import gzip
+    import gpas_uploader
+
+    reads = [('@read%i runid=abc\n' % i, 'ACGT' * (i % 50 + 1), '+read%i\n' % i) for i in range(1000)]
+    # uncompressed, as a gzipped file is read in blocks too big to split this small
+    fastq = tmp_path / 'big.fastq'
+    with open(fastq, 'w') as f:
+        for name, sequence, plus in reads:
+            f.write(name + sequence + '\n' + plus + 'I' * len(sequence) + '\n')
+
+    chunks = list(gpas_uploader.split_fastq(fastq, 2000, tmp_path, 'big', block_size=1000))
+
+    # several chunks of whole reads which between them hold every read, renamed 1,2,3..
+    assert len(chunks) > 2
+    assert sum(i[1] for i in chunks) == len(reads)
+
+    lines = []
+    for chunk, n in chunks:
+        with gzip.open(chunk, 'rt') as f:
+            chunk_lines = f.read().splitlines()
+        assert len(chunk_lines) == 4 * n
+        lines += chunk_lines
+
+    assert lines[0::4] == ['@%i' % i for i in range(1, len(reads) + 1)]
+    assert lines[1::4] == [i[1] for i in reads]
+    assert set(lines[2::4]) == {'+'}
+
+    assert gpas_uploader.chunk_workers(10e9, 1e9, 4) == 4
+    assert gpas_uploader.chunk_workers(1.5e9, 1e9, 4) == 2
+
+    # a truncated file is refused
+    fastq = tmp_path / 'truncated.fastq.gz'
+    with gzip.open(fastq, 'wt') as f:
+        f.write('@read1\nACGT\n+\n')
+    with pytest.raises(gpas_uploader.GpasError):
+        list(gpas_uploader.split_fastq(fastq, 2000, tmp_path, 'truncated'))
+
+    # as is a chunk whose read count ReadItAndKeep does not report
+    import sys
+    from gpas_uploader.ProcessGeneticFiles import _decontaminate_chunk
+    riak = tmp_path / 'readItAndKeep'
+    riak.write_text('#!%s\nimport sys, gzip\ngzip.open(sys.argv[sys.argv.index("--outprefix") + 1] + ".reads.fastq.gz", "wb").close()\n' % sys.executable)
+    riak.chmod(0o755)
+    chunk, n = chunks[0]
+    with pytest.raises(gpas_uploader.GpasError, match='could not find how many reads'):
+        _decontaminate_chunk(str(riak), 'ref.fasta', chunk, n, 'big', 0, gpas_uploader.Watchdog())
+
+def test_check_files_not_duplicated(tmp_path):
+
+    import os
+    import pandas
+    import gpas_uploader
+
+    (tmp_path / 'a.fastq.gz').write_bytes(b'A' * 100000)
+    shutil.copy(tmp_path / 'a.fastq.gz', tmp_path / 'copy.fastq.gz')
+    os.link(tmp_path / 'a.fastq.gz', tmp_path / 'link.fastq.gz')
+    # the same size and the same first 64 KB, but different
+    (tmp_path / 'b.fastq.gz').write_bytes(b'A' * 99999 + b'B')
+
+    df = pandas.DataFrame({'sample_name': ['a', 'copy', 'link', 'b', 'missing'],
+                           'fastq': ['a.fastq.gz', 'copy.fastq.gz', 'link.fastq.gz', 'b.fastq.gz', 'missing.fastq.gz']})
+    df.set_index('sample_name', inplace=True)
+
+    result, err = gpas_uploader.check_files_not_duplicated_in_df(df, ['fastq'], tmp_path)
+    assert not result
+    assert dict(zip(err.sample_name, err.error_message)) == {'copy': 'same file contents as sample a',
+                                                            'link': 'same files as sample a'}
+
+    result, err = gpas_uploader.check_files_not_duplicated_in_df(df.loc[['a', 'b', 'missing']], ['fastq'], tmp_path)
+    assert result and err is None
+
+    assert gpas_uploader.digest_file(tmp_path / 'a.fastq.gz', 10) == gpas_uploader.digest_file(tmp_path / 'b.fastq.gz', 10)
+
+def test_count_fastq(tmp_path):
+
+    import gzip
+    import gpas_uploader
+
+    fastq = tmp_path / 'reads.fastq.gz'
+    with gzip.open(fastq, 'wt') as f:
+        for i in range(1000):
+            f.write('@read%i\n%s\n+\n%s\n' % (i, 'ACGT' * 10, 'I' * 40))
+
+    assert gpas_uploader.count_fastq(fastq, block_size=1000) == (1000, 40000)
+
+    data = fastq.read_bytes()
+
+    # a file that stops part way through, or whose trailer does not match its contents, is refused
+    (tmp_path / 'truncated.fastq.gz').write_bytes(data[:len(data) // 2])
+    corrupt = bytearray(data)
+    corrupt[-8] ^= 0xff
+    (tmp_path / 'corrupt.fastq.gz').write_bytes(bytes(corrupt))
+    with gzip.open(tmp_path / 'quality.fastq.gz', 'wt') as f:
+        f.write('@read1\nACGT\n+\nIII\n')
+
+    for i in ['truncated', 'corrupt', 'quality']:
+        with pytest.raises(gpas_uploader.GpasError):
+            gpas_uploader.count_fastq(tmp_path / (i + '.fastq.gz'))
+
+    # as is a FASTQ that is not gzipped but ends part way through a read
+    (tmp_path / 'plain.fastq').write_text('@read1\nACGT\n+\nIIII\n@read2\nACGT\n')
+    with pytest.raises(gpas_uploader.GpasError):
+        gpas_uploader.count_fastq(tmp_path / 'plain.fastq')
+
+def test_fastq_stream(tmp_path):
+
+    import gzip
+    import gpas_uploader
+
+    (tmp_path / 'barcode01').mkdir()
+    for i in range(3):
+        with gzip.open(tmp_path / 'barcode01' / ('reads_%i.fastq.gz' % i), 'wt') as f:
+            for j in range(100):
+                f.write('@read%i_%i\nACGT\n+\nIIII\n' % (i, j))
+
+    files = gpas_uploader.expand_fastq('barcode01/*.fastq.gz', tmp_path)
+    assert [i.name for i in files] == ['reads_0.fastq.gz', 'reads_1.fastq.gz', 'reads_2.fastq.gz']
+    assert gpas_uploader.expand_fastq('barcode01/reads_0.fastq.gz', tmp_path) == [tmp_path / 'barcode01' / 'reads_0.fastq.gz']
+    assert gpas_uploader.expand_fastq('barcode02/*.fastq.gz', tmp_path) == []
+
+    # the files are joined, not recompressed, into a pipe that can be read as one gzipped FASTQ
+    with gpas_uploader.FastqStream(files) as reads:
+        for attempt in range(2):
+            reads.start()
+            data = subprocess.run(['cat', str(reads.path)], stdout=subprocess.PIPE, check=True).stdout
+            assert data == b''.join(i.read_bytes() for i in files)
+            assert gzip.decompress(data).count(b'\n') == 1200
+        # a tool that never reads the pipe does not leave it hanging
+        reads.start()
+    assert not reads.path.exists()
+
+    with gpas_uploader.FastqStream(files[:1]) as reads:
+        assert reads.path == files[0]
+
+    # and split as one file, with the reads numbered across all of them
+    chunks = list(gpas_uploader.split_fastq(files, 10 ** 9, tmp_path, 'barcode01'))
+    assert [i[1] for i in chunks] == [300]
+
+    assert gpas_uploader.count_fastq_files(files) == (300, 1200)
+
+def test_fastq_formats(tmp_path):
+
+    import gzip
+    import gpas_uploader
+
+    zstandard = pytest.importorskip('zstandard')
+
+    data = b''.join(b'@read%i\nACGT\n+\nIIII\n' % i for i in range(1000))
+    (tmp_path / 'plain.fastq').write_bytes(data)
+    with gzip.open(tmp_path / 'gzipped.fastq.gz', 'wb') as f:
+        f.write(data)
+    # two frames, as e.g. pzstd writes
+    compressed = zstandard.ZstdCompressor().compress(data[:8000]) + zstandard.ZstdCompressor().compress(data[8000:])
+    (tmp_path / 'zstd.fastq.zst').write_bytes(compressed)
+    (tmp_path / 'truncated.fastq.zst').write_bytes(compressed[:-10])
+
+    for i in ['plain.fastq', 'gzipped.fastq.gz', 'zstd.fastq.zst']:
+        assert gpas_uploader.count_fastq(tmp_path / i) == (1000, 4000)
+    assert gpas_uploader.fastq_compression(tmp_path / 'zstd.fastq.zst') == 'zstd'
+
+    with pytest.raises(gpas_uploader.GpasError):
+        gpas_uploader.count_fastq(tmp_path / 'truncated.fastq.zst')
+
+    # readItAndKeep cannot read zstd, so it is given the decompressed reads
+    with gpas_uploader.FastqStream([tmp_path / 'zstd.fastq.zst']) as reads:
+        reads.start()
+        assert reads.path.name == 'reads.fastq'
+        assert subprocess.run(['cat', str(reads.path)], stdout=subprocess.PIPE, check=True).stdout == data
+        reads.check()
+
+    # as it is a mix of formats
+    with gpas_uploader.FastqStream([tmp_path / 'gzipped.fastq.gz', tmp_path / 'plain.fastq']) as reads:
+        reads.start()
+        assert subprocess.run(['cat', str(reads.path)], stdout=subprocess.PIPE, check=True).stdout == data + data
+
+    # but an uncompressed FASTQ can be read as it is
+    with gpas_uploader.FastqStream([tmp_path / 'plain.fastq']) as reads:
+        assert reads.path == tmp_path / 'plain.fastq'
+
+    # a corrupt file is reported once the tool has finished
+    with gpas_uploader.FastqStream([tmp_path / 'truncated.fastq.zst']) as reads:
+        reads.start()
+        subprocess.run(['cat', str(reads.path)], stdout=subprocess.PIPE, check=True)
+        with pytest.raises(gpas_uploader.GpasError):
+            reads.check()
+
+    assert gpas_uploader.cram_reference_args('sample1.cram', 'ref.fasta') == ['--reference', 'ref.fasta']
+    assert gpas_uploader.cram_reference_args('sample1.bam', 'ref.fasta') == []
+
+
+def test_recompress_bgzf(tmp_path):
+
+    import gzip
+    import hashlib
+    import random
+    import pandas
+    import gpas_uploader
+
+    rng = random.Random(0)
+    data = b''.join(b'@read%i\n%s\n+\n%s\n' % (i, bytes(rng.choices(b'ACGT', k=100)), bytes(rng.choices(b'FI:', k=100))) for i in range(5000))
+    fastq = tmp_path / 'sample1.reads.fastq.gz'
+    fastq.write_bytes(gzip.compress(data, compresslevel=1))
+    size = fastq.stat().st_size
+
+    # the reads compress at least as well at a higher level as at level 1
+    measured = gpas_uploader.measure_compression(fastq, sample_bytes=100000)
+    assert measured['bytes'] == 100000
+    assert measured['bgzf_ratio'] < measured['ratio']
+
+    # whether that pays off depends on how fast the upload is
+    assert gpas_uploader.choose_compression(fastq, None) == 'keep'
+    assert gpas_uploader.choose_compression(fastq, 1) == 'bgzf'
+    assert gpas_uploader.choose_compression(fastq, 1e15) == 'keep'
+
+    row = pandas.Series({'r_uri': fastq.name}, name='sample1')
+    assert list(gpas_uploader.compress_reads(row, ['r_uri'], tmp_path, 'keep')) == ['keep', size, size, 0.0, None]
+
+    md5 = gpas_uploader.digest_file(fastq)
+    result = gpas_uploader.compress_reads(row, ['r_uri'], tmp_path, 'bgzf', threads=2)
+    assert list(result[:3]) == ['bgzf', size, fastq.stat().st_size]
+    assert result[4] == md5
+    assert fastq.stat().st_size < size
+
+    # the file keeps its name, is still gzip and holds the same reads in blocks ending with the BGZF EOF
+    assert gzip.decompress(fastq.read_bytes()) == data
+    assert fastq.read_bytes().endswith(gpas_uploader.BGZF_EOF)
+    assert not (tmp_path / 'sample1.reads.fastq.gz.bgzf').exists()
+
+    # recompressing it again saves nothing, so it is left as it is
+    before = fastq.read_bytes()
+    assert gpas_uploader.recompress_bgzf(fastq) == (len(before), len(before))
+    assert fastq.read_bytes() == before
+    result = gpas_uploader.compress_reads(row, ['r_uri'], tmp_path, 'bgzf')
+    assert list(result[:3]) == ['keep', len(before), len(before)]
+    assert result[4] is None
+    assert fastq.read_bytes() == before
+
+    # the MD5 is also right for an uncompressed FASTQ, which open_fastq peeks at before reading
+    plain = tmp_path / 'sample2.reads.fastq'
+    plain.write_bytes(data)
+    row = pandas.Series({'r_uri': plain.name}, name='sample2')
+    result = gpas_uploader.compress_reads(row, ['r_uri'], tmp_path, 'bgzf')
+    assert result[0] == 'bgzf'
+    assert result[4] == hashlib.md5(data).hexdigest()